@@ -0,0 +1,415 @@
+# ============================================================
+# BENCHMARK_EDITOR_PO – RESUMO FUNCIONAL
+# ============================================================
+# Objetivo:
+# Medir a vazão do EDITOR_AUTOM_PO com uma massa sintética de CT-e,
+# servindo de linha de base para comparar cada alteração no código.
+#
+# Massa gerada:
+# - XMLs no namespace http://www.portalfiscal.inf.br/cte
+# - UFEnv variando entre SP e MG
+# - rem/CNPJ variando entre CACAU e CHOCOLATE
+# - PO em <xObs>, em <ObsCont><xTexto> ou ausente
+# - Tamanho variável (quantidade de <infNFe> em <infDoc>)
+# - ZIPs com XMLs e PDFs (DACTE) pareados
+#
+# Etapas medidas (cada uma em um processo separado, para o pico de
+# memória refletir apenas a etapa):
+# - extrair_info_xml
+# - alterar_po_xml
+# - processar_xml_individual
+# - processar_zip
+# - executar (ponta a ponta, XMLs soltos + ZIPs, com pool de processos)
+#
+# Resultado: arquivos/s, MB/s e pico de memória (RSS) por etapa e volume.
+#
+# Inicialização (--inicializacao): tempo de uma execução completa do
+# programa (processo novo, como no agendador) com as pastas vazias e com
+# um único XML + PDF. Mede o script ou o executável do PyInstaller (--exe).
+#
+# Uso:
+#   python BENCHMARK_EDITOR_PO.py
+#   python BENCHMARK_EDITOR_PO.py --quantidades 1000,10000 --etapas executar
+#   python BENCHMARK_EDITOR_PO.py --inicializacao [--exe dist\EDITOR_AUTOM_PO.exe]
+# ============================================================
+
+
+
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import tempfile
+import subprocess
+
+
+# ============================================================
+# CONFIGURAÇÕES
+# ============================================================
+QUANTIDADES_PADRAO = [1000, 10000, 100000]
+XMLS_POR_ZIP = 500
+SEMENTE = 20251017
+
+ETAPAS = [
+    "extrair_info_xml",
+    "alterar_po_xml",
+    "processar_xml_individual",
+    "processar_zip",
+    "executar",
+]
+
+CASOS_INICIALIZACAO = ["pastas_vazias", "um_arquivo"]
+REPETICOES_INICIALIZACAO = 10
+
+NS_CTE = "http://www.portalfiscal.inf.br/cte"
+
+CNPJS = {
+    "CACAU": "33.163.908/0105-61",
+    "CHOCOLATE": "33.163.908/0085-83",
+}
+
+POS_EXISTENTES = [
+    "4504000000/00010",
+    "4504819456/00010",
+    "4504820478/00010",
+    "4504819478/00020",
+]
+
+
+# ============================================================
+# GERAÇÃO DE CT-e SINTÉTICO
+# ============================================================
+def gerar_cte(rnd, numero):
+    uf = rnd.choice(["SP", "MG"])
+    cnpj = CNPJS[rnd.choice(["CACAU", "CHOCOLATE"])]
+    posicao_po = rnd.choice(["xObs", "xTexto", "nenhum"])
+    po = rnd.choice(POS_EXISTENTES)
+    qtd_nfe = rnd.choice([1, 3, 10, 40, 150])
+
+    cuf = "35" if uf == "SP" else "31"
+    chave = f"{cuf}2510{numero:038d}"
+
+    if posicao_po == "xObs":
+        compl = f"<compl><xObs>PEDIDO {po} REF. FRETE</xObs></compl>"
+    elif posicao_po == "xTexto":
+        compl = (
+            "<compl><ObsCont xCampo=\"PEDIDO\">"
+            f"<xTexto>{po}</xTexto></ObsCont></compl>"
+        )
+    else:
+        compl = "<compl><xObs>SEM PEDIDO INFORMADO</xObs></compl>"
+
+    nfes = "".join(
+        f"<infNFe><chave>{cuf}2510{rnd.randrange(10**30):030d}{i:010d}</chave>"
+        f"<dPrev>2025-10-{1 + i % 28:02d}</dPrev></infNFe>"
+        for i in range(qtd_nfe)
+    )
+
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<cteProc xmlns="{NS_CTE}" versao="4.00">'
+        f'<CTe xmlns="{NS_CTE}"><infCte Id="CTe{chave}" versao="4.00">'
+        "<ide>"
+        f"<cUF>{cuf}</cUF><cCT>{numero % 10**8:08d}</cCT><CFOP>6352</CFOP>"
+        "<natOp>PRESTACAO DE SERVICO DE TRANSPORTE</natOp>"
+        f"<mod>57</mod><serie>1</serie><nCT>{numero}</nCT>"
+        "<dhEmi>2025-10-17T10:00:00-03:00</dhEmi>"
+        f"<xMunEnv>{'SAO PAULO' if uf == 'SP' else 'BELO HORIZONTE'}</xMunEnv>"
+        f"<UFEnv>{uf}</UFEnv><modal>01</modal><tpServ>0</tpServ>"
+        "</ide>"
+        f"{compl}"
+        "<emit><CNPJ>11222333000181</CNPJ><xNome>TRANSPORTADORA TESTE LTDA</xNome></emit>"
+        f"<rem><CNPJ>{cnpj}</CNPJ><xNome>REMETENTE</xNome></rem>"
+        "<dest><CNPJ>99888777000166</CNPJ><xNome>DESTINATARIO</xNome></dest>"
+        "<vPrest><vTPrest>1234.56</vTPrest><vRec>1234.56</vRec></vPrest>"
+        "<infCTeNorm><infCarga><vCarga>98765.43</vCarga><proPred>CHOCOLATE</proPred>"
+        "</infCarga>"
+        f"<infDoc>{nfes}</infDoc></infCTeNorm>"
+        "</infCte></CTe>"
+        "<protCTe versao=\"4.00\"><infProt><cStat>100</cStat></infProt></protCTe>"
+        "</cteProc>"
+    )
+    return xml.encode("utf-8")
+
+
+def gerar_pdf(rnd):
+    # PDF já comprimido: bytes aleatórios não compactam
+    return b"%PDF-1.4\n" + rnd.randbytes(rnd.choice([20_000, 60_000, 120_000]))
+
+
+def gerar_xmls(pasta, quantidade, rnd, com_pdf=False):
+    os.makedirs(pasta, exist_ok=True)
+    total_bytes = 0
+    for i in range(quantidade):
+        dados = gerar_cte(rnd, i + 1)
+        with open(os.path.join(pasta, f"CTE_{i + 1:06d}.xml"), "wb") as f:
+            f.write(dados)
+        total_bytes += len(dados)
+
+        if com_pdf:
+            with open(os.path.join(pasta, f"CTE_{i + 1:06d}.pdf"), "wb") as f:
+                f.write(gerar_pdf(rnd))
+    return total_bytes
+
+
+def gerar_zips(pasta, quantidade, rnd):
+    os.makedirs(pasta, exist_ok=True)
+    total_bytes = 0
+    numero = 0
+    lote = 0
+
+    while numero < quantidade:
+        lote += 1
+        caminho = os.path.join(pasta, f"LOTE_{lote:04d}.zip")
+        with zipfile.ZipFile(caminho, "w", zipfile.ZIP_DEFLATED) as zf:
+            for _ in range(min(XMLS_POR_ZIP, quantidade - numero)):
+                numero += 1
+                zf.writestr(f"CTE_{numero:06d}.xml", gerar_cte(rnd, numero))
+                zf.writestr(f"CTE_{numero:06d}.pdf", gerar_pdf(rnd))
+        total_bytes += os.path.getsize(caminho)
+
+    return total_bytes
+
+
+# ============================================================
+# MEDIÇÃO
+# ============================================================
+def pico_memoria_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    proprio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    filhos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    pico = max(proprio, filhos)
+    # Linux informa em KB; macOS em bytes
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def preparar_ambiente(raiz):
+    # get_desktop_path() usa o diretório do usuário: aponta para a massa
+    os.environ["HOME"] = raiz
+    os.environ["USERPROFILE"] = raiz
+
+    import EDITOR_AUTOM_PO as editor
+
+    pastas = editor.definir_pastas_base()
+    editor.garantir_pastas(pastas)
+    return editor, pastas
+
+
+def medir_etapa(etapa, quantidade, raiz, workers):
+    rnd = random.Random(SEMENTE)
+    editor, pastas = preparar_ambiente(raiz)
+    entrada = pastas["ENTRADA_FRETE"]
+
+    if etapa == "processar_zip":
+        total_bytes = gerar_zips(entrada, quantidade, rnd)
+    elif etapa == "executar":
+        metade = quantidade // 2
+        total_bytes = gerar_xmls(entrada, metade, rnd, com_pdf=True)
+        total_bytes += gerar_zips(pastas["ENTRADA_CUSTO"], quantidade - metade, rnd)
+    else:
+        total_bytes = gerar_xmls(entrada, quantidade, rnd)
+
+    arquivos = sorted(os.path.join(entrada, nome) for nome in os.listdir(entrada))
+
+    inicio = time.perf_counter()
+
+    if etapa == "extrair_info_xml":
+        for caminho in arquivos:
+            editor.extrair_info_xml(caminho)
+
+    elif etapa == "alterar_po_xml":
+        for caminho in arquivos:
+            editor.alterar_po_xml(caminho, "4504819456/00010")
+
+    elif etapa == "processar_xml_individual":
+        for caminho in arquivos:
+            editor.processar_xml_individual(pastas, "FRETE", caminho)
+
+    elif etapa == "processar_zip":
+        for caminho in arquivos:
+            editor.processar_zip(pastas, "FRETE", caminho)
+
+    elif etapa == "executar":
+        editor.executar(pastas, workers=workers)
+
+    duracao = time.perf_counter() - inicio
+
+    editor.descarregar_logs()
+    erros = os.path.join(pastas["LOG"], "LOG_ERRO.txt")
+
+    return {
+        "etapa": etapa,
+        "quantidade": quantidade,
+        "segundos": round(duracao, 3),
+        "arquivos_s": round(quantidade / duracao, 1) if duracao else None,
+        "mb_s": round(total_bytes / (1024 * 1024) / duracao, 2) if duracao else None,
+        "mb_entrada": round(total_bytes / (1024 * 1024), 2),
+        "pico_rss_mb": pico_memoria_mb(),
+        "erros": os.path.exists(erros),
+    }
+
+
+def rodar_em_subprocesso(etapa, quantidade, workers):
+    raiz = tempfile.mkdtemp(prefix="BENCH_PO_")
+    try:
+        resultado = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__),
+                "--interno", etapa, str(quantidade), raiz,
+                "--workers", str(workers),
+            ],
+            capture_output=True, text=True, check=True,
+        )
+        return json.loads(resultado.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(raiz, ignore_errors=True)
+
+
+def medir_inicializacao(caso, comando, repeticoes):
+    tempos = []
+
+    for _ in range(repeticoes):
+        raiz = tempfile.mkdtemp(prefix="BENCH_PO_")
+        ambiente = dict(os.environ, HOME=raiz, USERPROFILE=raiz)
+        try:
+            # A primeira execução só cria a estrutura de pastas
+            subprocess.run(comando, env=ambiente, capture_output=True, check=True)
+
+            if caso == "um_arquivo":
+                entrada = os.path.join(
+                    raiz, "Desktop", "EDITOR_BO_BARRY", "PARA_EDICAO", "FRETE"
+                )
+                gerar_xmls(entrada, 1, random.Random(SEMENTE), com_pdf=True)
+
+            inicio = time.perf_counter()
+            subprocess.run(comando, env=ambiente, capture_output=True, check=True)
+            tempos.append(time.perf_counter() - inicio)
+        finally:
+            shutil.rmtree(raiz, ignore_errors=True)
+
+    tempos.sort()
+    return {
+        "caso": caso,
+        "repeticoes": repeticoes,
+        "ms_min": round(tempos[0] * 1000, 1),
+        "ms_mediana": round(tempos[len(tempos) // 2] * 1000, 1),
+        "ms_max": round(tempos[-1] * 1000, 1),
+    }
+
+
+# ============================================================
+# RELATÓRIO
+# ============================================================
+def imprimir_tabela(resultados):
+    print("=" * 96)
+    print(
+        f"{'ETAPA':<26}{'ARQUIVOS':>10}{'SEGUNDOS':>11}"
+        f"{'ARQ/S':>11}{'MB/S':>10}{'MB':>10}{'PICO RSS MB':>14}"
+    )
+    print("-" * 96)
+    for r in resultados:
+        rss = f"{r['pico_rss_mb']:.1f}" if r["pico_rss_mb"] is not None else "N/D"
+        print(
+            f"{r['etapa']:<26}{r['quantidade']:>10}{r['segundos']:>11}"
+            f"{r['arquivos_s']:>11}{r['mb_s']:>10}{r['mb_entrada']:>10}{rss:>14}"
+            f"{'  (com erros)' if r['erros'] else ''}"
+        )
+    print("=" * 96)
+
+
+def imprimir_tabela_inicializacao(resultados):
+    print("=" * 60)
+    print(f"{'CASO':<18}{'EXECUÇÕES':>10}{'MIN MS':>10}{'MEDIANA MS':>12}{'MAX MS':>10}")
+    print("-" * 60)
+    for r in resultados:
+        print(
+            f"{r['caso']:<18}{r['repeticoes']:>10}{r['ms_min']:>10}"
+            f"{r['ms_mediana']:>12}{r['ms_max']:>10}"
+        )
+    print("=" * 60)
+
+
+# ============================================================
+# MAIN
+# ============================================================
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do EDITOR_AUTOM_PO")
+    parser.add_argument(
+        "--quantidades", default=",".join(str(q) for q in QUANTIDADES_PADRAO),
+        help="volumes de arquivos separados por vírgula (padrão: 1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--etapas", default=",".join(ETAPAS),
+        help=f"etapas separadas por vírgula (padrão: {','.join(ETAPAS)})",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="processos para a etapa executar (padrão: nº de CPUs)",
+    )
+    parser.add_argument(
+        "--inicializacao", action="store_true",
+        help="mede o tempo de inicialização (pastas vazias e um único arquivo)",
+    )
+    parser.add_argument(
+        "--exe", help="executável do PyInstaller a medir em --inicializacao (padrão: o script)",
+    )
+    parser.add_argument(
+        "--repeticoes", type=int, default=REPETICOES_INICIALIZACAO,
+        help=f"execuções por caso em --inicializacao (padrão: {REPETICOES_INICIALIZACAO})",
+    )
+    parser.add_argument("--json", help="grava os resultados também neste arquivo JSON")
+    parser.add_argument("--interno", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.interno:
+        etapa, quantidade, raiz = args.interno
+        print(json.dumps(medir_etapa(etapa, int(quantidade), raiz, args.workers)))
+        return
+
+    if args.inicializacao:
+        comando = [args.exe] if args.exe else [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "EDITOR_AUTOM_PO.py"),
+        ]
+        comando += ["--workers", "1"]
+
+        resultados = []
+        for caso in CASOS_INICIALIZACAO:
+            print(f"⏱️ inicialização: {caso}...", flush=True)
+            resultados.append(medir_inicializacao(caso, comando, args.repeticoes))
+        imprimir_tabela_inicializacao(resultados)
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        return
+
+    etapas = [e.strip() for e in args.etapas.split(",") if e.strip()]
+    for etapa in etapas:
+        if etapa not in ETAPAS:
+            parser.error(f"etapa desconhecida: {etapa}")
+
+    resultados = []
+    for quantidade in [int(q) for q in args.quantidades.split(",")]:
+        for etapa in etapas:
+            print(f"⏱️ {etapa} ({quantidade} arquivos)...", flush=True)
+            resultados.append(rodar_em_subprocesso(etapa, quantidade, args.workers))
+
+    imprimir_tabela(resultados)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
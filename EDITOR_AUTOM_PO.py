@@ -7,6 +7,23 @@
 #
 # Funcionamento geral:
 # - O sistema roda automaticamente (manual, Agendador do Windows ou .exe).
+# - Várias instâncias (ou máquinas) podem trabalhar na mesma pasta: cada
+#   arquivo é reivindicado por renomeação atômica e processado uma única vez.
+# - Toda saída é gravada em arquivo temporário e renomeada; após uma queda,
+#   a próxima execução retoma só o que estava em andamento (journal) e
+#   repõe o log/auditoria dos itens que já tinham sido concluídos.
+# - Também pode ser importado como biblioteca (ver API PARA USO COMO
+#   BIBLIOTECA): processar_cte_bytes e processar_zip_stream trabalham em
+#   memória / streams, sem as pastas do Desktop.
+# - Com --dry-run só gera um relatório (LOG/PREVIA_PO_<data>.csv ou .json)
+#   com tomador, UF, PO atual e PO de destino de cada XML, inclusive dentro
+#   dos ZIPs, sem alterar nenhum arquivo.
+# - Com --serve sobe um serviço HTTP local (POST /processar?tipo=...) que
+#   devolve o XML/ZIP corrigido, com o pool de processos sempre aquecido.
+# - Com --watch fica em execução contínua e processa cada arquivo assim que
+#   ele termina de ser copiado para a pasta de entrada.
+# - Os arquivos são processados em paralelo (--workers N, padrão = nº de CPUs);
+#   os logs continuam saindo em ordem fixa (tipo, nome do arquivo).
 # - Trabalha sempre na Área de Trabalho do usuário, na pasta:
 #   EDITOR_BO_BARRY
 #
@@ -19,6 +36,14 @@
 #     ├─ FRETE
 #     ├─ TRANSFERENCIA
 #     └─ CUSTO
+#   (opcionalmente em subpastas: --layout-saida mes/tomador/uf gera
+#   SAIDA_FINAL/FRETE/2026-10/CACAU/SP/; --migrar-saida reorganiza a saída
+#   já existente)
+#   (com --pacote-saida os XMLs soltos saem agrupados em
+#   PACOTE_<TIPO>_<data>_<instância>.zip; manifesto em
+#   LOG/MANIFESTO_PACOTES.jsonl)
+# - EM_PROCESSAMENTO/   (arquivos reivindicados por cada instância)
+# - QUARENTENA/         (ZIP-bomba, XML gigante: fora dos limites, por tipo)
 # - LOG/
 #
 # Regras de processamento:
@@ -35,12 +60,15 @@
 # - XML solto:
 #     • PO é validado/alterado
 #     • XML é movido para a pasta de saída correspondente
-#     • PDF (DACTE), se existir, é movido junto
+#     • PDF (DACTE), se existir, é movido junto (mesmo nome ou mesma chave
+#       de acesso no nome, achado no índice da pasta, sem stat por arquivo)
 #
 # - ZIP:
-#     • ZIP é extraído em pasta temporária
-#     • Todos os XMLs internos são processados
-#     • PDFs e demais arquivos são preservados
+#     • ZIP é lido membro a membro, sem extração em disco
+#     • Todos os XMLs internos são processados em memória
+#     • ZIPs dentro do ZIP também (até --zip-profundidade níveis), refeitos
+#       em memória e recolocados no lugar; o log traz a contagem por nível
+#     • PDFs e demais arquivos são copiados em bruto (sem recompactar)
 #     • ZIP é recomposto com o mesmo nome
 #     • ZIP final é movido para a pasta de saída correspondente
 #
@@ -54,6 +82,24 @@
 #     • Gerado somente se ocorrer falha
 #     • Arquivos com erro permanecem na pasta de entrada
 #
+# - Gravação em lote (buffer) e rotação opcional por tamanho ou por dia,
+#   com compactação .gz dos arquivos rotacionados (--log-rotacao / --log-gzip)
+#
+# - AUDITORIA_PO.db (SQLite)
+#     • Uma linha por XML processado, inclusive dentro dos ZIPs: chave, nCT,
+#       CNPJ, tomador, UF, PO antes e depois, data
+#     • Consulta: --consultar [--chave | --nct | --cnpj | --po | --desde | --ate]
+#       [--formato texto|csv|json]; LOG_EDICAO_PO.txt pode ser desligado
+#       com --sem-log-texto
+#
+# - METRICAS_EXECUCAO.json / editor_po.prom
+#     • Tempo (total e percentis) e bytes por etapa da última execução
+#       (em --watch/--serve, acumulado desde o início do processo)
+#     • O .prom segue o formato "textfile" do node exporter (Prometheus),
+#       com as durações em histograma de faixas fixas
+#     • Tamanho original x gravado e CPU da compressão dos ZIPs por política
+#       (bruto / deflate / stored), para ajustar --zip-nivel e --zip-threads
+#
 # Comportamento esperado:
 # - Em sucesso: pasta de entrada fica vazia
 # - Em erro: nada é movido e o erro é registrado
@@ -61,19 +107,44 @@
 # Observação importante:
 # - O mesmo XML pode ser processado novamente em outra pasta.
 # - O PO final sempre refletirá o TIPO da pasta atual.
+# - LOG/INDICE_CTE.db registra o hash de cada XML solto já gravado na saída:
+#   se o mesmo XML voltar para a mesma pasta, ele é apenas movido.
+#   Chaves de acesso repetidas saem no log como DUPLICADO.
 # ============================================================
 
 
 
 
+import io
 import os
 import re
+import sys
+import time
+import gzip
+import atexit
+import signal
+import threading
+import select
+import socket
+import argparse
+import bisect
+import multiprocessing
 import shutil
+import copy
+import errno
+import json
+import mmap
+import struct
+import contextlib
+import hashlib
+import importlib
 import zipfile
-import tempfile
+import zlib
 from datetime import datetime
 from collections import Counter
-from lxml import etree
+from itertools import repeat
+# lxml, sqlite3, ctypes, csv e concurrent.futures são importados só nas
+# funções que usam: uma execução com as pastas vazias não paga por eles.
 
 
 # ============================================================
@@ -103,6 +174,12 @@ def definir_pastas_base():
         "SAIDA_TRANSFERENCIA": os.path.join(base, "SAIDA_FINAL", "TRANSFERENCIA"),
         "SAIDA_CUSTO": os.path.join(base, "SAIDA_FINAL", "CUSTO"),
 
+        # Arquivos em processamento (1 subpasta por worker, ver LEASES)
+        "PROCESSAMENTO": os.path.join(base, "EM_PROCESSAMENTO"),
+
+        # Arquivos recusados pelos limites (ver LIMITES)
+        "QUARENTENA": os.path.join(base, "QUARENTENA"),
+
         # Logs
         "LOG": os.path.join(base, "LOG"),
     }
@@ -113,41 +190,354 @@ def garantir_pastas(pastas):
         os.makedirs(caminho, exist_ok=True)
 
 
+# ============================================================
+# MÉTRICAS
+# ============================================================
+# Tempo e volume por etapa do processamento (parse, edição do PO, gravação,
+# ZIP, PDF, log). Ao fim de cada execução é gravado em LOG/:
+# - METRICAS_EXECUCAO.json: resumo da execução
+# - editor_po.prom: formato "textfile" do node exporter do Prometheus
+# Nos workers do pool as medições são devolvidas junto com o resultado de
+# cada tarefa e somadas no processo principal.
+# As durações vão para faixas fixas (histograma): a memória não cresce com o
+# tempo de vida do processo (--watch/--serve) e os percentis saem das faixas.
+FAIXAS_METRICA = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+_metricas = {}
+_lock_metricas = threading.Lock()
+
+
+def nova_metrica():
+    # A última faixa conta o que passou de FAIXAS_METRICA[-1]
+    return {
+        "faixas": [0] * (len(FAIXAS_METRICA) + 1),
+        "quantidade": 0, "segundos": 0.0, "max": 0.0, "bytes": 0,
+    }
+
+
+def registrar_metrica(etapa, duracao, tamanho=0):
+    with _lock_metricas:
+        metrica = _metricas.get(etapa)
+        if metrica is None:
+            metrica = _metricas[etapa] = nova_metrica()
+        metrica["faixas"][bisect.bisect_left(FAIXAS_METRICA, duracao)] += 1
+        metrica["quantidade"] += 1
+        metrica["segundos"] += duracao
+        metrica["max"] = max(metrica["max"], duracao)
+        metrica["bytes"] += tamanho
+
+
+@contextlib.contextmanager
+def medir(etapa, tamanho=0):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_metrica(etapa, time.perf_counter() - inicio, tamanho)
+
+
+def coletar_metricas():
+    # Entrega e zera as medições locais (usado pelos workers)
+    with _lock_metricas:
+        parciais = dict(_metricas)
+        _metricas.clear()
+    return parciais
+
+
+def mesclar_metricas(parciais):
+    with _lock_metricas:
+        for etapa, dados in parciais.items():
+            metrica = _metricas.get(etapa)
+            if metrica is None:
+                metrica = _metricas[etapa] = nova_metrica()
+            metrica["faixas"] = [a + b for a, b in zip(metrica["faixas"], dados["faixas"])]
+            metrica["quantidade"] += dados["quantidade"]
+            metrica["segundos"] += dados["segundos"]
+            metrica["max"] = max(metrica["max"], dados["max"])
+            metrica["bytes"] += dados["bytes"]
+
+
+def percentil(metrica, fracao):
+    # Limite superior da faixa que contém o percentil (nunca acima do máximo)
+    if not metrica["quantidade"]:
+        return 0.0
+    alvo = fracao * metrica["quantidade"]
+    acumulado = 0
+    for limite, contagem in zip(FAIXAS_METRICA, metrica["faixas"]):
+        acumulado += contagem
+        if acumulado >= alvo:
+            return min(limite, metrica["max"])
+    return metrica["max"]
+
+
+def resumir_metricas():
+    resumo = {}
+    with _lock_metricas:
+        for etapa, dados in sorted(_metricas.items()):
+            total = dados["segundos"]
+            resumo[etapa] = {
+                "quantidade": dados["quantidade"],
+                "segundos_total": round(total, 6),
+                "p50": round(percentil(dados, 0.50), 6),
+                "p95": round(percentil(dados, 0.95), 6),
+                "p99": round(percentil(dados, 0.99), 6),
+                "max": round(dados["max"], 6),
+                "bytes": dados["bytes"],
+                "mb_s": round(dados["bytes"] / (1024 * 1024) / total, 2) if total else 0.0,
+                "faixas": dict(zip(
+                    [str(limite) for limite in FAIXAS_METRICA] + ["+Inf"], dados["faixas"]
+                )),
+            }
+    return resumo
+
+
+def gravar_atomico(caminho, texto):
+    temporario = caminho + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        f.write(texto)
+    os.replace(temporario, caminho)
+
+
+def exportar_metricas(pastas, inicio, fim):
+    resumo = resumir_metricas()
+    compressao = resumir_compressao()
+
+    gravar_atomico(
+        os.path.join(pastas["LOG"], "METRICAS_EXECUCAO.json"),
+        json.dumps(
+            {
+                "inicio": f"{datetime.fromtimestamp(inicio):%Y-%m-%d %H:%M:%S}",
+                "fim": f"{datetime.fromtimestamp(fim):%Y-%m-%d %H:%M:%S}",
+                "segundos": round(fim - inicio, 3),
+                "etapas": resumo,
+                "compressao": compressao,
+            },
+            indent=2,
+            ensure_ascii=False,
+        ),
+    )
+
+    linhas = [
+        "# HELP editor_po_etapa_segundos Duração por etapa do EDITOR_AUTOM_PO.",
+        "# TYPE editor_po_etapa_segundos histogram",
+    ]
+    for etapa, m in resumo.items():
+        acumulado = 0
+        for limite, contagem in m["faixas"].items():
+            acumulado += contagem
+            linhas.append(
+                f'editor_po_etapa_segundos_bucket{{etapa="{etapa}",le="{limite}"}} {acumulado}'
+            )
+        linhas.append(f'editor_po_etapa_segundos_sum{{etapa="{etapa}"}} {m["segundos_total"]}')
+        linhas.append(f'editor_po_etapa_segundos_count{{etapa="{etapa}"}} {m["quantidade"]}')
+
+    linhas += [
+        "# HELP editor_po_etapa_bytes Bytes processados por etapa.",
+        "# TYPE editor_po_etapa_bytes gauge",
+    ]
+    linhas += [
+        f'editor_po_etapa_bytes{{etapa="{etapa}"}} {m["bytes"]}'
+        for etapa, m in resumo.items()
+    ]
+    linhas += [
+        "# HELP editor_po_zip_bytes Bytes dos membros de ZIP por política de compressão.",
+        "# TYPE editor_po_zip_bytes gauge",
+    ]
+    for politica, c in compressao.items():
+        linhas.append(f'editor_po_zip_bytes{{politica="{politica}",tipo="original"}} {c["bytes_originais"]}')
+        linhas.append(f'editor_po_zip_bytes{{politica="{politica}",tipo="gravado"}} {c["bytes_gravados"]}')
+    linhas += [
+        "# HELP editor_po_zip_cpu_segundos CPU gasta na compressão por política.",
+        "# TYPE editor_po_zip_cpu_segundos gauge",
+    ]
+    linhas += [
+        f'editor_po_zip_cpu_segundos{{politica="{politica}"}} {c["cpu_segundos"]}'
+        for politica, c in compressao.items()
+    ]
+    linhas += [
+        "# HELP editor_po_execucao_segundos Duração da última execução.",
+        "# TYPE editor_po_execucao_segundos gauge",
+        f"editor_po_execucao_segundos {round(fim - inicio, 3)}",
+        "# HELP editor_po_execucao_timestamp_segundos Fim da última execução (epoch).",
+        "# TYPE editor_po_execucao_timestamp_segundos gauge",
+        f"editor_po_execucao_timestamp_segundos {int(fim)}",
+    ]
+
+    gravar_atomico(os.path.join(pastas["LOG"], "editor_po.prom"), "\n".join(linhas) + "\n")
+
+
 # ============================================================
 # LOGS
 # ============================================================
-def registrar_log_xml(pastas, tipo, arquivo, po_antigo, po_novo):
-    log = os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt")
-    with open(log, "a", encoding="utf-8") as f:
-        f.write(
-            f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
-            f"{tipo} | {arquivo} | "
-            f"PO_ANTES={po_antigo} | PO_DEPOIS={po_novo}\n"
+# As linhas ficam em buffer na memória e são gravadas em lote: a cada
+# LOG_LOTE_LINHAS linhas, a cada LOG_INTERVALO_FLUSH segundos ou no
+# encerramento do programa (atexit / SIGTERM).
+#
+# Rotação (opcional, ver --log-rotacao):
+# - "tamanho": rotaciona quando o arquivo passa de LOG_TAMANHO_MAXIMO bytes
+# - "diaria":  rotaciona na virada do dia
+# O arquivo rotacionado recebe a data/hora no nome e, com LOG_COMPACTAR,
+# é compactado em .gz.
+LOG_LOTE_LINHAS = 500
+LOG_INTERVALO_FLUSH = 5.0
+LOG_ROTACAO = "nenhuma"
+LOG_TAMANHO_MAXIMO = 10 * 1024 * 1024
+LOG_COMPACTAR = False
+# LOG_EDICAO_PO.txt é opcional: o histórico completo fica em LOG/AUDITORIA_PO.db
+LOG_TEXTO = True
+
+_buffers_log = {}
+_lock_log = threading.Lock()
+
+
+def configurar_log(rotacao=None, tamanho_maximo=None, compactar=None, texto=None):
+    global LOG_ROTACAO, LOG_TAMANHO_MAXIMO, LOG_COMPACTAR, LOG_TEXTO
+
+    if rotacao is not None:
+        LOG_ROTACAO = rotacao
+    if tamanho_maximo is not None:
+        LOG_TAMANHO_MAXIMO = tamanho_maximo
+    if compactar is not None:
+        LOG_COMPACTAR = compactar
+    if texto is not None:
+        LOG_TEXTO = texto
+
+
+def nome_rotacionado(log, instante):
+    base, ext = os.path.splitext(log)
+    destino = f"{base}_{instante:%Y%m%d_%H%M%S}{ext}"
+
+    sequencia = 1
+    while os.path.exists(destino) or os.path.exists(destino + ".gz"):
+        destino = f"{base}_{instante:%Y%m%d_%H%M%S}_{sequencia}{ext}"
+        sequencia += 1
+
+    return destino
+
+
+def rotacionar_log(log, tamanho_novo):
+    if LOG_ROTACAO == "nenhuma" or not os.path.exists(log):
+        return
+
+    st = os.stat(log)
+    modificado = datetime.fromtimestamp(st.st_mtime)
+
+    if LOG_ROTACAO == "tamanho":
+        if st.st_size == 0 or st.st_size + tamanho_novo <= LOG_TAMANHO_MAXIMO:
+            return
+    elif LOG_ROTACAO == "diaria":
+        if modificado.date() == datetime.now().date():
+            return
+
+    destino = nome_rotacionado(log, modificado)
+    os.replace(log, destino)
+
+    if LOG_COMPACTAR:
+        with open(destino, "rb") as origem, gzip.open(destino + ".gz", "wb") as gz:
+            shutil.copyfileobj(origem, gz)
+        os.remove(destino)
+
+
+def descarregar_log(log):
+    linhas = _buffers_log.get(log, {}).get("linhas")
+    if not linhas:
+        return
+
+    texto = "".join(linhas)
+    tamanho = len(texto.encode("utf-8"))
+    with medir("gravar_log", tamanho):
+        rotacionar_log(log, tamanho)
+        with open(log, "a", encoding="utf-8") as f:
+            f.write(texto)
+
+    _buffers_log[log] = {"linhas": [], "desde": time.monotonic()}
+
+
+def descarregar_logs():
+    with _lock_log:
+        for log in list(_buffers_log):
+            try:
+                descarregar_log(log)
+            except OSError:
+                pass
+
+
+def escrever_log(log, linha):
+    with _lock_log:
+        buffer = _buffers_log.setdefault(
+            log, {"linhas": [], "desde": time.monotonic()}
         )
+        buffer["linhas"].append(linha)
 
+        if (
+            len(buffer["linhas"]) >= LOG_LOTE_LINHAS
+            or time.monotonic() - buffer["desde"] >= LOG_INTERVALO_FLUSH
+        ):
+            descarregar_log(log)
 
-def registrar_log_zip_resumido(pastas, tipo, zip_nome, total, antes, depois):
+
+atexit.register(descarregar_logs)
+
+
+def formatar_log_xml(tipo, arquivo, po_antigo, po_novo, observacao=None):
+    return (
+        f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
+        f"{tipo} | {arquivo} | "
+        f"PO_ANTES={po_antigo} | PO_DEPOIS={po_novo}"
+        f"{f' | {observacao}' if observacao else ''}"
+    )
+
+
+def formatar_log_zip_resumido(tipo, zip_nome, total, antes, depois, niveis=None):
     def fmt(counter):
         return ", ".join([f"{qtd}x {po}" for po, qtd in counter.items()])
 
+    linha = (
+        f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
+        f"{tipo} | {zip_nome} | "
+        f"TOTAL_XML={total} | "
+        f"PO_ANTES=[{fmt(antes)}] | "
+        f"PO_DEPOIS=[{fmt(depois)}]"
+    )
+
+    # XMLs em ZIPs internos: contagem por nível (0 = ZIP recebido)
+    if niveis and set(niveis) != {0}:
+        for nivel, contagem in sorted(niveis.items()):
+            linha += (
+                f" | NIVEL_{nivel}: TOTAL_XML={contagem['TOTAL_XML']} "
+                f"PO_ANTES=[{fmt(contagem['PO_ANTES'])}] "
+                f"PO_DEPOIS=[{fmt(contagem['PO_DEPOIS'])}]"
+            )
+    return linha
+
+
+def registrar_log_xml(pastas, tipo, arquivo, po_antigo, po_novo, observacao=None):
+    if not LOG_TEXTO:
+        return
     log = os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt")
-    with open(log, "a", encoding="utf-8") as f:
-        f.write(
-            f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
-            f"{tipo} | {zip_nome} | "
-            f"TOTAL_XML={total} | "
-            f"PO_ANTES=[{fmt(antes)}] | "
-            f"PO_DEPOIS=[{fmt(depois)}]\n"
-        )
+    escrever_log(
+        log, formatar_log_xml(tipo, arquivo, po_antigo, po_novo, observacao) + "\n"
+    )
+
+
+def registrar_log_zip_resumido(pastas, tipo, zip_nome, total, antes, depois, niveis=None):
+    if not LOG_TEXTO:
+        return
+    log = os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt")
+    escrever_log(
+        log, formatar_log_zip_resumido(tipo, zip_nome, total, antes, depois, niveis) + "\n"
+    )
 
 
 def registrar_erro(pastas, tipo, arquivo, erro):
     log = os.path.join(pastas["LOG"], "LOG_ERRO.txt")
-    with open(log, "a", encoding="utf-8") as f:
-        f.write(
-            f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
-            f"{tipo} | {arquivo} | ERRO={erro}\n"
-        )
+    escrever_log(
+        log,
+        f"{datetime.now():%Y-%m-%d %H:%M:%S} | "
+        f"{tipo} | {arquivo} | ERRO={erro}\n"
+    )
 
 
 # ============================================================
@@ -175,150 +565,2998 @@ PO_RULES = {
 # ============================================================
 # XML
 # ============================================================
-def extrair_info_xml(xml_path):
-    tree = etree.parse(xml_path)
-    ns = {"cte": "http://www.portalfiscal.inf.br/cte"}
+PADRAO_PO = re.compile(rb"4504\d{6,}/\d{5}")
+
+
+TAG_INF_CTE = "{http://www.portalfiscal.inf.br/cte}infCte"
+TAG_UFENV = "{http://www.portalfiscal.inf.br/cte}UFEnv"
+TAG_NCT = "{http://www.portalfiscal.inf.br/cte}nCT"
+TAG_REM = "{http://www.portalfiscal.inf.br/cte}rem"
+TAG_CNPJ = "{http://www.portalfiscal.inf.br/cte}CNPJ"
+
+
+def extrair_info_cte(fonte):
+    # Leitura incremental (iterparse): UFEnv, nCT e rem/CNPJ ficam no início
+    # do infCte, então o parse para assim que os três aparecem, sem montar a
+    # árvore de infCarga/infDoc. Os elementos já lidos são liberados.
+    from lxml import etree
+
+    chave = ""
+    uf = nct = cnpj = None
+
+    for evento, elem in etree.iterparse(fonte, events=("start", "end")):
+        if evento == "start":
+            if elem.tag == TAG_INF_CTE:
+                chave = elem.get("Id", "")[3:]
+            continue
+
+        if elem.tag == TAG_UFENV and uf is None:
+            uf = elem.text
+        elif elem.tag == TAG_NCT and nct is None:
+            nct = elem.text
+        elif elem.tag == TAG_CNPJ and cnpj is None:
+            pai = elem.getparent()
+            if pai is not None and pai.tag == TAG_REM:
+                cnpj = elem.text
 
-    uf = tree.findtext(".//cte:UFEnv", namespaces=ns)
-    cnpj = tree.findtext(".//cte:rem/cte:CNPJ", namespaces=ns)
+        if uf is not None and nct is not None and cnpj is not None:
+            break
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
     if not uf or not cnpj:
         raise ValueError("UF ou CNPJ não encontrados")
 
+    return montar_info(uf, cnpj, nct, chave)
+
+
+def montar_info(uf, cnpj, nct, chave):
     cnpj = re.sub(r"\D", "", cnpj)
     tomador = "CACAU" if cnpj == CNPJ_CACAU else "CHOCOLATE"
 
-    return uf, tomador
+    return {"UF": uf, "TOMADOR": tomador, "CNPJ": cnpj, "nCT": nct, "CHAVE": chave}
 
 
-def alterar_po_xml(xml_path, novo_po):
-    with open(xml_path, "r", encoding="utf-8") as f:
-        xml = f.read()
+# Leitura rápida, sem lxml: UFEnv, nCT, rem/CNPJ e o Id do infCte são
+# localizados direto nos bytes (ou no mmap). Qualquer caso fora do padrão
+# (UTF-16, comentário/CDATA, campo ausente, rem sem CNPJ) volta None e o
+# documento segue para o iterparse.
+RE_UFENV = re.compile(rb"<(?:[\w.-]+:)?UFEnv>([A-Z]{2})</")
+RE_NCT = re.compile(rb"<(?:[\w.-]+:)?nCT>(\d+)</")
+RE_REM = re.compile(rb"<(?:[\w.-]+:)?rem[\s>].*?</(?:[\w.-]+:)?rem>", re.S)
+RE_CNPJ = re.compile(rb"<(?:[\w.-]+:)?CNPJ>([^<]*)</")
+RE_ID_INF_CTE = re.compile(rb"<(?:[\w.-]+:)?infCte\s[^>]*?\bId=[\"']([^\"']*)")
+RE_MARCACAO_ESPECIAL = re.compile(rb"<!--|<!\[CDATA\[")
+
+
+def extrair_info_rapido(dados):
+    if not compativel_ascii(dados) or RE_MARCACAO_ESPECIAL.search(dados):
+        return None
+
+    uf = RE_UFENV.search(dados)
+    nct = RE_NCT.search(dados)
+    rem = RE_REM.search(dados)
+    cnpj = RE_CNPJ.search(rem.group()) if rem else None
+    if not (uf and nct and cnpj):
+        return None
+
+    chave = RE_ID_INF_CTE.search(dados)
+    return montar_info(
+        uf.group(1).decode("ascii"),
+        cnpj.group(1).decode("ascii", "replace"),
+        nct.group(1).decode("ascii"),
+        chave.group(1).decode("ascii", "replace")[3:] if chave else "",
+    )
+
+
+def extrair_info_bytes(dados):
+    return extrair_info_rapido(dados) or extrair_info_cte(io.BytesIO(dados))
+
+
+# A reescrita do PO trabalha direto nos bytes do arquivo: o PO e a tag
+# <xObs> são ASCII, então o mesmo padrão serve para UTF-8, ISO-8859-1 e
+# qualquer codificação compatível com ASCII, preservando a declaração
+# original. Só UTF-16 (identificado pelo BOM) precisa ser decodificado.
+BOMS_UTF16 = (b"\xff\xfe", b"\xfe\xff")
+
+
+def compativel_ascii(dados):
+    return bytes(dados[:2]) not in BOMS_UTF16
+
+
+def alterar_po_bytes(dados, novo_po):
+    if not compativel_ascii(dados):
+        texto = dados.decode("utf-16")
+        xml_editado, po_antigo = alterar_po_bytes(texto.encode("utf-8"), novo_po)
+        return xml_editado.decode("utf-8").encode("utf-16"), po_antigo
+
+    encontrado = PADRAO_PO.search(dados)
+
+    if encontrado:
+        po_antigo = encontrado.group().decode("ascii")
+        xml_editado = PADRAO_PO.sub(novo_po.encode("ascii"), dados)
+    else:
+        po_antigo = "NAO_ENCONTRADO"
+        xml_editado = dados.replace(
+            b"</CTe>", f"<xObs>{novo_po}</xObs></CTe>".encode("ascii")
+        )
+
+    return xml_editado, po_antigo
+
+
+def remendar_po(conteudo, novo_po, temporario):
+    # Caminho rápido: com o PO novo do mesmo tamanho do antigo (sempre o caso
+    # no formato 4504XXXXXX/XXXXX), o temporário da saída é gravado direto do
+    # conteúdo mapeado (mmap), trecho a trecho, sem montar uma cópia do
+    # documento. A entrada nunca é alterada: em erro ela volta intacta.
+    # Devolve (PO antigo, hash da saída, gravado); gravado=False quando todos
+    # os PO já estavam certos e nada foi escrito. None quando não dá para
+    # remendar (sem PO, tamanho diferente, UTF-16); aí vale o alterar_po_bytes.
+    if not compativel_ascii(conteudo):
+        return None
+
+    novo = novo_po.encode("ascii")
+    encontrados = list(PADRAO_PO.finditer(conteudo))
+    if not encontrados or any(m.end() - m.start() != len(novo) for m in encontrados):
+        return None
+
+    po_antigo = encontrados[0].group().decode("ascii")
+    if all(m.group() == novo for m in encontrados):
+        return po_antigo, hashlib.sha256(conteudo).hexdigest(), False
+
+    hash_saida = hashlib.sha256()
+    with memoryview(conteudo) as visao, open(temporario, "wb") as f:
+        inicio = 0
+        for m in encontrados + [None]:
+            fim = m.start() if m else len(visao)
+            with visao[inicio:fim] as trecho:
+                f.write(trecho)
+                hash_saida.update(trecho)
+            if m:
+                f.write(novo)
+                hash_saida.update(novo)
+                inicio = m.end()
+        f.flush()
+        os.fsync(f.fileno())
+
+    return po_antigo, hash_saida.hexdigest(), True
+
+
+def validar_tipo(tipo):
+    if tipo not in PO_RULES:
+        raise ValueError(f"TIPO inválido: {tipo} (use {', '.join(PO_RULES)})")
+
+
+def processar_cte_bytes(dados, tipo):
+    # Núcleo do processamento: o XML é lido uma única vez (bytes) e o
+    # resultado editado é devolvido em memória, sem tocar no disco.
+    validar_tipo(tipo)
+    verificar_tamanho_xml(len(dados))
+
+    with medir("extrair_info_xml", len(dados)):
+        info = extrair_info_bytes(dados)
+    novo_po = PO_RULES[tipo][info["TOMADOR"]][info["UF"]]
+
+    with medir("alterar_po_xml", len(dados)):
+        xml_editado, po_antigo = alterar_po_bytes(dados, novo_po)
+
+    info["PO_ANTES"] = po_antigo
+    info["PO_DEPOIS"] = novo_po
+    return xml_editado, info
+
+
+def ler_bytes(caminho):
+    with open(caminho, "rb") as f:
+        return f.read()
+
+
+def caminho_temporario(caminho):
+    return caminho + ".tmp"
+
+
+def confirmar_arquivo(temporario, caminho):
+    # Garante os dados no disco antes da renomeação: depois de uma queda de
+    # energia existe o arquivo antigo ou o novo completo, nunca um pedaço.
+    with open(temporario, "r+b") as f:
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+
+
+def gravar_temporario(temporario, dados):
+    with open(temporario, "wb") as f:
+        f.write(dados)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def gravar_bytes(caminho, dados, temporario=None):
+    temporario = temporario or caminho_temporario(caminho)
+    gravar_temporario(temporario, dados)
+    os.replace(temporario, caminho)
+
+
+# Pares (pasta de origem, pasta de destino) que já falharam a renomeação por
+# estarem em volumes diferentes: nos próximos arquivos vai direto à cópia.
+_volumes_distintos = set()
+
+
+def outro_volume(erro):
+    # EXDEV no POSIX; ERROR_NOT_SAME_DEVICE (17) no Windows
+    return erro.errno == errno.EXDEV or getattr(erro, "winerror", None) == 17
+
+
+def mover_atomico(origem, destino):
+    par = (os.path.dirname(origem), os.path.dirname(destino))
+    if par not in _volumes_distintos:
+        try:
+            os.replace(origem, destino)
+            return
+        except FileNotFoundError:
+            raise
+        except OSError as e:
+            if outro_volume(e):
+                _volumes_distintos.add(par)
+
+    # Outro volume: copia para temporário, confirma e só então remove
+    temporario = caminho_temporario(destino)
+    shutil.copy2(origem, temporario)
+    confirmar_arquivo(temporario, destino)
+    os.remove(origem)
+
+
+def mover_em_lote(pares):
+    # Move vários arquivos de uma vez; o que sumiu no meio do caminho (outra
+    # instância levou) é ignorado. Devolve os destinos efetivamente gravados.
+    movidos = []
+    for origem, destino in pares:
+        try:
+            mover_atomico(origem, destino)
+        except FileNotFoundError:
+            continue
+        movidos.append(destino)
+    return movidos
+
+
+# ============================================================
+# ÍNDICE DAS PASTAS DE ENTRADA
+# ============================================================
+# Cada pasta de entrada é lida uma única vez com os.scandir, que já traz o
+# tipo de cada entrada (no Windows, também tamanho e datas) sem um stat por
+# arquivo. Em um compartilhamento de rede isso troca dezenas de milhares de
+# idas e voltas (listdir + isfile + exists do PDF) por uma listagem.
+# O índice agrupa por nome-base:
+# - "XML" e "ZIP": caminhos a processar
+# - "PDF": nome-base (minúsculo) -> caminho do PDF
+# - "PDF_CHAVE": chave de acesso (44 dígitos no nome) -> caminho do PDF,
+#   para o PDF cujo nome não bate com o do XML
+RE_CHAVE_NOME = re.compile(r"(?<!\d)\d{44}(?!\d)")
+
+# Índice da última listagem, por TIPO
+_indices_entrada = {}
+
+# XML reivindicado -> PDF reivindicado junto (None: sem PDF de mesmo nome)
+_pdfs_pareados = {}
+
+
+def indexar_pasta(pasta):
+    indice = {"XML": [], "ZIP": [], "PDF": {}, "PDF_CHAVE": {}}
+
+    with os.scandir(pasta) as itens:
+        for item in itens:
+            if not item.is_file():
+                continue
+
+            base, extensao = os.path.splitext(item.name)
+            extensao = extensao.lower()
+
+            if extensao == ".xml":
+                indice["XML"].append(item.path)
 
-    encontrados = re.findall(r"4504\d{6,}/\d{5}", xml)
-    po_antigo = encontrados[0] if encontrados else "NAO_ENCONTRADO"
+            elif extensao == ".zip":
+                indice["ZIP"].append(item.path)
 
-    xml_editado = re.sub(r"4504\d{6,}/\d{5}", novo_po, xml)
+            elif extensao == ".pdf":
+                indice["PDF"][base.lower()] = item.path
+                chave = RE_CHAVE_NOME.search(base)
+                if chave:
+                    indice["PDF_CHAVE"].setdefault(chave.group(), item.path)
 
-    if xml_editado == xml:
-        xml_editado = xml.replace("</CTe>", f"<xObs>{novo_po}</xObs></CTe>")
+    return indice
 
-    with open(xml_path, "w", encoding="utf-8") as f:
-        f.write(xml_editado)
 
+def indexar_entradas(pastas):
+    _indices_entrada.clear()
+    for tipo, pasta in mapear_entradas(pastas).items():
+        _indices_entrada[tipo] = indexar_pasta(pasta)
+    return _indices_entrada
+
+
+def retirar_pdf(indice, pdf):
+    # Um PDF só acompanha um XML: sai das duas chaves do índice
+    base = os.path.splitext(os.path.basename(pdf))[0]
+    indice["PDF"].pop(base.lower(), None)
+    chave = RE_CHAVE_NOME.search(base)
+    if chave and indice["PDF_CHAVE"].get(chave.group()) == pdf:
+        del indice["PDF_CHAVE"][chave.group()]
+
+
+def pdf_do_xml(indice, xml_path, chave=None):
+    # Mesmo nome-base primeiro; senão, a chave de acesso (do nome do XML ou
+    # do conteúdo, quando já lido)
+    base = os.path.splitext(os.path.basename(xml_path))[0]
+    pdf = indice["PDF"].get(base.lower())
+
+    if pdf is None:
+        if chave is None:
+            encontrada = RE_CHAVE_NOME.search(base)
+            chave = encontrada.group() if encontrada else None
+        if chave:
+            pdf = indice["PDF_CHAVE"].get(chave)
+
+    if pdf:
+        retirar_pdf(indice, pdf)
+    return pdf
+
+
+@contextlib.contextmanager
+def abrir_xml(caminho):
+    # Conteúdo do XML como mmap somente leitura; se não for possível mapear
+    # (arquivo vazio, compartilhamento), lê em bytes.
+    with open(caminho, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            yield f.read()
+            return
+
+        with mm:
+            yield mm
+
+
+def extrair_info_xml(xml_path):
+    with medir("extrair_info_xml"):
+        info = extrair_info_bytes(ler_bytes(xml_path))
+    return info["UF"], info["TOMADOR"]
+
+
+def alterar_po_xml(xml_path, novo_po):
+    # O arquivo só é trocado (temporário + renomeação) depois de fechado o
+    # mmap: o Windows não substitui um arquivo mapeado
+    temporario = caminho_temporario(xml_path)
+    xml_editado = None
+    with abrir_xml(xml_path) as conteudo, medir("alterar_po_xml", len(conteudo)):
+        remendado = remendar_po(conteudo, novo_po, temporario)
+        if remendado is None:
+            xml_editado, po_antigo = alterar_po_bytes(bytes(conteudo), novo_po)
+        else:
+            po_antigo, _, gravado = remendado
+
+    if xml_editado is not None:
+        gravar_bytes(xml_path, xml_editado, temporario)
+    elif gravado:
+        os.replace(temporario, xml_path)
     return po_antigo, novo_po
 
 
 # ============================================================
-# PROCESSAMENTO XML SOLTO
+# ÍNDICE DE CT-e JÁ PROCESSADOS
 # ============================================================
-def processar_xml_individual(pastas, tipo, xml_path):
+# LOG/INDICE_CTE.db guarda o hash (SHA-256) de cada XML gravado na saída,
+# com a chave de acesso (Id do infCte), tipo, tomador, UF e PO aplicado.
+# Um XML solto cujo hash já está no índice para o mesmo tipo (e cujo PO
+# ainda confere com PO_RULES) é apenas movido, sem parse nem regravação.
+# Chaves de acesso repetidas são marcadas como DUPLICADO no log.
+_conexoes_indice = {}
+_registros_indice = []
+_chaves_lote = set()
+
+
+def caminho_indice(pastas):
+    return os.path.join(pastas["LOG"], "INDICE_CTE.db")
+
+
+def abrir_indice(indice):
+    # Uma conexão por processo: os workers do pool herdam este dicionário no
+    # fork e o SQLite não permite usar a conexão do processo pai.
+    chave_conexao = (os.getpid(), indice)
+    con = _conexoes_indice.get(chave_conexao)
+    if con is None:
+        import sqlite3
+
+        con = sqlite3.connect(indice, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS indice_cte ("
+            "hash TEXT PRIMARY KEY, chave TEXT, tipo TEXT, tomador TEXT, "
+            "uf TEXT, po TEXT, data TEXT)"
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS ix_indice_cte_chave ON indice_cte (chave)"
+        )
+        con.commit()
+        _conexoes_indice[chave_conexao] = con
+    return con
+
+
+def consultar_indice(indice, hash_xml):
+    return abrir_indice(indice).execute(
+        "SELECT chave, tipo, tomador, uf, po FROM indice_cte WHERE hash = ?",
+        (hash_xml,),
+    ).fetchone()
+
+
+def chave_indexada(indice, chave):
+    if not chave:
+        return False
+    return abrir_indice(indice).execute(
+        "SELECT 1 FROM indice_cte WHERE chave = ? LIMIT 1", (chave,)
+    ).fetchone() is not None
+
+
+def registro_indice(tipo, info):
+    return (
+        info["HASH"], info["CHAVE"], tipo, info["TOMADOR"], info["UF"],
+        info["PO_DEPOIS"], f"{datetime.now():%Y-%m-%d %H:%M:%S}",
+    )
+
+
+def descarregar_indice(pastas):
+    # Uma única transação por lote
+    _chaves_lote.clear()
+    if not _registros_indice:
+        return
+
+    con = abrir_indice(caminho_indice(pastas))
+    with medir("indice"), con:
+        con.executemany(
+            "INSERT OR REPLACE INTO indice_cte "
+            "(hash, chave, tipo, tomador, uf, po, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            _registros_indice,
+        )
+    _registros_indice.clear()
+
+
+# ============================================================
+# AUDITORIA (HISTÓRICO DE PO POR CT-e)
+# ============================================================
+# LOG/AUDITORIA_PO.db tem uma linha por XML processado (soltos e membros de
+# ZIP): data, tipo, arquivo/membro, chave, nCT, CNPJ do remetente, tomador,
+# UF e PO antes/depois. As linhas ficam em buffer e são gravadas em uma
+# única transação por lote, junto com o índice. Consulta: --consultar.
+_conexao_auditoria = {}
+_registros_auditoria = []
+_lock_auditoria = threading.Lock()
+
+CAMPOS_AUDITORIA = (
+    "data", "tipo", "arquivo", "membro", "chave", "nct", "cnpj",
+    "tomador", "uf", "po_antes", "po_depois", "duplicado", "worker",
+)
+
+
+def caminho_auditoria(pastas):
+    return os.path.join(pastas["LOG"], "AUDITORIA_PO.db")
+
+
+def abrir_auditoria(auditoria):
+    con = _conexao_auditoria.get(auditoria)
+    if con is None:
+        import sqlite3
+
+        con = sqlite3.connect(auditoria, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS auditoria_po ("
+            "id INTEGER PRIMARY KEY, data TEXT, tipo TEXT, arquivo TEXT, "
+            "membro TEXT, chave TEXT, nct TEXT, cnpj TEXT, tomador TEXT, "
+            "uf TEXT, po_antes TEXT, po_depois TEXT, duplicado INTEGER, "
+            "worker TEXT)"
+        )
+        for coluna in ("chave", "nct", "cnpj", "po_antes", "po_depois", "data"):
+            con.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_auditoria_po_{coluna} "
+                f"ON auditoria_po ({coluna})"
+            )
+        con.commit()
+        _conexao_auditoria[auditoria] = con
+    return con
+
+
+def registro_auditoria(tipo, arquivo, info, membro=None, duplicado=False):
+    return (
+        f"{datetime.now():%Y-%m-%d %H:%M:%S}", tipo, arquivo, membro,
+        info.get("CHAVE"), info.get("nCT"), info.get("CNPJ"),
+        info["TOMADOR"], info["UF"], info["PO_ANTES"], info["PO_DEPOIS"],
+        int(duplicado), ID_WORKER,
+    )
+
+
+def registrar_auditoria(tipo, arquivo, info, membro=None, duplicado=False):
+    registro = registro_auditoria(tipo, arquivo, info, membro, duplicado)
+    with _lock_auditoria:
+        _registros_auditoria.append(registro)
+
+
+def descarregar_auditoria(pastas):
+    with _lock_auditoria:
+        registros = _registros_auditoria[:]
+        _registros_auditoria.clear()
+    if not registros:
+        return
+
+    con = abrir_auditoria(caminho_auditoria(pastas))
+    with medir("auditoria"), con:
+        con.executemany(
+            f"INSERT INTO auditoria_po ({', '.join(CAMPOS_AUDITORIA)}) "
+            f"VALUES ({', '.join('?' * len(CAMPOS_AUDITORIA))})",
+            registros,
+        )
+
+
+def consultar_auditoria(pastas, chave=None, nct=None, cnpj=None, po=None,
+                        desde=None, ate=None):
+    condicoes, parametros = [], []
+    for coluna, valor in (("chave", chave), ("nct", nct), ("cnpj", cnpj)):
+        if valor:
+            condicoes.append(f"{coluna} = ?")
+            parametros.append(valor)
+    if po:
+        condicoes.append("(po_antes = ? OR po_depois = ?)")
+        parametros += [po, po]
+    if desde:
+        condicoes.append("data >= ?")
+        parametros.append(desde)
+    if ate:
+        # "2024-05-31" inclui o dia inteiro
+        condicoes.append("data <= ?")
+        parametros.append(ate if len(ate) > 10 else f"{ate} 23:59:59")
+
+    sql = f"SELECT {', '.join(CAMPOS_AUDITORIA)} FROM auditoria_po"
+    if condicoes:
+        sql += " WHERE " + " AND ".join(condicoes)
+    sql += " ORDER BY data, id"
+
+    con = abrir_auditoria(caminho_auditoria(pastas))
+    for linha in con.execute(sql, parametros):
+        yield dict(zip(CAMPOS_AUDITORIA, linha))
+
+
+def exportar_auditoria(registros, formato="texto", saida=sys.stdout):
+    if formato == "json":
+        json.dump(list(registros), saida, ensure_ascii=False, indent=2)
+        saida.write("\n")
+        return
+
+    if formato == "csv":
+        import csv
+
+        escritor = csv.DictWriter(
+            saida, fieldnames=CAMPOS_AUDITORIA, delimiter=";", lineterminator="\n"
+        )
+        escritor.writeheader()
+        escritor.writerows(registros)
+        return
+
+    # Mesmo formato do LOG_EDICAO_PO.txt, uma linha por CT-e
+    for r in registros:
+        arquivo = f"{r['arquivo']}/{r['membro']}" if r["membro"] else r["arquivo"]
+        saida.write(
+            f"{r['data']} | {r['tipo']} | {arquivo} | nCT={r['nct']} | "
+            f"PO_ANTES={r['po_antes']} | PO_DEPOIS={r['po_depois']}"
+            f"{' | DUPLICADO' if r['duplicado'] else ''}\n"
+        )
+
+
+# ============================================================
+# LIMITES (ZIP-BOMBA E MEMÓRIA)
+# ============================================================
+# Um ZIP malicioso ou corrompido de uma transportadora não pode encher o
+# disco nem a memória. Limites conferidos antes/enquanto os dados são lidos:
+# - LIMITE_ZIP_MB: soma descompactada dos membros de um ZIP
+# - LIMITE_MEMBROS: quantidade de membros de um ZIP
+# - LIMITE_RAZAO: razão descompactado/compactado de um membro (só a partir
+#   de RAZAO_MINIMA_BYTES, pois arquivos pequenos comprimem muito)
+# - LIMITE_XML_MB: um único XML (solto, membro de ZIP ou requisição)
+# Os tamanhos do diretório central são conferidos antes de ler qualquer
+# membro; como o zipfile nunca entrega mais que o tamanho declarado (o
+# excedente falha no CRC), isso também limita o que de fato é lido.
+# O arquivo recusado vai para QUARENTENA/<TIPO> (com o PDF, se houver) e o
+# motivo para LOG_ERRO.txt. A memória fica limitada pelos blocos de ZIP (no
+# máximo LIMITE_BLOCO_MB de XML descompactado por vez), pela cópia em blocos
+# dos membros não-XML e por arquivo temporário para streams sem seek.
+LIMITE_ZIP_MB = 4096
+LIMITE_MEMBROS = 200000
+LIMITE_RAZAO = 200
+RAZAO_MINIMA_BYTES = 1024 * 1024
+LIMITE_XML_MB = 50
+LIMITE_BLOCO_MB = 64
+BLOCO_COPIA = 1024 * 1024
+
+
+# Arquivo fora dos limites: vai para a quarentena em vez de voltar à entrada
+class ArquivoRecusado(ValueError):
+    pass
+
+
+def configurar_limites(zip_mb=None, membros=None, razao=None, xml_mb=None):
+    # Também é o initializer do pool: os workers não herdam a linha de comando
+    global LIMITE_ZIP_MB, LIMITE_MEMBROS, LIMITE_RAZAO, LIMITE_XML_MB
+
+    if zip_mb is not None:
+        LIMITE_ZIP_MB = zip_mb
+    if membros is not None:
+        LIMITE_MEMBROS = membros
+    if razao is not None:
+        LIMITE_RAZAO = razao
+    if xml_mb is not None:
+        LIMITE_XML_MB = xml_mb
+
+
+def verificar_tamanho_xml(tamanho, nome="XML"):
+    if tamanho > LIMITE_XML_MB * 1024 * 1024:
+        raise ArquivoRecusado(
+            f"{nome} com {tamanho} bytes excede o limite de {LIMITE_XML_MB} MB por XML"
+        )
+
+
+def ler_bytes_limitado(caminho):
+    # Lê no máximo o limite + 1 byte: um XML gigante nunca entra inteiro
+    limite = LIMITE_XML_MB * 1024 * 1024
+    with open(caminho, "rb") as f:
+        dados = f.read(limite + 1)
+    verificar_tamanho_xml(len(dados), os.path.basename(caminho))
+    return dados
+
+
+def verificar_limites_zip(membros, consumido=None):
+    # consumido: contagem compartilhada entre o ZIP e seus ZIPs internos, para
+    # que o aninhamento não multiplique os limites
+    consumido = Counter() if consumido is None else consumido
+    consumido["MEMBROS"] += len(membros)
+    if consumido["MEMBROS"] > LIMITE_MEMBROS:
+        raise ArquivoRecusado(
+            f"ZIP com {consumido['MEMBROS']} membros excede o limite de {LIMITE_MEMBROS}"
+        )
+
+    for info in membros:
+        consumido["BYTES"] += info.file_size
+        if consumido["BYTES"] > LIMITE_ZIP_MB * 1024 * 1024:
+            raise ArquivoRecusado(
+                f"ZIP descompactado excede o limite de {LIMITE_ZIP_MB} MB"
+            )
+
+        if membro_xml(info):
+            verificar_tamanho_xml(info.file_size, info.filename)
+
+        if info.file_size >= RAZAO_MINIMA_BYTES \
+                and info.file_size > LIMITE_RAZAO * max(info.compress_size, 1):
+            raise ArquivoRecusado(
+                f"{info.filename}: compressão de "
+                f"{info.file_size // max(info.compress_size, 1)}:1 excede o "
+                f"limite de {LIMITE_RAZAO}:1"
+            )
+
+
+def blocos_de_membros(membros):
+    # Até TAMANHO_BLOCO_ZIP membros e LIMITE_BLOCO_MB de XML por bloco
+    limite = LIMITE_BLOCO_MB * 1024 * 1024
+    bloco, tamanho_bloco = [], 0
+
+    for info in membros:
+        tamanho = info.file_size if membro_xml(info) else 0
+        if bloco and (len(bloco) >= TAMANHO_BLOCO_ZIP or tamanho_bloco + tamanho > limite):
+            yield bloco
+            bloco, tamanho_bloco = [], 0
+        bloco.append(info)
+        tamanho_bloco += tamanho
+
+    if bloco:
+        yield bloco
+
+
+def temporario_em_memoria():
+    # Em memória até LIMITE_BLOCO_MB; acima disso o próprio Python passa para
+    # um arquivo temporário anônimo (nada é extraído em pastas)
+    import tempfile
+
+    return tempfile.SpooledTemporaryFile(max_size=LIMITE_BLOCO_MB * 1024 * 1024)
+
+
+def quarentenar(pastas, tipo, caminho, motivo, acompanhantes=()):
+    pasta = os.path.join(pastas["QUARENTENA"], tipo)
+    os.makedirs(pasta, exist_ok=True)
     try:
-        uf, tomador = extrair_info_xml(xml_path)
-        novo_po = PO_RULES[tipo][tomador][uf]
+        mover_em_lote(
+            (c, os.path.join(pasta, os.path.basename(c)))
+            for c in (caminho, *acompanhantes) if c
+        )
+    except OSError as e:
+        motivo = f"{motivo} (não foi possível mover: {e})"
+    registrar_erro(pastas, tipo, os.path.basename(caminho), f"QUARENTENA: {motivo}")
 
-        po_antigo, po_novo = alterar_po_xml(xml_path, novo_po)
 
-        registrar_log_xml(
-            pastas, tipo, os.path.basename(xml_path), po_antigo, po_novo
+# ============================================================
+# LAYOUT DA SAÍDA
+# ============================================================
+# Com centenas de milhares de arquivos em SAIDA_FINAL/<TIPO>, o Explorer e a
+# carga no SAP ficam lentos. LAYOUT_SAIDA divide a saída em subpastas,
+# na ordem dada, com os componentes:
+# - mes     → AAAA-MM do processamento
+# - dia     → AAAA-MM-DD do processamento
+# - tomador → CACAU / CHOCOLATE
+# - uf      → UFEnv
+# - chave   → primeiros PREFIXO_CHAVE dígitos da chave de acesso (cUF + AAMM
+#             de emissão)
+# Ex.: "mes/tomador/uf" → SAIDA_FINAL/FRETE/2026-10/CACAU/SP/
+# "plano" (padrão) mantém tudo direto em SAIDA_FINAL/<TIPO>. ZIPs podem
+# misturar tomadores e UFs: só os componentes de data se aplicam a eles.
+# Os temporários (.tmp) ficam na área da instância (ver JOURNAL), nunca
+# na saída.
+LAYOUT_SAIDA = "plano"
+COMPONENTES_LAYOUT = ("mes", "dia", "tomador", "uf", "chave")
+PREFIXO_CHAVE = 6
+
+_pastas_criadas = set()
+
+
+def validar_layout(layout):
+    if layout == "plano":
+        return ()
+
+    componentes = tuple(c.strip().lower() for c in layout.split("/") if c.strip())
+    invalidos = [c for c in componentes if c not in COMPONENTES_LAYOUT]
+    if not componentes or invalidos:
+        raise ValueError(
+            f"Layout de saída inválido: {layout!r} "
+            f"(use 'plano' ou {'/'.join(COMPONENTES_LAYOUT)} separados por '/')"
         )
+    return componentes
+
+
+def configurar_saida(layout=None):
+    global LAYOUT_SAIDA
+
+    if layout is not None:
+        validar_layout(layout)
+        LAYOUT_SAIDA = layout
+
+
+def componente_saida(componente, info, quando):
+    if componente == "mes":
+        return quando.strftime("%Y-%m")
+    if componente == "dia":
+        return quando.strftime("%Y-%m-%d")
+    if componente == "tomador":
+        return info["TOMADOR"]
+    if componente == "uf":
+        return info["UF"]
+    return (info["CHAVE"] or "")[:PREFIXO_CHAVE] or "SEM_CHAVE"
+
 
-        destino = os.path.join(pastas[f"SAIDA_{tipo}"], os.path.basename(xml_path))
-        shutil.move(xml_path, destino)
+def pasta_saida_layout(pasta_saida, info=None, layout=None, quando=None):
+    # info None (ZIP): só os componentes de data
+    quando = quando or datetime.now()
+    partes = [
+        componente_saida(c, info, quando)
+        for c in validar_layout(layout or LAYOUT_SAIDA)
+        if info is not None or c in ("mes", "dia")
+    ]
+    if not partes:
+        return pasta_saida
 
-        # PDF associado
-        base = os.path.splitext(os.path.basename(xml_path))[0]
-        pdf = os.path.join(os.path.dirname(xml_path), f"{base}.pdf")
-        if os.path.exists(pdf):
-            shutil.move(pdf, os.path.join(pastas[f"SAIDA_{tipo}"], os.path.basename(pdf)))
+    pasta = os.path.join(pasta_saida, *partes)
+    if pasta not in _pastas_criadas:
+        os.makedirs(pasta, exist_ok=True)
+        _pastas_criadas.add(pasta)
+    return pasta
+
+
+# ============================================================
+# PROCESSAMENTO XML SOLTO
+# ============================================================
+def editar_xml_para_saida(tipo, xml_path, pasta_saida, indice=None, pdf=None, layout=None,
+                          pasta_temporaria=None):
+    nome = os.path.basename(xml_path)
+    temporario = caminho_temporario(os.path.join(pasta_temporaria or pasta_saida, nome))
+    xml_editado = None
+    remendado = False
+
+    with abrir_xml(xml_path) as conteudo:
+        verificar_tamanho_xml(len(conteudo), nome)
+        hash_entrada = hashlib.sha256(conteudo).hexdigest()
+
+        registro = consultar_indice(indice, hash_entrada) if indice else None
+        if registro:
+            chave, tipo_anterior, tomador, uf, po = registro
+            if tipo_anterior != tipo or PO_RULES[tipo][tomador][uf] != po:
+                registro = None
+
+        tamanho = len(conteudo)
+
+        if registro is None:
+            with medir("extrair_info_xml", tamanho):
+                info = extrair_info_rapido(conteudo) or extrair_info_cte(xml_path)
+            novo_po = PO_RULES[tipo][info["TOMADOR"]][info["UF"]]
+
+            with medir("alterar_po_xml", tamanho):
+                remendado = remendar_po(conteudo, novo_po, temporario)
+                if remendado is not None:
+                    po_antigo, hash_saida, remendado = remendado
+                else:
+                    dados = bytes(conteudo)
+                    xml_editado, po_antigo = alterar_po_bytes(dados, novo_po)
+                    if xml_editado == dados:
+                        xml_editado = None
+                        hash_saida = hash_entrada
+                    else:
+                        hash_saida = hashlib.sha256(xml_editado).hexdigest()
+
+    if registro:
+        info = {
+            "UF": uf, "TOMADOR": tomador, "CHAVE": chave, "HASH": hash_entrada,
+            "PO_ANTES": po, "PO_DEPOIS": po, "DUPLICADO": True,
+        }
+    else:
+        info["PO_ANTES"] = po_antigo
+        info["PO_DEPOIS"] = novo_po
+        info["HASH"] = hash_saida
+        info["DUPLICADO"] = bool(indice) and chave_indexada(indice, info["CHAVE"])
+
+    pasta_destino = pasta_saida_layout(pasta_saida, info, layout)
+    info["SAIDA"] = os.path.join(pasta_destino, nome)
+
+    # Já correto ou repetido: o arquivo é só movido. Senão, o temporário
+    # (remendado direto do mmap ou gravado agora, sempre com fsync) vai para
+    # o destino e a entrada, intacta até ali, é removida. As renomeações
+    # ficam para confirmar_xml_saida, no processo principal, depois do
+    # journal.
+    info["PENDENTE"] = {
+        "PDF": (pdf, os.path.join(pasta_destino, os.path.basename(pdf))) if pdf else None,
+        "XML": xml_path, "REMOVER": None,
+    }
+    if not registro and xml_editado is not None:
+        with medir("gravar_xml", tamanho):
+            gravar_temporario(temporario, xml_editado)
+    if not registro and (xml_editado is not None or remendado):
+        info["PENDENTE"].update(XML=temporario, REMOVER=xml_path)
+
+    return info
+
+
+def confirmar_xml_saida(info):
+    # PDF antes do XML: XML fora da pasta da instância = item concluído
+    pendente = info.pop("PENDENTE")
+    info["PDF"] = None
+    if pendente["PDF"]:
+        with medir("mover_pdf"):
+            movidos = mover_em_lote([pendente["PDF"]])
+        info["PDF"] = movidos[0] if movidos else None
+
+    with medir("mover_xml"):
+        mover_atomico(pendente["XML"], info["SAIDA"])
+        if pendente["REMOVER"]:
+            os.remove(pendente["REMOVER"])
+
+
+def concluir_xml_individual(pastas, tipo, xml_path, info):
+    nome = os.path.basename(xml_path)
+    duplicado = info["DUPLICADO"] or (info["CHAVE"] and info["CHAVE"] in _chaves_lote)
+    registros = {
+        "indice": [registro_indice(tipo, info)],
+        "auditoria": [registro_auditoria(tipo, nome, info, duplicado=duplicado)],
+        "log": formatar_log_xml(
+            tipo, nome, info["PO_ANTES"], info["PO_DEPOIS"],
+            observacao="DUPLICADO" if duplicado else None,
+        ) + "\n" if LOG_TEXTO else None,
+    }
+
+    # As linhas vão para o journal antes de a origem sair da pasta da
+    # instância: numa queda, o item concluído tem o histórico reposto
+    anotar_journal({"concluido": xml_path, **registros})
+    confirmar_xml_saida(info)
+    _chaves_lote.add(info["CHAVE"])
+    acumular_registros(pastas, registros)
+
+    # PDF de nome diferente, achado pela chave de acesso na pasta de entrada
+    pdf = info["PDF"]
+    if pdf is None and tipo in _indices_entrada and info["CHAVE"]:
+        pdf = pdf_do_xml(_indices_entrada[tipo], xml_path, info["CHAVE"])
+        if pdf:
+            with medir("mover_pdf"):
+                movidos = mover_em_lote([(
+                    pdf, os.path.join(os.path.dirname(info["SAIDA"]), os.path.basename(pdf))
+                )])
+            pdf = movidos[0] if movidos else None
+
+    if PACOTE_SAIDA:
+        with medir("pacote_saida"):
+            adicionar_ao_pacote(pastas, tipo, info, [info["SAIDA"]] + ([pdf] if pdf else []))
+
+
+def pdf_reivindicado(xml_path):
+    # PDF reivindicado junto com o XML (índice da entrada); chamada avulsa,
+    # sem índice, procura o PDF de mesmo nome no disco
+    if xml_path in _pdfs_pareados:
+        return _pdfs_pareados.pop(xml_path)
+
+    pdf = f"{os.path.splitext(xml_path)[0]}.pdf"
+    return pdf if os.path.exists(pdf) else None
+
+
+def processar_xml_individual(pastas, tipo, xml_path):
+    pdf = pdf_reivindicado(xml_path)
+    try:
+        pasta_saida, layout = destino_xml_solto(pastas, tipo)
+        info = editar_xml_para_saida(
+            tipo, xml_path, pasta_saida, caminho_indice(pastas), pdf, layout,
+            preparar_temporarios(pastas, tipo),
+        )
+        concluir_xml_individual(pastas, tipo, xml_path, info)
+
+    except ArquivoRecusado as e:
+        quarentenar(pastas, tipo, xml_path, str(e), [pdf])
 
     except Exception as e:
         registrar_erro(pastas, tipo, os.path.basename(xml_path), str(e))
 
 
 # ============================================================
-# PROCESSAMENTO ZIP
+# TAREFAS DO POOL DE PROCESSOS
 # ============================================================
-def processar_zip(pastas, tipo, zip_path):
-    zip_nome = os.path.basename(zip_path)
+# As tarefas rodam nos workers e nunca levantam exceção: o erro volta como
+# texto, para o processo principal registrar em LOG_ERRO.txt na ordem certa
+# (exceções do lxml nem sempre sobrevivem ao pickle entre processos).
+TAMANHO_BLOCO_ZIP = 256
 
-    total = 0
-    po_antes = Counter()
-    po_depois = Counter()
 
+def criar_pool(workers):
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(
+        max_workers=workers, initializer=configurar_limites,
+        initargs=(LIMITE_ZIP_MB, LIMITE_MEMBROS, LIMITE_RAZAO, LIMITE_XML_MB),
+    )
+
+
+def tarefa_xml_individual(tipo, xml_path, pasta_saida, indice=None, pdf=None, layout=None,
+                          pasta_temporaria=None):
+    # (info, erro, recusado pelos limites, métricas)
     try:
-        tmp_dir = tempfile.mkdtemp(prefix="ZIP_", dir=pastas["BASE"])
+        info = editar_xml_para_saida(
+            tipo, xml_path, pasta_saida, indice, pdf, layout, pasta_temporaria,
+        )
+        return info, None, False, coletar_metricas()
+    except Exception as e:
+        return None, str(e), isinstance(e, ArquivoRecusado), coletar_metricas()
 
-        with zipfile.ZipFile(zip_path, "r") as zf:
-            zf.extractall(tmp_dir)
 
-        for root, _, files in os.walk(tmp_dir):
-            for nome in files:
-                if nome.lower().endswith(".xml"):
-                    xml_path = os.path.join(root, nome)
+def tarefa_cte_bytes(dados, tipo):
+    try:
+        xml_editado, info = processar_cte_bytes(dados, tipo)
+        return xml_editado, info, None, coletar_metricas()
+    except Exception as e:
+        return None, None, str(e), coletar_metricas()
 
-                    uf, tomador = extrair_info_xml(xml_path)
-                    novo_po = PO_RULES[tipo][tomador][uf]
 
-                    po_antigo, po_novo = alterar_po_xml(xml_path, novo_po)
+def editar_em_lote(lista_dados, tipo, executor=None):
+    if executor is None:
+        return [processar_cte_bytes(dados, tipo) for dados in lista_dados]
 
-                    po_antes[po_antigo] += 1
-                    po_depois[po_novo] += 1
-                    total += 1
+    resultados = []
+    for xml_editado, info, erro, metricas in executor.map(
+        tarefa_cte_bytes, lista_dados, repeat(tipo), chunksize=16
+    ):
+        mesclar_metricas(metricas)
+        if erro:
+            raise ValueError(erro)
+        resultados.append((xml_editado, info))
+    return resultados
 
-        destino_zip = os.path.join(pastas[f"SAIDA_{tipo}"], zip_nome)
-        with zipfile.ZipFile(destino_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(tmp_dir):
-                for file in files:
-                    full = os.path.join(root, file)
-                    rel = os.path.relpath(full, tmp_dir)
-                    zf.write(full, rel)
 
-        registrar_log_zip_resumido(
-            pastas, tipo, zip_nome, total, po_antes, po_depois
+# ============================================================
+# ZIP (REESCRITA EM STREAMING)
+# ============================================================
+# Política de compressão do ZIP de saída:
+# - membros que não são XML (PDFs, imagens, ZIPs internos...) e XMLs que não
+#   mudaram são copiados em bruto, com a compressão original e sem CPU;
+# - XMLs editados são comprimidos (deflate no nível ZIP_NIVEL_XML, 0 = sem
+#   compressão) em ZIP_THREADS threads, pois o zlib libera o GIL, e gravados
+#   na ordem original. Se o deflate não reduzir o tamanho, vão sem
+#   compressão (STORED).
+# Bytes originais, bytes gravados e tempo de CPU de cada política vão para
+# as métricas da execução (seção "compressao").
+ZIP_NIVEL_XML = 6
+ZIP_THREADS = os.cpu_count() or 1
+
+# ZIPs dentro do ZIP (um por dia/filial) são abertos e refeitos até esta
+# profundidade; abaixo dela (ou 0) são copiados em bruto, como os PDFs.
+PROFUNDIDADE_ZIP = 3
+
+_compressao = {}
+_pool_compressao = None
+_lock_pool_compressao = threading.Lock()
+
+
+def configurar_zip(nivel_xml=None, threads=None, profundidade=None):
+    global ZIP_NIVEL_XML, ZIP_THREADS, PROFUNDIDADE_ZIP
+
+    if nivel_xml is not None:
+        ZIP_NIVEL_XML = nivel_xml
+    if threads is not None:
+        ZIP_THREADS = max(1, threads)
+    if profundidade is not None:
+        PROFUNDIDADE_ZIP = max(0, profundidade)
+
+
+def registrar_compressao(politica, original, gravado, cpu=0.0):
+    with _lock_metricas:
+        dados = _compressao.setdefault(politica, Counter())
+        dados["membros"] += 1
+        dados["bytes_originais"] += original
+        dados["bytes_gravados"] += gravado
+        dados["cpu_segundos"] += cpu
+
+
+def resumir_compressao():
+    resumo = {}
+    with _lock_metricas:
+        for politica, dados in sorted(_compressao.items()):
+            original = dados["bytes_originais"]
+            resumo[politica] = {
+                "membros": dados["membros"],
+                "bytes_originais": original,
+                "bytes_gravados": dados["bytes_gravados"],
+                "razao": round(dados["bytes_gravados"] / original, 4) if original else 1.0,
+                "cpu_segundos": round(dados["cpu_segundos"], 6),
+            }
+    return resumo
+
+
+def comprimir_membro(dados):
+    inicio = time.thread_time()
+    crc = zlib.crc32(dados)
+    tipo, gravado = zipfile.ZIP_STORED, dados
+
+    if ZIP_NIVEL_XML > 0:
+        compressor = zlib.compressobj(ZIP_NIVEL_XML, zlib.DEFLATED, -15)
+        comprimido = compressor.compress(dados) + compressor.flush()
+        if len(comprimido) < len(dados):
+            tipo, gravado = zipfile.ZIP_DEFLATED, comprimido
+
+    return tipo, gravado, crc, time.thread_time() - inicio
+
+
+def comprimir_em_lote(lista_dados):
+    global _pool_compressao
+
+    if ZIP_THREADS <= 1 or len(lista_dados) <= 1:
+        return [comprimir_membro(dados) for dados in lista_dados]
+
+    # --serve chama daqui de várias threads: um único pool por processo
+    with _lock_pool_compressao:
+        if _pool_compressao is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            _pool_compressao = ThreadPoolExecutor(max_workers=ZIP_THREADS)
+    return list(_pool_compressao.map(comprimir_membro, lista_dados))
+
+
+def gravar_membro_bruto(zout, novo, dados):
+    # Grava cabeçalho local + dados já comprimidos; CRC e tamanhos já são
+    # conhecidos, então dispensa o "data descriptor"
+    novo.flag_bits &= ~0x08
+    novo.header_offset = zout.fp.tell()
+
+    zout.fp.write(novo.FileHeader())
+    if isinstance(dados, (bytes, bytearray, memoryview)):
+        zout.fp.write(dados)
+    else:
+        for parte in dados:
+            zout.fp.write(parte)
+    zout.start_dir = zout.fp.tell()
+    zout.filelist.append(novo)
+    zout.NameToInfo[novo.filename] = novo
+    zout._didModify = True
+
+
+def gravar_membro_comprimido(zout, info, dados, comprimido):
+    tipo, gravado, crc, cpu = comprimido
+
+    novo = copiar_zipinfo(info)
+    novo.compress_type = tipo
+    novo.CRC = crc
+    novo.file_size = len(dados)
+    novo.compress_size = len(gravado)
+    gravar_membro_bruto(zout, novo, gravado)
+
+    politica = "deflate" if tipo == zipfile.ZIP_DEFLATED else "stored"
+    registrar_compressao(politica, len(dados), len(gravado), cpu)
+
+
+def copiar_membro_bruto(zin, zout, info):
+    # Copia o membro com os dados já comprimidos, sem descompactar nem
+    # recompactar (PDFs e demais arquivos saem idênticos ao original).
+    zin.fp.seek(info.header_offset)
+    cabecalho = struct.unpack(
+        zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader)
+    )
+    tam_nome = cabecalho[zipfile._FH_FILENAME_LENGTH]
+    tam_extra = cabecalho[zipfile._FH_EXTRA_FIELD_LENGTH]
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + tam_nome + tam_extra)
+
+    novo = copy.copy(info)
+    novo.extra = zipfile._strip_extra(info.extra, (1,))
+    # Em blocos: um PDF de vários GB não passa inteiro pela memória
+    gravar_membro_bruto(zout, novo, ler_em_blocos(zin.fp, info.compress_size))
+    registrar_compressao("bruto", info.file_size, info.compress_size)
+
+
+def ler_em_blocos(fp, tamanho):
+    while tamanho > 0:
+        parte = fp.read(min(BLOCO_COPIA, tamanho))
+        if not parte:
+            raise zipfile.BadZipFile("Membro truncado")
+        tamanho -= len(parte)
+        yield parte
+
+
+def copiar_zipinfo(info):
+    novo = zipfile.ZipInfo(info.filename, info.date_time)
+    novo.comment = info.comment
+    novo.create_system = info.create_system
+    novo.external_attr = info.external_attr
+    novo.compress_type = zipfile.ZIP_DEFLATED
+    return novo
+
+
+def membro_xml(info):
+    return not info.is_dir() and info.filename.lower().endswith(".xml")
+
+
+def membro_zip(info):
+    return not info.is_dir() and info.filename.lower().endswith(".zip")
+
+
+def contagem_nivel(contexto, nivel):
+    return contexto["NIVEIS"].setdefault(
+        nivel, {"TOTAL_XML": 0, "PO_ANTES": Counter(), "PO_DEPOIS": Counter()}
+    )
+
+
+def mesclar_niveis(contexto, niveis):
+    for nivel, origem in niveis.items():
+        contagem = contagem_nivel(contexto, nivel)
+        contagem["TOTAL_XML"] += origem["TOTAL_XML"]
+        contagem["PO_ANTES"].update(origem["PO_ANTES"])
+        contagem["PO_DEPOIS"].update(origem["PO_DEPOIS"])
+
+
+def reescrever_zip_interno(zin, zout, info, tipo, executor, membros_editados, nivel, contexto):
+    # O ZIP interno é lido para um temporário em memória, refeito (com os
+    # seus próprios ZIPs internos) e regravado no lugar do original, sem
+    # recompressão (ZIP já é comprimido). Sem XML dentro, ou se não for um
+    # ZIP válido, segue em bruto. Devolve (total, PO antes, PO depois).
+    # As contagens por nível do ZIP interno só entram no contexto se ele for
+    # de fato regravado; o consumo (limites) é sempre do ZIP inteiro.
+    interno_contexto = {"NIVEIS": {}, "CONSUMIDO": contexto["CONSUMIDO"]}
+    with temporario_em_memoria() as origem, temporario_em_memoria() as destino:
+        with zin.open(info) as interno:
+            shutil.copyfileobj(interno, origem, BLOCO_COPIA)
+        origem.seek(0)
+
+        membros = []
+        try:
+            total, po_antes, po_depois = reescrever_zip(
+                origem, destino, tipo, executor, membros, nivel + 1, interno_contexto
+            )
+        except zipfile.BadZipFile:
+            total = 0
+
+        if not total:
+            copiar_membro_bruto(zin, zout, info)
+            return 0, Counter(), Counter()
+
+        novo = copiar_zipinfo(info)
+        novo.compress_type = zipfile.ZIP_STORED
+        novo.file_size = destino.tell()
+        destino.seek(0)
+        with zout.open(novo, "w") as f:
+            shutil.copyfileobj(destino, f, BLOCO_COPIA)
+        registrar_compressao("stored", novo.file_size, novo.file_size)
+
+    mesclar_niveis(contexto, interno_contexto["NIVEIS"])
+    if membros_editados is not None:
+        membros_editados.extend(
+            (f"{info.filename}/{membro}", resultado) for membro, resultado in membros
         )
+    return total, po_antes, po_depois
+
+
+def reescrever_zip(origem, destino, tipo, executor=None, membros_editados=None,
+                   nivel=0, contexto=None):
+    # Lê cada membro do ZIP de origem e grava no destino na mesma ordem:
+    # XMLs são editados em memória, ZIPs internos são refeitos
+    # recursivamente (até PROFUNDIDADE_ZIP) e o restante é copiado em bruto.
+    # Os XMLs são editados em blocos, distribuídos no pool quando houver
+    # executor. Com membros_editados (lista), recebe (nome do membro, info)
+    # de cada XML, inclusive dos ZIPs internos ("interno.zip/membro.xml").
+    # contexto["NIVEIS"] acumula as contagens por nível (só os níveis com
+    # algum XML); os totais devolvidos somam todos os níveis.
+    contexto = {"NIVEIS": {}, "CONSUMIDO": Counter()} if contexto is None else contexto
+    total = 0
+    po_antes = Counter()
+    po_depois = Counter()
+    contagem = None
+
+    with zipfile.ZipFile(origem, "r") as zin, \
+            zipfile.ZipFile(destino, "w", zipfile.ZIP_DEFLATED) as zout:
+        membros = zin.infolist()
+        verificar_limites_zip(membros, contexto["CONSUMIDO"])
+
+        for bloco in blocos_de_membros(membros):
+            xmls = [info for info in bloco if membro_xml(info)]
+            originais = [zin.read(info) for info in xmls]
+            editados = editar_em_lote(originais, tipo, executor)
+            resultados = {
+                id(info): (dados, xml_editado, resultado)
+                for info, dados, (xml_editado, resultado)
+                in zip(xmls, originais, editados)
+            }
+
+            # Só os XMLs que mudaram são recomprimidos (em threads)
+            alterados = [
+                info for info in xmls
+                if resultados[id(info)][1] != resultados[id(info)][0]
+            ]
+            comprimidos = dict(zip(
+                map(id, alterados),
+                comprimir_em_lote([resultados[id(info)][1] for info in alterados]),
+            ))
+
+            for info in bloco:
+                if id(info) not in resultados:
+                    if membro_zip(info) and nivel < PROFUNDIDADE_ZIP:
+                        interno_total, interno_antes, interno_depois = reescrever_zip_interno(
+                            zin, zout, info, tipo, executor, membros_editados, nivel, contexto
+                        )
+                        total += interno_total
+                        po_antes.update(interno_antes)
+                        po_depois.update(interno_depois)
+                    else:
+                        copiar_membro_bruto(zin, zout, info)
+                    continue
+
+                dados, xml_editado, resultado = resultados[id(info)]
+
+                po_antes[resultado["PO_ANTES"]] += 1
+                po_depois[resultado["PO_DEPOIS"]] += 1
+                total += 1
+                if contagem is None:
+                    contagem = contagem_nivel(contexto, nivel)
+                contagem["PO_ANTES"][resultado["PO_ANTES"]] += 1
+                contagem["PO_DEPOIS"][resultado["PO_DEPOIS"]] += 1
+                contagem["TOTAL_XML"] += 1
+                if membros_editados is not None:
+                    membros_editados.append((info.filename, resultado))
+
+                if xml_editado == dados:
+                    copiar_membro_bruto(zin, zout, info)
+                else:
+                    gravar_membro_comprimido(
+                        zout, info, xml_editado, comprimidos[id(info)]
+                    )
+
+    return total, po_antes, po_depois
+
+
+# ============================================================
+# API PARA USO COMO BIBLIOTECA
+# ============================================================
+# O motor não depende das pastas do Desktop: outro programa pode importar
+# este arquivo e processar CT-e em memória, sem arquivos temporários.
+#
+#   import EDITOR_AUTOM_PO as editor
+#   xml_editado, info = editor.processar_cte_bytes(dados, "FRETE")
+#   resumo = editor.processar_zip_stream(entrada, saida, "CUSTO")
+#
+# - processar_cte_bytes(xml, tipo) -> (XML editado, info com UF, TOMADOR,
+#   CNPJ, nCT, CHAVE, PO_ANTES e PO_DEPOIS)
+# - processar_zip_stream(src, dst, tipo) aceita caminhos ou objetos de
+#   arquivo (BytesIO, arquivo aberto, socket/resposta HTTP): src sem seek é
+#   lido para a memória; dst pode ser um stream só de escrita. Devolve
+#   TOTAL_XML, a contagem de PO antes/depois, (membro, info) de cada XML e
+#   NIVEIS (as mesmas contagens por nível de ZIP interno; 0 = o próprio).
+# Com executor (ProcessPoolExecutor do chamador), os XMLs do ZIP são
+# editados em paralelo. Erros sobem como exceção; nada é gravado em LOG/.
+# As medições de tempo se acumulam no processo: coletar_metricas() as
+# devolve e zera.
+def processar_zip_stream(src, dst, tipo, executor=None):
+    validar_tipo(tipo)
+
+    if not isinstance(src, (str, os.PathLike)) and not (
+        hasattr(src, "seekable") and src.seekable()
+    ):
+        # Sem seek: copia para um temporário que só fica em memória enquanto
+        # for pequeno (acima de LIMITE_BLOCO_MB vai para o disco)
+        copia = temporario_em_memoria()
+        shutil.copyfileobj(src, copia, BLOCO_COPIA)
+        copia.seek(0)
+        src = copia
+
+    membros = []
+    contexto = {"NIVEIS": {}, "CONSUMIDO": Counter()}
+    total, po_antes, po_depois = reescrever_zip(
+        src, dst, tipo, executor, membros, contexto=contexto
+    )
+
+    return {
+        "TOTAL_XML": total,
+        "PO_ANTES": po_antes,
+        "PO_DEPOIS": po_depois,
+        "MEMBROS": membros,
+        "NIVEIS": contexto["NIVEIS"],
+    }
+
 
+# ============================================================
+# PROCESSAMENTO ZIP
+# ============================================================
+# Pastas do Desktop sobre o processar_zip_stream: grava em temporário,
+# confirma, registra auditoria/log e remove o ZIP de entrada.
+def processar_zip(pastas, tipo, zip_path, executor=None):
+    zip_nome = os.path.basename(zip_path)
+    temporario = caminho_temporario(os.path.join(pasta_temporarios(pastas, tipo), zip_nome))
+
+    try:
+        # Pastas criadas aqui dentro: uma falha fica no LOG_ERRO deste ZIP
+        preparar_temporarios(pastas, tipo)
+        destino_zip = os.path.join(pasta_saida_layout(pastas[f"SAIDA_{tipo}"]), zip_nome)
+
+        with medir("processar_zip", os.path.getsize(zip_path)):
+            resumo = processar_zip_stream(zip_path, temporario, tipo, executor)
+            registros = {
+                "indice": [],
+                "auditoria": [
+                    registro_auditoria(tipo, zip_nome, info, membro=membro)
+                    for membro, info in resumo["MEMBROS"]
+                ],
+                "log": formatar_log_zip_resumido(
+                    tipo, zip_nome, resumo["TOTAL_XML"],
+                    resumo["PO_ANTES"], resumo["PO_DEPOIS"], resumo["NIVEIS"],
+                ) + "\n" if LOG_TEXTO else None,
+            }
+            anotar_journal({"concluido": zip_path, **registros})
+            confirmar_arquivo(temporario, destino_zip)
+
+        acumular_registros(pastas, registros)
         os.remove(zip_path)
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    except ArquivoRecusado as e:
+        descartar(temporario)
+        quarentenar(pastas, tipo, zip_path, str(e))
 
     except Exception as e:
+        # ZIP de origem permanece na entrada; descarta o destino incompleto
+        if os.path.exists(temporario):
+            os.remove(temporario)
         registrar_erro(pastas, tipo, zip_nome, str(e))
 
 
+# ============================================================
+# PACOTES DE SAÍDA (--pacote-saida)
+# ============================================================
+# Em vez de um arquivo pequeno por CT-e na saída, os XMLs soltos (e seus
+# PDFs) são acumulados em um ZIP por tipo, fechado ao atingir
+# PACOTE_MAX_ARQUIVOS XMLs, PACOTE_MAX_MB megabytes ou PACOTE_MAX_MINUTOS
+# desde a abertura (e sempre no fim da execução):
+# - o XML editado é gravado primeiro em EM_PROCESSAMENTO/<ID>/PACOTE/<TIPO>,
+#   área da instância coberta pelo journal e pelo lease;
+# - cada XML/PDF é acrescentado ao ZIP aberto com a mesma gravação de
+#   membros do processar_zip (XML em deflate, PDF sem recompressão);
+# - ao fechar, o ZIP é confirmado (fsync) em SAIDA_FINAL/<TIPO> como
+#   PACOTE_<TIPO>_<data>_<ID>_<seq>.zip, sai uma linha resumida no
+#   LOG_EDICAO_PO.txt e o manifesto (arquivos, chaves e PO) vai para
+#   LOG/MANIFESTO_PACOTES.jsonl; só então os arquivos da área são apagados.
+# Se a instância cair, quem recupera o lease move os arquivos da área para a
+# saída como arquivos soltos: nada se perde (no pior caso, sai repetido).
+PACOTE_SAIDA = False
+PACOTE_MAX_ARQUIVOS = 1000
+PACOTE_MAX_MB = 100
+PACOTE_MAX_MINUTOS = 30
+
+# TIPO -> pacote aberto por esta instância
+_pacotes = {}
+_sequencia_pacote = Counter()
+
+
+def configurar_pacote(ativo=None, arquivos=None, mb=None, minutos=None):
+    global PACOTE_SAIDA, PACOTE_MAX_ARQUIVOS, PACOTE_MAX_MB, PACOTE_MAX_MINUTOS
+
+    if ativo is not None:
+        PACOTE_SAIDA = ativo
+    if arquivos is not None:
+        PACOTE_MAX_ARQUIVOS = max(1, arquivos)
+    if mb is not None:
+        PACOTE_MAX_MB = max(1, mb)
+    if minutos is not None:
+        PACOTE_MAX_MINUTOS = max(0, minutos)
+
+
+def pasta_pacote(pastas, tipo=None):
+    pasta = os.path.join(pasta_lease(pastas), "PACOTE")
+    return os.path.join(pasta, tipo) if tipo else pasta
+
+
+def destino_xml_solto(pastas, tipo):
+    # (pasta, layout) onde o worker grava o XML solto editado
+    if PACOTE_SAIDA:
+        pasta = pasta_pacote(pastas, tipo)
+        os.makedirs(pasta, exist_ok=True)
+        return pasta, "plano"
+    return pastas[f"SAIDA_{tipo}"], LAYOUT_SAIDA
+
+
+def abrir_pacote(pastas, tipo):
+    # Sequência no nome: vários pacotes podem fechar no mesmo segundo
+    _sequencia_pacote[tipo] += 1
+    nome = (
+        f"PACOTE_{tipo}_{datetime.now():%Y%m%d_%H%M%S}_{ID_WORKER}"
+        f"_{_sequencia_pacote[tipo]:04d}.zip"
+    )
+    temporario = caminho_temporario(os.path.join(pasta_pacote(pastas), nome))
+    os.makedirs(os.path.dirname(temporario), exist_ok=True)
+
+    pacote = {
+        "NOME": nome,
+        "TEMPORARIO": temporario,
+        "ZIP": zipfile.ZipFile(temporario, "w", zipfile.ZIP_DEFLATED),
+        "ABERTO_EM": datetime.now(),
+        "INICIO": time.monotonic(),
+        "ARQUIVOS": [],
+        "XMLS": [],
+        "PO_ANTES": Counter(),
+        "PO_DEPOIS": Counter(),
+    }
+    _pacotes[tipo] = pacote
+    return pacote
+
+
+def pacote_cheio(pacote):
+    return (
+        len(pacote["XMLS"]) >= PACOTE_MAX_ARQUIVOS
+        or pacote["ZIP"].fp.tell() >= PACOTE_MAX_MB * 1024 * 1024
+        or time.monotonic() - pacote["INICIO"] >= PACOTE_MAX_MINUTOS * 60
+    )
+
+
+def adicionar_ao_pacote(pastas, tipo, info, arquivos):
+    pacote = _pacotes.get(tipo)
+    nomes = [os.path.basename(caminho) for caminho in arquivos]
+    # Mesmo nome já no pacote (XML reenviado): fecha e começa outro
+    if pacote and any(nome in pacote["ZIP"].NameToInfo for nome in nomes):
+        fechar_pacote(pastas, tipo)
+        pacote = None
+    if pacote is None:
+        pacote = abrir_pacote(pastas, tipo)
+
+    for caminho, nome in zip(arquivos, nomes):
+        if nome.lower().endswith(".xml"):
+            dados = ler_bytes(caminho)
+            gravar_membro_comprimido(
+                pacote["ZIP"], zipfile.ZipInfo(nome, time.localtime()[:6]),
+                dados, comprimir_membro(dados),
+            )
+        else:
+            # PDF: sem recompressão e em blocos (não passa inteiro pela memória)
+            pacote["ZIP"].write(caminho, nome, compress_type=zipfile.ZIP_STORED)
+            tamanho = pacote["ZIP"].NameToInfo[nome].file_size
+            registrar_compressao("stored", tamanho, tamanho)
+        pacote["ARQUIVOS"].append(caminho)
+
+    pacote["XMLS"].append({
+        "ARQUIVO": nomes[0], "CHAVE": info["CHAVE"],
+        "PO_ANTES": info["PO_ANTES"], "PO_DEPOIS": info["PO_DEPOIS"],
+    })
+    pacote["PO_ANTES"][info["PO_ANTES"]] += 1
+    pacote["PO_DEPOIS"][info["PO_DEPOIS"]] += 1
+
+    if pacote_cheio(pacote):
+        fechar_pacote(pastas, tipo)
+
+
+def fechar_pacote(pastas, tipo):
+    pacote = _pacotes.pop(tipo, None)
+    if pacote is None:
+        return
+
+    pacote["ZIP"].close()
+    destino = os.path.join(pasta_saida_layout(pastas[f"SAIDA_{tipo}"]), pacote["NOME"])
+    with medir("fechar_pacote", os.path.getsize(pacote["TEMPORARIO"])):
+        confirmar_arquivo(pacote["TEMPORARIO"], destino)
+
+    registrar_log_zip_resumido(
+        pastas, tipo, pacote["NOME"], len(pacote["XMLS"]),
+        pacote["PO_ANTES"], pacote["PO_DEPOIS"],
+    )
+    manifesto = {
+        "PACOTE": os.path.relpath(destino, pastas["BASE"]),
+        "TIPO": tipo,
+        "ABERTO_EM": f"{pacote['ABERTO_EM']:%Y-%m-%d %H:%M:%S}",
+        "FECHADO_EM": f"{datetime.now():%Y-%m-%d %H:%M:%S}",
+        "BYTES": os.path.getsize(destino),
+        "XMLS": pacote["XMLS"],
+    }
+    with open(os.path.join(pastas["LOG"], "MANIFESTO_PACOTES.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(manifesto, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Só depois do pacote confirmado os arquivos soltos deixam de existir
+    for caminho in pacote["ARQUIVOS"]:
+        descartar(caminho)
+
+
+def fechar_pacotes(pastas, vencidos=False):
+    # vencidos=True: só os que passaram do tempo (chamado no --watch ocioso)
+    for tipo in list(_pacotes):
+        if not vencidos or pacote_cheio(_pacotes[tipo]):
+            try:
+                fechar_pacote(pastas, tipo)
+            except Exception as e:
+                registrar_erro(pastas, tipo, f"PACOTE_{tipo}", str(e))
+
+
+def liberar_pacotes(pastas, pasta_worker):
+    # Instância caída: o que estava na área do pacote vai solto para a saída
+    pasta = os.path.join(pasta_worker, "PACOTE")
+    for tipo in TIPOS:
+        try:
+            with os.scandir(os.path.join(pasta, tipo)) as itens:
+                restantes = [item.path for item in itens]
+        except FileNotFoundError:
+            continue
+
+        saida = pasta_saida_layout(pastas[f"SAIDA_{tipo}"])
+        mover_em_lote(
+            (caminho, os.path.join(saida, os.path.basename(caminho)))
+            for caminho in restantes if not caminho.endswith(".tmp")
+        )
+        for caminho in restantes:
+            if caminho.endswith(".tmp"):
+                descartar(caminho)
+
+    if os.path.isdir(pasta):
+        shutil.rmtree(pasta, ignore_errors=True)
+
+
 # ============================================================
 # EXECUÇÃO
 # ============================================================
-def executar(pastas):
-    entradas = {
-        "FRETE": pastas["ENTRADA_FRETE"],
-        "TRANSFERENCIA": pastas["ENTRADA_TRANSFERENCIA"],
-        "CUSTO": pastas["ENTRADA_CUSTO"],
+TIPOS = ("FRETE", "TRANSFERENCIA", "CUSTO")
+
+
+def mapear_entradas(pastas):
+    return {tipo: pastas[f"ENTRADA_{tipo}"] for tipo in TIPOS}
+
+
+def classificar_arquivos(arquivos):
+    # Ordem fixa (tipo e nome) para que o log saia sempre igual,
+    # independentemente da ordem em que os workers terminam.
+    ordem_tipo = {tipo: i for i, tipo in enumerate(TIPOS)}
+    xmls, zips = [], []
+
+    for tipo, caminho in sorted(
+        arquivos, key=lambda a: (ordem_tipo[a[0]], os.path.basename(a[1]))
+    ):
+        nome = os.path.basename(caminho).lower()
+
+        if nome.endswith(".xml"):
+            xmls.append((tipo, caminho))
+
+        elif nome.endswith(".zip"):
+            zips.append((tipo, caminho))
+
+    return xmls, zips
+
+
+def listar_entradas(pastas):
+    arquivos = []
+    for tipo, indice in indexar_entradas(pastas).items():
+        arquivos.extend((tipo, caminho) for caminho in indice["XML"])
+        arquivos.extend((tipo, caminho) for caminho in indice["ZIP"])
+
+    return classificar_arquivos(arquivos)
+
+
+def processar_lote(pastas, xmls, zips, executor=None):
+    # Cria o índice antes de os workers o consultarem
+    abrir_indice(caminho_indice(pastas))
+
+    try:
+        if executor is None:
+            for tipo, caminho in xmls:
+                processar_xml_individual(pastas, tipo, caminho)
+            for tipo, caminho in zips:
+                processar_zip(pastas, tipo, caminho)
+            return
+
+        futuros = []
+        for tipo, caminho in xmls:
+            pdf = pdf_reivindicado(caminho)
+            try:
+                pasta_saida, layout = destino_xml_solto(pastas, tipo)
+                futuros.append((tipo, caminho, pdf, executor.submit(
+                    tarefa_xml_individual, tipo, caminho, pasta_saida,
+                    caminho_indice(pastas), pdf, layout, preparar_temporarios(pastas, tipo),
+                )))
+            except Exception as e:
+                # Pasta de saída/temporários indisponível: o XML volta à
+                # entrada com o erro, o resto do lote segue
+                registrar_erro(pastas, tipo, os.path.basename(caminho), str(e))
+
+        for tipo, caminho, pdf, futuro in futuros:
+            try:
+                info, erro, recusado, metricas = futuro.result()
+                mesclar_metricas(metricas)
+                if recusado:
+                    raise ArquivoRecusado(erro)
+                if erro:
+                    raise ValueError(erro)
+                concluir_xml_individual(pastas, tipo, caminho, info)
+            except ArquivoRecusado as e:
+                quarentenar(pastas, tipo, caminho, str(e), [pdf])
+            except Exception as e:
+                registrar_erro(pastas, tipo, os.path.basename(caminho), str(e))
+
+        for tipo, caminho in zips:
+            processar_zip(pastas, tipo, caminho, executor)
+
+    finally:
+        descarregar_indice(pastas)
+        descarregar_auditoria(pastas)
+        # Daqui em diante a retomada não repõe as linhas nos bancos
+        anotar_journal({"gravado": True})
+
+
+# ============================================================
+# LEASES (VÁRIOS WORKERS NA MESMA PASTA)
+# ============================================================
+# Permite que várias máquinas/instâncias esvaziem o mesmo EDITOR_BO_BARRY
+# (ex.: em um compartilhamento de rede) sem processar o mesmo arquivo duas
+# vezes:
+# - Cada instância tem um ID (máquina + PID) e reivindica os arquivos
+#   renomeando-os (operação atômica) para EM_PROCESSAMENTO/<ID>/<TIPO>/.
+#   Se outra instância renomeou antes, o arquivo é simplesmente pulado.
+# - O PDF de mesmo nome acompanha o XML.
+# - EM_PROCESSAMENTO/<ID>.lease é renovado a cada LEASE_RENOVACAO segundos
+#   enquanto a instância estiver viva.
+# - O que sobrar na pasta da instância ao fim de cada lote (arquivos com
+#   erro) volta para a pasta de entrada, como antes.
+# - Lease sem renovação há mais de LEASE_EXPIRACAO segundos (instância que
+#   caiu) tem os arquivos devolvidos à entrada por qualquer outra instância.
+LEASE_EXPIRACAO = 15 * 60
+LEASE_RENOVACAO = 30
+LOTE_REIVINDICACAO = 500
+
+ID_WORKER = f"{socket.gethostname()}_{os.getpid()}"
+
+_lease_ativo = threading.Event()
+_lease_thread = None
+
+
+def pasta_lease(pastas, worker=ID_WORKER):
+    return os.path.join(pastas["PROCESSAMENTO"], worker)
+
+
+def arquivo_lease(pastas, worker=ID_WORKER):
+    return pasta_lease(pastas, worker) + ".lease"
+
+
+def renovar_lease(pastas):
+    with open(arquivo_lease(pastas), "w", encoding="utf-8") as f:
+        f.write(f"{datetime.now():%Y-%m-%d %H:%M:%S}\n")
+
+
+def iniciar_lease(pastas):
+    global _lease_thread
+
+    renovar_lease(pastas)
+    _lease_ativo.set()
+
+    if _lease_thread is None:
+        def manter():
+            while True:
+                time.sleep(LEASE_RENOVACAO)
+                if _lease_ativo.is_set():
+                    try:
+                        renovar_lease(pastas)
+                    except OSError:
+                        pass
+
+        _lease_thread = threading.Thread(target=manter, daemon=True)
+        _lease_thread.start()
+
+
+def encerrar_lease(pastas):
+    # Pacotes abertos são fechados antes de a área da instância ser liberada;
+    # o que sobrar na área do pacote (fechamento com erro) vai solto, como
+    # na recuperação, e a pasta PACOTE não fica para trás
+    fechar_pacotes(pastas)
+    liberar_pacotes(pastas, pasta_lease(pastas))
+    descartar_temporarios(pastas)
+    _lease_ativo.clear()
+    devolver_arquivos(pastas, pasta_lease(pastas))
+    try:
+        os.remove(arquivo_lease(pastas))
+    except OSError:
+        pass
+
+
+def reivindicar(pastas, tipo, caminho):
+    pasta_destino = os.path.join(pasta_lease(pastas), tipo)
+    os.makedirs(pasta_destino, exist_ok=True)
+    nome = os.path.basename(caminho)
+    destino = os.path.join(pasta_destino, nome)
+
+    # Cópia de mesmo nome que ficou na área da instância (devolver_arquivos
+    # não sobrescreve a entrada): no POSIX o rename a apagaria sem aviso
+    if os.path.exists(destino):
+        registrar_erro(
+            pastas, tipo, nome, f"Já existe em processamento: {destino}"
+        )
+        return None
+
+    try:
+        os.rename(caminho, destino)
+    except FileNotFoundError:
+        return None  # outra instância chegou antes
+    except OSError as e:
+        # Ainda sendo copiado / bloqueado (antivírus) no Windows: fica para
+        # a próxima passada, sem derrubar o lote
+        registrar_erro(pastas, tipo, nome, str(e))
+        return None
+
+    if not caminho.lower().endswith(".xml"):
+        return destino
+
+    if tipo in _indices_entrada:
+        # PDF conhecido pelo índice: nenhuma tentativa de renomear no escuro
+        pdf = pdf_do_xml(_indices_entrada[tipo], caminho)
+    else:
+        pdf = f"{os.path.splitext(caminho)[0]}.pdf"
+
+    _pdfs_pareados[destino] = None
+    pdf_destino = pdf and os.path.join(pasta_destino, os.path.basename(pdf))
+    if pdf_destino and not os.path.exists(pdf_destino):
+        try:
+            os.rename(pdf, pdf_destino)
+            _pdfs_pareados[destino] = pdf_destino
+        except OSError:
+            pass
+
+    return destino
+
+
+def reivindicar_arquivos(pastas, arquivos):
+    reivindicados = []
+    for tipo, caminho in arquivos:
+        destino = reivindicar(pastas, tipo, caminho)
+        if destino:
+            reivindicados.append((tipo, destino))
+    return reivindicados
+
+
+def devolver_arquivos(pastas, pasta_worker):
+    for tipo in TIPOS:
+        origem = os.path.join(pasta_worker, tipo)
+        try:
+            with os.scandir(origem) as itens:
+                restantes = [item.name for item in itens]
+        except FileNotFoundError:
+            continue
+
+        if restantes:
+            # Uma listagem da entrada no lugar de um exists por arquivo; não
+            # sobrescreve um arquivo novo de mesmo nome que chegou lá
+            entrada = pastas[f"ENTRADA_{tipo}"]
+            with os.scandir(entrada) as itens:
+                existentes = {item.name.lower() for item in itens}
+
+            for nome in restantes:
+                if nome.lower() in existentes:
+                    continue
+                try:
+                    os.rename(os.path.join(origem, nome), os.path.join(entrada, nome))
+                except OSError:
+                    pass
+
+        try:
+            os.rmdir(origem)
+        except OSError:
+            pass
+
+    try:
+        os.rmdir(pasta_worker)
+    except OSError:
+        pass
+
+
+def worker_ativo(nome):
+    # Na mesma máquina dá para saber na hora se o processo dono do lease
+    # ainda existe; de outra máquina vale só a expiração do lease.
+    maquina, _, pid = nome.rpartition("_")
+    if maquina != socket.gethostname() or not pid.isdigit():
+        return True
+    pid = int(pid)
+
+    if os.name == "nt":
+        import ctypes
+
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # acesso negado = existe
+        codigo = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(codigo))
+        kernel32.CloseHandle(handle)
+        return codigo.value == 259  # STILL_ACTIVE
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def recuperar_leases_expirados(pastas):
+    agora = time.time()
+
+    for nome in os.listdir(pastas["PROCESSAMENTO"]):
+        pasta_worker = os.path.join(pastas["PROCESSAMENTO"], nome)
+        if nome == ID_WORKER or not os.path.isdir(pasta_worker):
+            continue
+
+        try:
+            referencia = os.path.getmtime(pasta_worker + ".lease")
+        except OSError:
+            referencia = os.path.getmtime(pasta_worker)
+
+        if agora - referencia < LEASE_EXPIRACAO and worker_ativo(nome):
+            continue
+
+        retomar_journal(pastas, nome)
+        liberar_pacotes(pastas, pasta_worker)
+        descartar_temporarios(pastas, nome)
+        devolver_arquivos(pastas, pasta_worker)
+        if not os.path.exists(pasta_worker):
+            try:
+                os.remove(pasta_worker + ".lease")
+            except OSError:
+                pass
+
+
+# ============================================================
+# JOURNAL (RETOMADA APÓS QUEDA)
+# ============================================================
+# Antes de cada bloco a instância grava (com fsync) a lista dos arquivos em
+# andamento em EM_PROCESSAMENTO/<ID>.journal, apagado quando o bloco termina.
+# As saídas são sempre gravadas em EM_PROCESSAMENTO/<ID>/TMP/<TIPO>/<nome>.tmp
+# e renomeadas para o destino, então nunca ficam pela metade, e a saída nunca
+# precisa ser varrida atrás de sobras. Se a instância cair, quem recupera o
+# lease (ver LEASES) retoma só o que ficou em andamento:
+# - a área TMP da instância é apagada inteira;
+# - item com a origem ainda na pasta da instância é refeito (uma saída já
+#   renomeada, sem log nem índice, é descartada; com LAYOUT_SAIDA dividido
+#   ela é sobrescrita ao refazer) ao voltar para a entrada;
+# - item com a origem já movida está concluído (o PDF vai antes do XML).
+# As linhas de índice, auditoria e LOG_EDICAO_PO de cada item só vão para o
+# disco no fim do bloco; por isso, antes de a origem sair da pasta da
+# instância, elas são anotadas no journal (com fsync). Na retomada, as dos
+# itens concluídos são repostas: nos bancos só se o bloco não chegou a
+# gravá-los (marca "gravado") e no log só as que ainda não estão no arquivo.
+_journal = None
+
+
+def arquivo_journal(pastas, worker=ID_WORKER):
+    return pasta_lease(pastas, worker) + ".journal"
+
+
+def pasta_temporarios(pastas, tipo=None, worker=ID_WORKER):
+    pasta = os.path.join(pasta_lease(pastas, worker), "TMP")
+    return os.path.join(pasta, tipo) if tipo else pasta
+
+
+def preparar_temporarios(pastas, tipo):
+    pasta = pasta_temporarios(pastas, tipo)
+    if pasta not in _pastas_criadas:
+        os.makedirs(pasta, exist_ok=True)
+        _pastas_criadas.add(pasta)
+    return pasta
+
+
+def descartar_temporarios(pastas, worker=ID_WORKER):
+    # Fim da instância ou instância caída: nada na área TMP é aproveitado
+    pasta = pasta_temporarios(pastas, worker=worker)
+    shutil.rmtree(pasta, ignore_errors=True)
+    _pastas_criadas.difference_update(
+        [p for p in _pastas_criadas if p.startswith(pasta + os.sep)]
+    )
+
+
+def iniciar_journal(pastas, itens):
+    global _journal
+
+    log = os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt")
+    try:
+        tamanho_log = os.path.getsize(log)
+    except OSError:
+        tamanho_log = 0
+
+    f = open(arquivo_journal(pastas), "w", encoding="utf-8")
+    f.write(json.dumps({"inicio": time.time(), "tamanho_log": tamanho_log}) + "\n")
+    for tipo, origem in itens:
+        pasta = pastas[f"SAIDA_{tipo}"]
+        if origem.lower().endswith(".xml"):
+            pasta = destino_xml_solto(pastas, tipo)[0]
+        destino = os.path.join(pasta, os.path.basename(origem))
+        f.write(json.dumps(
+            {"tipo": tipo, "origem": origem, "destino": destino},
+            ensure_ascii=False,
+        ) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+    _journal = f
+
+
+def anotar_journal(registro):
+    # Fora de um bloco (chamada avulsa) não há journal a anotar
+    if _journal is None:
+        return
+    _journal.write(json.dumps(registro, ensure_ascii=False) + "\n")
+    _journal.flush()
+    os.fsync(_journal.fileno())
+
+
+def encerrar_journal(pastas):
+    global _journal
+
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+    try:
+        os.remove(arquivo_journal(pastas))
+    except FileNotFoundError:
+        pass
+
+
+def acumular_registros(pastas, registros, bancos=True):
+    if bancos:
+        _registros_indice.extend(tuple(r) for r in registros["indice"])
+        with _lock_auditoria:
+            _registros_auditoria.extend(tuple(r) for r in registros["auditoria"])
+    if registros["log"]:
+        escrever_log(os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt"), registros["log"])
+
+
+def repor_registros(pastas, concluidos, gravado, tamanho_log):
+    # Linhas de LOG_EDICAO_PO que o bloco já tinha descarregado (lote de
+    # LOG_LOTE_LINHAS ou LOG_INTERVALO_FLUSH) não são repetidas
+    log = os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt")
+    presentes = set()
+    try:
+        with open(log, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= tamanho_log:
+                f.seek(tamanho_log)  # senão o log foi rotacionado: lê tudo
+            presentes = {linha.decode("utf-8", "replace") for linha in f}
+    except FileNotFoundError:
+        pass
+
+    for registros in concluidos:
+        if registros.get("log") in presentes:
+            registros["log"] = None
+        acumular_registros(pastas, registros, bancos=not gravado)
+
+    descarregar_indice(pastas)
+    descarregar_auditoria(pastas)
+    descarregar_logs()
+
+
+def descartar(caminho):
+    try:
+        os.remove(caminho)
+    except FileNotFoundError:
+        pass
+
+
+def retomar_journal(pastas, worker):
+    journal = arquivo_journal(pastas, worker)
+    try:
+        with open(journal, encoding="utf-8") as f:
+            linhas = f.readlines()
+        gravado_em = os.path.getmtime(journal)
+    except FileNotFoundError:
+        return
+
+    itens, concluidos = [], {}
+    gravado, tamanho_log = False, 0
+    for linha in linhas:
+        try:
+            registro = json.loads(linha)
+        except ValueError:
+            continue  # última linha cortada: anotação que não se completou
+
+        if "concluido" in registro:
+            concluidos[registro["concluido"]] = registro
+        elif "gravado" in registro:
+            gravado = True
+        elif "inicio" in registro:
+            gravado_em = registro["inicio"]
+            tamanho_log = registro["tamanho_log"]
+        else:
+            itens.append(registro)
+
+    # Concluído = anotado e com a origem já fora da pasta da instância
+    concluidos = [r for origem, r in concluidos.items() if not os.path.exists(origem)]
+    if concluidos:
+        repor_registros(pastas, concluidos, gravado, tamanho_log)
+
+    for item in itens:
+        origem, destino = item["origem"], item["destino"]
+
+        # Saída gravada depois do journal e antes de a origem sair
+        if os.path.exists(origem) and os.path.exists(destino) \
+                and os.path.getmtime(destino) >= gravado_em:
+            descartar(destino)
+
+    descartar(journal)
+
+
+def recuperar_pendencias(pastas):
+    recuperar_leases_expirados(pastas)
+
+
+def processar_reivindicados(pastas, arquivos, executor=None):
+    # Reivindica em blocos, para dividir o trabalho com as outras instâncias
+    for inicio in range(0, len(arquivos), LOTE_REIVINDICACAO):
+        reivindicados = reivindicar_arquivos(
+            pastas, arquivos[inicio:inicio + LOTE_REIVINDICACAO]
+        )
+        if reivindicados:
+            xmls, zips = classificar_arquivos(reivindicados)
+            iniciar_journal(pastas, xmls + zips)
+            processar_lote(pastas, xmls, zips, executor)
+            # Log do bloco no disco antes de o journal deixar de cobri-lo
+            descarregar_logs()
+            encerrar_journal(pastas)
+        devolver_arquivos(pastas, pasta_lease(pastas))
+
+
+def nada_a_processar(pastas):
+    # Só os.scandir: decide se vale continuar antes de qualquer import pesado
+    pastas_verificadas = list(mapear_entradas(pastas).values())
+    pastas_verificadas.append(pastas["PROCESSAMENTO"])
+
+    for pasta in pastas_verificadas:
+        try:
+            with os.scandir(pasta) as itens:
+                if any(True for _ in itens):
+                    return False
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def executar(pastas, workers=1):
+    recuperar_pendencias(pastas)
+    xmls, zips = listar_entradas(pastas)
+
+    if not xmls and not zips:
+        return
+
+    inicio = time.time()
+    iniciar_lease(pastas)
+    try:
+        if workers <= 1:
+            processar_reivindicados(pastas, xmls + zips)
+        else:
+            with criar_pool(workers) as executor:
+                processar_reivindicados(pastas, xmls + zips, executor)
+    finally:
+        _indices_entrada.clear()
+        _pdfs_pareados.clear()
+        encerrar_lease(pastas)
+        descarregar_logs()
+        exportar_metricas(pastas, inicio, time.time())
+
+
+# ============================================================
+# PRÉVIA (--dry-run)
+# ============================================================
+# Percorre as três pastas de entrada, inclusive os XMLs dentro dos ZIPs
+# (lidos em memória, sem extrair), e calcula tomador, UF, PO atual e PO de
+# destino pelo PO_RULES. Nada é alterado, movido ou registrado em log: o
+# único arquivo gravado é o relatório (CSV ou JSON). Usa o mesmo pool de
+# processos e os mesmos blocos de ZIP da execução normal.
+CAMPOS_PREVIA = (
+    "TIPO", "ARQUIVO", "MEMBRO", "TOMADOR", "UF", "nCT", "CHAVE",
+    "PO_ATUAL", "PO_NOVO", "ALTERA", "ERRO",
+)
+
+
+def pos_atuais_bytes(dados):
+    # Todas as ocorrências: a execução real troca cada uma (PADRAO_PO.sub)
+    if not compativel_ascii(dados):
+        dados = bytes(dados).decode("utf-16").encode("utf-8")
+    return [m.group().decode("ascii") for m in PADRAO_PO.finditer(dados)]
+
+
+def prever_cte_bytes(dados, tipo):
+    # Roda nos workers: nunca levanta exceção, o erro vai para o relatório
+    try:
+        info = extrair_info_bytes(dados)
+        po_novo = PO_RULES[tipo][info["TOMADOR"]][info["UF"]]
+        pos_atuais = pos_atuais_bytes(dados)
+    except Exception as e:
+        return {"ERRO": str(e)}
+
+    # Sem PO nenhum a execução insere o xObs, então também altera
+    altera = not pos_atuais or any(po != po_novo for po in pos_atuais)
+    return {
+        "TOMADOR": info["TOMADOR"], "UF": info["UF"], "nCT": info["nCT"] or "",
+        "CHAVE": info["CHAVE"],
+        "PO_ATUAL": pos_atuais[0] if pos_atuais else "NAO_ENCONTRADO",
+        "PO_NOVO": po_novo, "ALTERA": "SIM" if altera else "NAO",
     }
 
-    for tipo, pasta in entradas.items():
-        for nome in os.listdir(pasta):
-            caminho = os.path.join(pasta, nome)
 
-            if not os.path.isfile(caminho):
+def prever_xml(tipo, caminho):
+    try:
+        return prever_cte_bytes(ler_bytes_limitado(caminho), tipo)
+    except OSError as e:
+        return {"ERRO": str(e)}
+    except ArquivoRecusado as e:
+        return {"ERRO": f"QUARENTENA: {e}"}
+
+
+def prever_membros_zip(zin, tipo, zip_nome, linhas, executor=None, prefixo="",
+                       nivel=0, consumido=None):
+    consumido = Counter() if consumido is None else consumido
+    verificar_limites_zip(zin.infolist(), consumido)
+    membros = [info for info in zin.infolist() if membro_xml(info)]
+
+    for bloco in blocos_de_membros(membros):
+        originais = [zin.read(info) for info in bloco]
+
+        if executor is None:
+            resultados = [prever_cte_bytes(dados, tipo) for dados in originais]
+        else:
+            resultados = executor.map(
+                prever_cte_bytes, originais, repeat(tipo), chunksize=16
+            )
+
+        for info, resultado in zip(bloco, resultados):
+            linhas.append({
+                "TIPO": tipo, "ARQUIVO": zip_nome,
+                "MEMBRO": prefixo + info.filename, **resultado,
+            })
+
+    # ZIPs internos, com o mesmo limite de profundidade da execução normal
+    if nivel >= PROFUNDIDADE_ZIP:
+        return
+    for info in zin.infolist():
+        if not membro_zip(info):
+            continue
+        with temporario_em_memoria() as copia:
+            with zin.open(info) as interno:
+                shutil.copyfileobj(interno, copia, BLOCO_COPIA)
+            copia.seek(0)
+            try:
+                zip_interno = zipfile.ZipFile(copia, "r")
+            except zipfile.BadZipFile:
                 continue
+            with zip_interno:
+                prever_membros_zip(
+                    zip_interno, tipo, zip_nome, linhas, executor,
+                    f"{prefixo}{info.filename}/", nivel + 1, consumido,
+                )
 
-            if nome.lower().endswith(".xml"):
-                processar_xml_individual(pastas, tipo, caminho)
 
-            elif nome.lower().endswith(".zip"):
-                processar_zip(pastas, tipo, caminho)
+def prever_zip(tipo, caminho, executor=None):
+    zip_nome = os.path.basename(caminho)
+    linhas = []
+
+    try:
+        with zipfile.ZipFile(caminho, "r") as zin:
+            prever_membros_zip(zin, tipo, zip_nome, linhas, executor)
+
+    except ArquivoRecusado as e:
+        linhas.append({"TIPO": tipo, "ARQUIVO": zip_nome, "ERRO": f"QUARENTENA: {e}"})
+
+    except Exception as e:
+        linhas.append({"TIPO": tipo, "ARQUIVO": zip_nome, "ERRO": str(e)})
+
+    return linhas
+
+
+def prever_entradas(pastas, executor=None):
+    xmls, zips = listar_entradas(pastas)
+    tipos = [tipo for tipo, _ in xmls]
+    caminhos = [caminho for _, caminho in xmls]
+
+    if executor is None:
+        resultados = map(prever_xml, tipos, caminhos)
+    else:
+        resultados = executor.map(prever_xml, tipos, caminhos, chunksize=32)
+
+    linhas = [
+        {"TIPO": tipo, "ARQUIVO": os.path.basename(caminho), **resultado}
+        for tipo, caminho, resultado in zip(tipos, caminhos, resultados)
+    ]
+    for tipo, caminho in zips:
+        linhas.extend(prever_zip(tipo, caminho, executor))
+
+    return linhas
+
+
+def gravar_relatorio_previa(caminho, linhas):
+    if caminho.lower().endswith(".json"):
+        texto = json.dumps(linhas, ensure_ascii=False, indent=2)
+    else:
+        # ";" e BOM: abre direto no Excel em português
+        import csv
+
+        saida = io.StringIO()
+        escritor = csv.DictWriter(
+            saida, fieldnames=CAMPOS_PREVIA, delimiter=";", restval="",
+            lineterminator="\n",
+        )
+        escritor.writeheader()
+        escritor.writerows(linhas)
+        texto = "\ufeff" + saida.getvalue()
+
+    gravar_atomico(caminho, texto)
+
+
+def executar_previa(pastas, workers=1, relatorio=None):
+    if relatorio is None:
+        relatorio = os.path.join(
+            pastas["LOG"], f"PREVIA_PO_{datetime.now():%Y%m%d_%H%M%S}.csv"
+        )
+
+    if workers <= 1:
+        linhas = prever_entradas(pastas)
+    else:
+        with criar_pool(workers) as executor:
+            linhas = prever_entradas(pastas, executor)
+
+    gravar_relatorio_previa(relatorio, linhas)
+
+    alteram = sum(1 for linha in linhas if linha.get("ALTERA") == "SIM")
+    erros = sum(1 for linha in linhas if linha.get("ERRO"))
+    print(
+        f"{len(linhas)} XML(s) | {alteram} com PO a alterar | "
+        f"{erros} com erro | relatório: {relatorio}"
+    )
+
+
+# ============================================================
+# MIGRAÇÃO DA SAÍDA (--migrar-saida)
+# ============================================================
+# Redistribui o que já está em SAIDA_FINAL conforme LAYOUT_SAIDA (inclusive
+# de volta para "plano"). Cada XML é lido (scanner rápido) para tomador, UF e
+# chave; a data é a da última modificação do arquivo, que corresponde ao
+# processamento. O PDF vai junto com o XML (mesmo nome ou mesma chave).
+# Nada é sobrescrito: conflito de nome vai para LOG_ERRO.txt e o arquivo
+# fica onde está. Rodar com as outras instâncias paradas.
+def mover_sem_sobrescrever(origem, destino):
+    if origem == destino:
+        return False
+    if os.path.exists(destino):
+        raise FileExistsError(f"Já existe no destino: {destino}")
+    mover_atomico(origem, destino)
+    return True
+
+
+def remover_pastas_vazias(raiz):
+    for pasta, _, _ in sorted(os.walk(raiz), key=lambda p: -len(p[0])):
+        if pasta != raiz:
+            try:
+                os.rmdir(pasta)
+            except OSError:
+                pass
+
+
+def migrar_saida(pastas, layout=None):
+    layout = layout or LAYOUT_SAIDA
+    validar_layout(layout)
+    totais = Counter()
+
+    for tipo in TIPOS:
+        raiz = pastas[f"SAIDA_{tipo}"]
+        # Lista antes de mover: as pastas novas não entram na varredura
+        for pasta in [p for p, _, _ in os.walk(raiz)]:
+            indice = indexar_pasta(pasta)
+
+            for xml in indice["XML"]:
+                nome = os.path.relpath(xml, raiz)
+                try:
+                    info = extrair_info_bytes(ler_bytes(xml))
+                    quando = datetime.fromtimestamp(os.path.getmtime(xml))
+                    destino = pasta_saida_layout(raiz, info, layout, quando)
+
+                    pdf = pdf_do_xml(indice, xml, info["CHAVE"])
+                    movido = mover_sem_sobrescrever(xml, os.path.join(destino, os.path.basename(xml)))
+                    totais["movidos" if movido else "no_lugar"] += 1
+                    if pdf:
+                        mover_sem_sobrescrever(pdf, os.path.join(destino, os.path.basename(pdf)))
+                except Exception as e:
+                    totais["erros"] += 1
+                    registrar_erro(pastas, tipo, nome, str(e))
+
+            for zip_path in indice["ZIP"]:
+                try:
+                    quando = datetime.fromtimestamp(os.path.getmtime(zip_path))
+                    destino = pasta_saida_layout(raiz, None, layout, quando)
+                    movido = mover_sem_sobrescrever(
+                        zip_path, os.path.join(destino, os.path.basename(zip_path))
+                    )
+                    totais["movidos" if movido else "no_lugar"] += 1
+                except Exception as e:
+                    totais["erros"] += 1
+                    registrar_erro(pastas, tipo, os.path.relpath(zip_path, raiz), str(e))
+
+        remover_pastas_vazias(raiz)
+
+    descarregar_logs()
+    print(
+        f"Layout {layout}: {totais['movidos']} arquivo(s) movido(s) | "
+        f"{totais['no_lugar']} já no lugar | {totais['erros']} com erro"
+    )
+
+
+# ============================================================
+# MODO VIGIA (--watch)
+# ============================================================
+# Processo contínuo: reage aos arquivos novos nas pastas de entrada em vez
+# de varrer tudo a cada execução agendada. No Linux usa inotify; nos demais
+# sistemas (ou se o inotify falhar) faz varredura periódica.
+# XML pronto sem o PDF de mesmo nome espera mais ESPERA_PDF segundos pelo
+# PDF (cópias feitas em dois passos: XML primeiro, PDF depois). Um PDF que
+# chegue depois disso fica na entrada, como o PDF sem XML na execução
+# normal.
+INTERVALO_VIGIA = 1.0
+ESPERA_OCIOSA = 60.0
+ESTABILIDADE_ARQUIVO = 2.0
+ESPERA_PDF = 15.0
+
+IN_CREATE = 0x100
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+
+
+def criar_espera_inotify(diretorios):
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 falhou")
+
+    diretorio_por_wd = {}
+    for diretorio in diretorios:
+        wd = libc.inotify_add_watch(
+            fd, os.fsencode(diretorio), IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch falhou: {diretorio}")
+        diretorio_por_wd[wd] = diretorio
+
+    cabecalho = struct.Struct("iIII")
+
+    def aguardar(timeout):
+        prontos, _, _ = select.select([fd], [], [], timeout)
+        if not prontos:
+            return set()
+
+        caminhos = set()
+        while True:
+            try:
+                buffer = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            pos = 0
+            while pos < len(buffer):
+                wd, mascara, _, tamanho = cabecalho.unpack_from(buffer, pos)
+                nome = buffer[pos + cabecalho.size:pos + cabecalho.size + tamanho]
+                pos += cabecalho.size + tamanho
+
+                if mascara & IN_Q_OVERFLOW:
+                    return None
+                nome = os.fsdecode(nome.rstrip(b"\0"))
+                if nome and wd in diretorio_por_wd:
+                    caminhos.add(os.path.join(diretorio_por_wd[wd], nome))
+
+        return caminhos
+
+    return aguardar
+
+
+def criar_espera_polling(diretorios):
+    def aguardar(timeout):
+        time.sleep(min(timeout, INTERVALO_VIGIA))
+        return None
+
+    return aguardar
+
+
+def criar_espera(diretorios):
+    # None = "varrer tudo de novo"; conjunto = apenas os caminhos citados
+    if sys.platform.startswith("linux"):
+        try:
+            return criar_espera_inotify(diretorios)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return criar_espera_polling(diretorios)
+
+
+def assinatura_arquivo(caminho):
+    st = os.stat(caminho)
+    return st.st_size, st.st_mtime_ns
+
+
+def arquivo_completo(caminho):
+    # Arquivo ainda sendo copiado: bloqueado (Windows), ZIP sem diretório
+    # central ou XML sem a tag de fechamento.
+    try:
+        with open(caminho, "rb") as f:
+            if caminho.lower().endswith(".xml"):
+                f.seek(max(0, os.fstat(f.fileno()).st_size - 64))
+                return f.read().rstrip().endswith(b">")
+    except OSError:
+        return False
+
+    if caminho.lower().endswith(".zip"):
+        return zipfile.is_zipfile(caminho)
+
+    return True
+
+
+def verificar_pendentes(pendentes):
+    agora = time.monotonic()
+    prontos = []
+
+    for caminho, (tipo, assinatura, desde) in list(pendentes.items()):
+        try:
+            atual = assinatura_arquivo(caminho)
+        except OSError:
+            del pendentes[caminho]
+            continue
+
+        if atual != assinatura:
+            pendentes[caminho] = (tipo, atual, agora)
+        elif agora - desde >= ESTABILIDADE_ARQUIVO and arquivo_completo(caminho):
+            prontos.append((tipo, caminho))
+
+    # XML só segue quando o PDF de mesmo nome (se houver) também estiver
+    # pronto; sem PDF à vista, só depois de ESPERA_PDF
+    prontos_set = {caminho for _, caminho in prontos}
+    liberados = []
+    for tipo, caminho in prontos:
+        if caminho.lower().endswith(".pdf"):
+            continue
+        pdf = os.path.splitext(caminho)[0] + ".pdf"
+        if pdf in pendentes and pdf not in prontos_set:
+            continue
+        if caminho.lower().endswith(".xml") and pdf not in pendentes \
+                and agora - pendentes[caminho][2] < ESPERA_PDF and not os.path.exists(pdf):
+            continue
+        liberados.append((tipo, caminho))
+        pendentes.pop(caminho, None)
+        pendentes.pop(pdf, None)
+
+    # PDF pronto que nenhum XML pendente espera (sozinho ou pareado só pela
+    # chave) sai da fila: senão a vigia nunca chega à espera ociosa.
+    aguardados = {
+        os.path.splitext(caminho)[0].lower()
+        for caminho in pendentes
+        if not caminho.lower().endswith(".pdf")
+    }
+    soltos = []
+    for _, caminho in prontos:
+        if (
+            caminho in pendentes
+            and caminho.lower().endswith(".pdf")
+            and os.path.splitext(caminho)[0].lower() not in aguardados
+        ):
+            del pendentes[caminho]
+            soltos.append(caminho)
+
+    return liberados, soltos
+
+
+def vigiar(pastas, workers=1):
+    entradas = mapear_entradas(pastas)
+    tipo_por_pasta = {os.path.normcase(p): tipo for tipo, p in entradas.items()}
+    aguardar = criar_espera(list(entradas.values()))
+    executor = criar_pool(workers) if workers > 1 else None
+
+    inicio = time.time()
+    ultima_recuperacao = 0.0
+    iniciar_lease(pastas)
+    pendentes = {}
+    # Arquivos já entregues ao processamento (ex.: com erro e ainda na
+    # entrada): só voltam à fila se forem alterados/substituídos.
+    entregues = {}
+    novos = None
+
+    try:
+        while True:
+            if time.monotonic() - ultima_recuperacao >= LEASE_RENOVACAO:
+                recuperar_pendencias(pastas)
+                ultima_recuperacao = time.monotonic()
+
+            if novos is None:
+                novos = {
+                    os.path.join(pasta, nome)
+                    for pasta in entradas.values()
+                    for nome in os.listdir(pasta)
+                }
+
+            for caminho in novos:
+                tipo = tipo_por_pasta.get(os.path.normcase(os.path.dirname(caminho)))
+                if not tipo or caminho in pendentes or not os.path.isfile(caminho):
+                    continue
+                try:
+                    if entregues.get(caminho) == assinatura_arquivo(caminho):
+                        continue
+                except OSError:
+                    continue
+                pendentes[caminho] = (tipo, None, time.monotonic())
+
+            prontos, soltos = verificar_pendentes(pendentes)
+            for caminho in soltos + [caminho for _, caminho in prontos]:
+                # Outra instância (ou o usuário) pode ter levado o arquivo
+                try:
+                    entregues[caminho] = assinatura_arquivo(caminho)
+                except OSError:
+                    pass
+
+            if prontos:
+                processar_reivindicados(pastas, prontos, executor)
+                descarregar_logs()
+                exportar_metricas(pastas, inicio, time.time())
+
+                for caminho in [c for c in entregues if not os.path.exists(c)]:
+                    del entregues[caminho]
+
+            fechar_pacotes(pastas, vencidos=True)
+            novos = aguardar(INTERVALO_VIGIA if pendentes else ESPERA_OCIOSA)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        encerrar_lease(pastas)
+        descarregar_logs()
+
+
+# ============================================================
+# MODO SERVIÇO (--serve)
+# ============================================================
+# Serviço HTTP local com o pool de processos já aquecido (lxml carregado),
+# para corrigir CT-e sob demanda sem abrir o executável a cada lote:
+#
+#   POST /processar?tipo=FRETE[&arquivo=NOME]   corpo: XML ou ZIP
+#     200 -> conteúdo corrigido (application/xml ou application/zip) e o
+#            resumo no cabeçalho X-Resumo-PO (mesma linha do log), além de
+#            X-PO-Antes / X-PO-Depois (XML) ou X-Total-XML (ZIP)
+#     400 -> tipo inválido ou XML/ZIP com erro (JSON com "erro")
+#     413 -> corpo maior que LIMITE_REQUISICAO ou fora dos LIMITES
+#            (ZIP-bomba, XML acima de LIMITE_XML_MB)
+#     503 -> fila cheia (Retry-After): o cliente deve tentar de novo
+#   GET /saude -> ocupação da fila
+#
+# No máximo --fila requisições ficam em andamento ao mesmo tempo; acima
+# disso a resposta é 503 imediatamente (backpressure), sem enfileirar sem
+# limite. Cada requisição também vai para LOG_EDICAO_PO.txt/LOG_ERRO.txt e
+# para a auditoria, como na execução por pastas.
+PORTA_SERVICO = 8765
+LIMITE_REQUISICAO = 200 * 1024 * 1024
+
+
+def aquecer_worker(_):
+    # Carrega o lxml no worker antes da primeira requisição
+    importlib.import_module("lxml.etree")
+
+    return os.getpid()
+
+
+def resposta_json(dados):
+    return json.dumps(dados, ensure_ascii=False).encode("utf-8")
+
+
+def processar_requisicao(pastas, executor, corpo, tipo, arquivo):
+    # Devolve (status, tipo de conteúdo, corpo, cabeçalhos extras)
+    try:
+        validar_tipo(tipo)
+    except ValueError as e:
+        return 400, "application/json", resposta_json({"erro": str(e)}), {}
+
+    # is_zipfile procura o diretório central, então reconhece também o ZIP
+    # vazio (só PK\x05\x06) e o autoextraível; "PK" no início cobre o ZIP
+    # truncado, que deve falhar como ZIP e não como XML
+    if corpo[:2] == b"PK" or zipfile.is_zipfile(io.BytesIO(corpo)):
+        arquivo = arquivo or "requisicao.zip"
+        saida = io.BytesIO()
+        try:
+            with medir("processar_zip", len(corpo)):
+                resumo = processar_zip_stream(io.BytesIO(corpo), saida, tipo, executor)
+        except ArquivoRecusado as e:
+            registrar_erro(pastas, tipo, arquivo, f"RECUSADO: {e}")
+            return 413, "application/json", resposta_json({"erro": str(e)}), {}
+        except Exception as e:
+            registrar_erro(pastas, tipo, arquivo, str(e))
+            return 400, "application/json", resposta_json({"erro": str(e)}), {}
+
+        for membro, info in resumo["MEMBROS"]:
+            registrar_auditoria(tipo, arquivo, info, membro=membro)
+        registrar_log_zip_resumido(
+            pastas, tipo, arquivo, resumo["TOTAL_XML"],
+            resumo["PO_ANTES"], resumo["PO_DEPOIS"], resumo["NIVEIS"],
+        )
+        return 200, "application/zip", saida.getvalue(), {
+            "X-Total-XML": str(resumo["TOTAL_XML"]),
+            "X-Resumo-PO": formatar_log_zip_resumido(
+                tipo, arquivo, resumo["TOTAL_XML"],
+                resumo["PO_ANTES"], resumo["PO_DEPOIS"], resumo["NIVEIS"],
+            ),
+        }
+
+    arquivo = arquivo or "requisicao.xml"
+    try:
+        verificar_tamanho_xml(len(corpo), arquivo)
+    except ArquivoRecusado as e:
+        registrar_erro(pastas, tipo, arquivo, f"RECUSADO: {e}")
+        return 413, "application/json", resposta_json({"erro": str(e)}), {}
+
+    xml_editado, info, erro, metricas = executor.submit(
+        tarefa_cte_bytes, corpo, tipo
+    ).result()
+    mesclar_metricas(metricas)
+    if erro:
+        registrar_erro(pastas, tipo, arquivo, erro)
+        return 400, "application/json", resposta_json({"erro": erro}), {}
+
+    registrar_auditoria(tipo, arquivo, info)
+    registrar_log_xml(pastas, tipo, arquivo, info["PO_ANTES"], info["PO_DEPOIS"])
+    return 200, "application/xml", xml_editado, {
+        "X-PO-Antes": info["PO_ANTES"],
+        "X-PO-Depois": info["PO_DEPOIS"],
+        "X-Resumo-PO": formatar_log_xml(
+            tipo, arquivo, info["PO_ANTES"], info["PO_DEPOIS"]
+        ),
+    }
+
+
+def servir(pastas, workers=1, host="127.0.0.1", porta=PORTA_SERVICO, fila=None):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+
+    fila = fila or max(1, workers) * 8
+    vagas = threading.BoundedSemaphore(fila)
+    em_andamento = Counter()
+    lock_andamento = threading.Lock()
+    executor = criar_pool(max(1, workers))
+    # Sobe todos os workers (e o lxml neles) antes da primeira requisição
+    list(executor.map(aquecer_worker, range(max(1, workers))))
+
+    class Tratador(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def responder(self, status, tipo_conteudo, corpo, cabecalhos=None):
+            self.send_response(status)
+            self.send_header("Content-Type", tipo_conteudo)
+            self.send_header("Content-Length", str(len(corpo)))
+            for nome, valor in (cabecalhos or {}).items():
+                # Cabeçalho HTTP é latin-1: nomes de arquivo com outros
+                # caracteres saem com "?"
+                self.send_header(nome, valor.encode("latin-1", "replace").decode("latin-1"))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def do_GET(self):
+            if urlsplit(self.path).path != "/saude":
+                self.responder(404, "application/json", resposta_json({"erro": "não encontrado"}))
+                return
+            self.responder(200, "application/json", resposta_json({
+                "em_andamento": em_andamento["total"],
+                "capacidade": fila,
+                "workers": workers,
+            }))
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/processar":
+                self.responder(404, "application/json", resposta_json({"erro": "não encontrado"}))
+                return
+
+            tamanho = self.headers.get("Content-Length")
+            if tamanho is None:
+                self.responder(411, "application/json", resposta_json({"erro": "Content-Length obrigatório"}))
+                return
+            try:
+                tamanho = int(tamanho)
+            except ValueError:
+                tamanho = -1
+            if tamanho < 0:
+                # Sem tamanho válido não dá para saber onde o corpo termina
+                self.close_connection = True
+                self.responder(400, "application/json", resposta_json({"erro": "Content-Length inválido"}))
+                return
+            if tamanho > LIMITE_REQUISICAO:
+                self.close_connection = True
+                self.responder(413, "application/json", resposta_json({"erro": "corpo muito grande"}))
+                return
+
+            if not vagas.acquire(blocking=False):
+                # Descarta o corpo para a conexão continuar utilizável
+                restante = tamanho
+                while restante > 0:
+                    bloco = self.rfile.read(min(restante, 1024 * 1024))
+                    if not bloco:
+                        break
+                    restante -= len(bloco)
+                self.responder(
+                    503, "application/json", resposta_json({"erro": "fila cheia"}),
+                    {"Retry-After": "1"},
+                )
+                return
+
+            try:
+                with lock_andamento:
+                    em_andamento["total"] += 1
+                corpo = self.rfile.read(tamanho)
+                parametros = parse_qs(url.query)
+                tipo = (parametros.get("tipo") or [self.headers.get("X-Tipo", "")])[0].upper()
+                arquivo = (parametros.get("arquivo") or [self.headers.get("X-Arquivo", "")])[0]
+                self.responder(*processar_requisicao(pastas, executor, corpo, tipo, arquivo))
+            finally:
+                with lock_andamento:
+                    em_andamento["total"] -= 1
+                vagas.release()
+
+        def log_message(self, formato, *args):
+            pass  # o registro fica no LOG_EDICAO_PO.txt / LOG_ERRO.txt
+
+    class Servidor(ThreadingHTTPServer):
+        daemon_threads = True
+        # Fila de conexões do sistema operacional (padrão 5 derruba rajadas)
+        request_queue_size = 256
+
+    servidor = Servidor((host, porta), Tratador)
+
+    # A conexão SQLite da auditoria fica em uma única thread; as métricas
+    # são exportadas no mesmo ritmo, para o node exporter ler com o serviço
+    # no ar
+    parar = threading.Event()
+    inicio = time.time()
+
+    def descarregar_periodicamente():
+        while not parar.wait(LOG_INTERVALO_FLUSH):
+            descarregar_auditoria(pastas)
+            descarregar_logs()
+            try:
+                exportar_metricas(pastas, inicio, time.time())
+            except OSError:
+                pass
+        descarregar_auditoria(pastas)
+
+    descarregador = threading.Thread(target=descarregar_periodicamente, daemon=True)
+    descarregador.start()
+
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        executor.shutdown()
+        parar.set()
+        descarregador.join()
+        descarregar_logs()
+        exportar_metricas(pastas, inicio, time.time())
 
 
 # ============================================================
 # MAIN
 # ============================================================
 def main():
+    parser = argparse.ArgumentParser(description="Editor automático de PO em CT-e")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="processos em paralelo (padrão: nº de CPUs; 1 = sequencial)",
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="fica em execução contínua processando os arquivos que chegarem",
+    )
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="sobe o serviço HTTP local (POST /processar?tipo=...) com o pool aquecido",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="endereço do --serve (padrão: 127.0.0.1)")
+    parser.add_argument(
+        "--porta", type=int, default=PORTA_SERVICO,
+        help=f"porta do --serve (padrão: {PORTA_SERVICO})",
+    )
+    parser.add_argument(
+        "--fila", type=int,
+        help="requisições simultâneas no --serve antes de responder 503 (padrão: 8 por worker)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="só gera um relatório com os PO que seriam alterados, sem tocar nos arquivos",
+    )
+    parser.add_argument(
+        "--relatorio",
+        help="arquivo do relatório do --dry-run (.csv ou .json; padrão: LOG/PREVIA_PO_<data>.csv)",
+    )
+    parser.add_argument(
+        "--layout-saida", default=LAYOUT_SAIDA,
+        help="subpastas da saída, ex.: mes/tomador/uf (componentes: "
+             f"{', '.join(COMPONENTES_LAYOUT)}; padrão: plano)",
+    )
+    parser.add_argument(
+        "--migrar-saida", action="store_true",
+        help="redistribui a SAIDA_FINAL existente conforme --layout-saida e sai",
+    )
+    parser.add_argument(
+        "--pacote-saida", action="store_true",
+        help="junta os XMLs soltos (e PDFs) em ZIPs por tipo em vez de um arquivo por CT-e",
+    )
+    parser.add_argument(
+        "--pacote-arquivos", type=int, default=PACOTE_MAX_ARQUIVOS,
+        help=f"fecha o pacote com N XMLs (padrão: {PACOTE_MAX_ARQUIVOS})",
+    )
+    parser.add_argument(
+        "--pacote-mb", type=int, default=PACOTE_MAX_MB,
+        help=f"fecha o pacote ao atingir M MB (padrão: {PACOTE_MAX_MB})",
+    )
+    parser.add_argument(
+        "--pacote-minutos", type=int, default=PACOTE_MAX_MINUTOS,
+        help=f"fecha o pacote T minutos após aberto, no --watch (padrão: {PACOTE_MAX_MINUTOS})",
+    )
+    limites = parser.add_argument_group(
+        "limites", "arquivos acima dos limites vão para QUARENTENA/<TIPO>"
+    )
+    limites.add_argument(
+        "--limite-zip-mb", type=int, default=LIMITE_ZIP_MB,
+        help=f"tamanho descompactado máximo de um ZIP (padrão: {LIMITE_ZIP_MB})",
+    )
+    limites.add_argument(
+        "--limite-membros", type=int, default=LIMITE_MEMBROS,
+        help=f"membros por ZIP (padrão: {LIMITE_MEMBROS})",
+    )
+    limites.add_argument(
+        "--limite-razao", type=int, default=LIMITE_RAZAO,
+        help=f"razão de compressão máxima de um membro (padrão: {LIMITE_RAZAO})",
+    )
+    limites.add_argument(
+        "--limite-xml-mb", type=int, default=LIMITE_XML_MB,
+        help=f"tamanho máximo de um XML (padrão: {LIMITE_XML_MB})",
+    )
+    parser.add_argument(
+        "--sem-log-texto", action="store_true",
+        help="não grava LOG_EDICAO_PO.txt (o histórico continua em LOG/AUDITORIA_PO.db)",
+    )
+    consulta = parser.add_argument_group(
+        "consulta à auditoria", "com --consultar, lista o histórico de PO e sai"
+    )
+    consulta.add_argument("--consultar", action="store_true")
+    consulta.add_argument("--chave", help="chave de acesso do CT-e")
+    consulta.add_argument("--nct", help="número do CT-e")
+    consulta.add_argument("--cnpj", help="CNPJ do remetente")
+    consulta.add_argument("--po", help="PO antes ou depois")
+    consulta.add_argument("--desde", help="data inicial (AAAA-MM-DD[ HH:MM:SS])")
+    consulta.add_argument("--ate", help="data final (AAAA-MM-DD[ HH:MM:SS])")
+    consulta.add_argument(
+        "--formato", choices=["texto", "csv", "json"], default="texto",
+        help="formato da saída (texto = mesmo formato do LOG_EDICAO_PO.txt)",
+    )
+    parser.add_argument(
+        "--zip-nivel", type=int, choices=range(10), default=ZIP_NIVEL_XML, metavar="0-9",
+        help=f"nível de deflate dos XMLs editados nos ZIPs (0 = sem compressão; padrão: {ZIP_NIVEL_XML})",
+    )
+    parser.add_argument(
+        "--zip-threads", type=int, default=ZIP_THREADS,
+        help="threads de compressão dos ZIPs (padrão: nº de CPUs)",
+    )
+    parser.add_argument(
+        "--zip-profundidade", type=int, default=PROFUNDIDADE_ZIP,
+        help=f"níveis de ZIP dentro de ZIP que são editados (0 = só o ZIP recebido; padrão: {PROFUNDIDADE_ZIP})",
+    )
+    parser.add_argument(
+        "--log-rotacao", choices=["nenhuma", "tamanho", "diaria"], default="nenhuma",
+        help="rotação de LOG_EDICAO_PO.txt / LOG_ERRO.txt (padrão: nenhuma)",
+    )
+    parser.add_argument(
+        "--log-tamanho-max", type=int, default=10,
+        help="tamanho máximo do log em MB para --log-rotacao tamanho (padrão: 10)",
+    )
+    parser.add_argument(
+        "--log-gzip", action="store_true",
+        help="compacta os logs rotacionados em .gz",
+    )
+    args = parser.parse_args()
+
+    configurar_log(
+        rotacao=args.log_rotacao,
+        tamanho_maximo=args.log_tamanho_max * 1024 * 1024,
+        compactar=args.log_gzip,
+        texto=not args.sem_log_texto,
+    )
+    configurar_zip(
+        nivel_xml=args.zip_nivel, threads=args.zip_threads,
+        profundidade=args.zip_profundidade,
+    )
+    configurar_limites(
+        zip_mb=args.limite_zip_mb, membros=args.limite_membros,
+        razao=args.limite_razao, xml_mb=args.limite_xml_mb,
+    )
+    configurar_pacote(
+        ativo=args.pacote_saida, arquivos=args.pacote_arquivos,
+        mb=args.pacote_mb, minutos=args.pacote_minutos,
+    )
+    try:
+        configurar_saida(args.layout_saida)
+    except ValueError as e:
+        parser.error(str(e))
+    # SIGTERM (ex.: fim do serviço/agendador) passa pelo atexit e descarrega os logs
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
     pastas = definir_pastas_base()
     garantir_pastas(pastas)
-    executar(pastas)
+
+    # Execução agendada com as pastas vazias: sai sem carregar mais nada
+    if not (args.consultar or args.migrar_saida or args.dry_run or args.watch or args.serve) \
+            and nada_a_processar(pastas):
+        return
+
+    if args.migrar_saida:
+        migrar_saida(pastas)
+    elif args.consultar:
+        exportar_auditoria(
+            consultar_auditoria(
+                pastas, chave=args.chave, nct=args.nct, cnpj=args.cnpj,
+                po=args.po, desde=args.desde, ate=args.ate,
+            ),
+            args.formato,
+        )
+    elif args.serve:
+        servir(
+            pastas, workers=args.workers, host=args.host, porta=args.porta,
+            fila=args.fila,
+        )
+    elif args.dry_run:
+        executar_previa(pastas, workers=args.workers, relatorio=args.relatorio)
+    elif args.watch:
+        vigiar(pastas, workers=args.workers)
+    else:
+        executar(pastas, workers=args.workers)
 
 
 if __name__ == "__main__":
+    # Necessário para o pool de processos no executável do PyInstaller
+    multiprocessing.freeze_support()
     main()
 
 
@@ -0,0 +1,398 @@
+# ============================================================
+# VERIFICAR_EDITOR_PO – RESUMO FUNCIONAL
+# ============================================================
+# Objetivo:
+# Conferir o comportamento do EDITOR_AUTOM_PO nos caminhos em que um erro
+# custa caro (PO errado na saída, arquivo perdido ou repetido), com a mesma
+# massa sintética do BENCHMARK_EDITOR_PO. Rodar antes de gerar o executável.
+#
+# Verificações (cada uma em pastas temporárias próprias, em um processo
+# separado, sem tocar na Área de Trabalho real):
+# - remendo_po
+#     • editar_xml_para_saida não altera o XML de entrada: até o
+#       confirmar_xml_saida a entrada continua idêntica
+#     • na saída, todo PO é o do PO_RULES (tomador e UF lidos do XML por
+#       expressão regular, sem o código do editor) e o resto do documento
+#       fica byte a byte igual; o HASH informado é o do arquivo gravado
+#     • o mesmo vale para o PO de tamanho diferente (sem o remendo rápido)
+#       e para o alterar_po_xml, que não deixa .tmp para trás
+# - retomada
+#     • uma execução é derrubada (os._exit, sem finally nem atexit) em três
+#       pontos: antes de gravar os bancos, logo depois de gravá-los e no
+#       meio das confirmações dos XMLs; a execução seguinte recupera o lease
+#     • ao final: entrada e EM_PROCESSAMENTO vazias, nenhum .tmp, cada XML
+#       e ZIP uma única vez na saída e com o PO certo (inclusive dentro do
+#       ZIP), auditoria, índice e LOG_EDICAO_PO completos e sem repetição,
+#       LOG_ERRO vazio
+#
+# Resultado: OK/FALHA por verificação; código de saída 1 se algo falhou.
+#
+# Uso:
+#   python VERIFICAR_EDITOR_PO.py
+#   python VERIFICAR_EDITOR_PO.py --verificacoes retomada --workers 1,4
+# ============================================================
+
+
+
+
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+import BENCHMARK_EDITOR_PO as benchmark
+
+
+# ============================================================
+# CONFIGURAÇÕES
+# ============================================================
+VERIFICACOES = ["remendo_po", "retomada"]
+PONTOS_QUEDA = ["antes_bancos", "depois_bancos", "meio"]
+WORKERS_PADRAO = [1, 3]
+QUANTIDADE_PADRAO = 40
+XMLS_POR_ZIP = 15
+CODIGO_QUEDA = 9
+
+RE_PO = re.compile(rb"4504\d{6,}/\d{5}")
+RE_UF = re.compile(rb"<UFEnv>(\w\w)</UFEnv>")
+RE_CNPJ_REM = re.compile(rb"<rem><CNPJ>([^<]+)</CNPJ>")
+
+
+# ============================================================
+# PO ESPERADO (SEM O CÓDIGO DO EDITOR)
+# ============================================================
+def po_esperado(editor, dados, tipo):
+    uf = RE_UF.search(dados).group(1).decode("ascii")
+    cnpj = re.sub(rb"\D", b"", RE_CNPJ_REM.search(dados).group(1)).decode("ascii")
+    tomador = "CACAU" if cnpj == editor.CNPJ_CACAU else "CHOCOLATE"
+    return editor.PO_RULES[tipo][tomador][uf]
+
+
+def conferir_saida(original, saida, po):
+    # Devolve o problema encontrado ou None
+    pos = {m.group().decode("ascii") for m in RE_PO.finditer(saida)}
+    if pos != {po}:
+        return f"PO na saída {sorted(pos)}, esperado {po}"
+    if RE_PO.search(original) and RE_PO.sub(po.encode("ascii"), original) != saida:
+        return "conteúdo alterado além do PO"
+    return None
+
+
+def ler(caminho):
+    with open(caminho, "rb") as f:
+        return f.read()
+
+
+# ============================================================
+# REMENDO DO PO
+# ============================================================
+def verificar_remendo_po(raiz, quantidade):
+    editor, pastas = benchmark.preparar_ambiente(raiz)
+    entrada = pastas["ENTRADA_FRETE"]
+    benchmark.gerar_xmls(entrada, quantidade, random.Random(benchmark.SEMENTE))
+
+    # PO de tamanho diferente: sai pelo caminho em bytes (alterar_po_bytes)
+    longo = benchmark.gerar_cte(random.Random(1), quantidade + 1)
+    longo = RE_PO.sub(b"45040000000/00010", longo) if RE_PO.search(longo) else longo.replace(
+        b"SEM PEDIDO INFORMADO", b"PEDIDO 45040000000/00010"
+    )
+    with open(os.path.join(entrada, "CTE_PO_LONGO.xml"), "wb") as f:
+        f.write(longo)
+
+    falhas = []
+    temporarios = editor.preparar_temporarios(pastas, "FRETE")
+    for nome in sorted(os.listdir(entrada)):
+        caminho = os.path.join(entrada, nome)
+        original = ler(caminho)
+        po = po_esperado(editor, original, "FRETE")
+
+        info = editor.editar_xml_para_saida(
+            "FRETE", caminho, pastas["SAIDA_FRETE"], pasta_temporaria=temporarios,
+        )
+        if ler(caminho) != original:
+            falhas.append(f"{nome}: entrada alterada antes da confirmação")
+
+        editor.confirmar_xml_saida(info)
+        if os.path.exists(caminho):
+            falhas.append(f"{nome}: entrada não removida após a confirmação")
+            continue
+
+        saida = ler(info["SAIDA"])
+        problema = conferir_saida(original, saida, po)
+        if problema:
+            falhas.append(f"{nome}: {problema}")
+        if info["PO_DEPOIS"] != po or hashlib.sha256(saida).hexdigest() != info["HASH"]:
+            falhas.append(f"{nome}: PO_DEPOIS/HASH não conferem com a saída")
+
+        # alterar_po_xml: troca no próprio arquivo, sem sobras
+        copia = os.path.join(raiz, nome)
+        shutil.copyfile(info["SAIDA"], copia)
+        outro = editor.PO_RULES["CUSTO"]["CACAU"]["SP"]
+        editor.alterar_po_xml(copia, outro)
+        problema = conferir_saida(saida, ler(copia), outro)
+        if problema or os.path.exists(editor.caminho_temporario(copia)):
+            falhas.append(f"{nome}: alterar_po_xml: {problema or '.tmp deixado'}")
+
+    editor.descartar_temporarios(pastas)
+    return {"arquivos": quantidade + 1, "falhas": falhas}
+
+
+# ============================================================
+# RETOMADA APÓS QUEDA
+# ============================================================
+def morrer():
+    # Como uma queda de energia: sem finally, atexit nem fechamento do pool
+    import multiprocessing
+
+    for processo in multiprocessing.active_children():
+        processo.kill()
+    os._exit(CODIGO_QUEDA)
+
+
+def preparar_queda(editor, ponto):
+    editor.LOG_LOTE_LINHAS = 3  # log descarregado também no meio do bloco
+
+    if ponto == "antes_bancos":
+        editor.descarregar_indice = lambda pastas: morrer()
+
+    elif ponto == "depois_bancos":
+        descarregar_auditoria = editor.descarregar_auditoria
+
+        def auditoria_e_queda(pastas):
+            descarregar_auditoria(pastas)
+            editor.anotar_journal({"gravado": True})
+            morrer()
+
+        editor.descarregar_auditoria = auditoria_e_queda
+
+    elif ponto == "meio":
+        confirmar_xml_saida = editor.confirmar_xml_saida
+        confirmados = Counter()
+
+        def confirmar_e_queda(info):
+            confirmados["total"] += 1
+            if confirmados["total"] > 8:
+                morrer()
+            confirmar_xml_saida(info)
+
+        editor.confirmar_xml_saida = confirmar_e_queda
+
+
+def executar_com_queda(raiz, ponto, workers, quantidade):
+    editor, pastas = benchmark.preparar_ambiente(raiz)
+    rnd = random.Random(benchmark.SEMENTE)
+    benchmark.XMLS_POR_ZIP = XMLS_POR_ZIP
+
+    benchmark.gerar_xmls(pastas["ENTRADA_FRETE"], quantidade, rnd, com_pdf=True)
+    benchmark.gerar_zips(pastas["ENTRADA_CUSTO"], quantidade, rnd)
+
+    esperado = {
+        "xmls": {
+            nome: po_esperado(editor, ler(os.path.join(pastas["ENTRADA_FRETE"], nome)), "FRETE")
+            for nome in os.listdir(pastas["ENTRADA_FRETE"]) if nome.endswith(".xml")
+        },
+        "zips": sorted(os.listdir(pastas["ENTRADA_CUSTO"])),
+        "membros_xml": quantidade,
+    }
+    with open(os.path.join(raiz, "esperado.json"), "w", encoding="utf-8") as f:
+        json.dump(esperado, f)
+
+    preparar_queda(editor, ponto)
+    editor.executar(pastas, workers=workers)
+    return {"falhas": ["a execução terminou sem a queda simulada"]}
+
+
+def conferir_retomada(raiz, workers):
+    editor, pastas = benchmark.preparar_ambiente(raiz)
+    editor.executar(pastas, workers=workers)
+
+    with open(os.path.join(raiz, "esperado.json"), encoding="utf-8") as f:
+        esperado = json.load(f)
+
+    falhas = []
+    for tipo in editor.TIPOS:
+        restantes = os.listdir(pastas[f"ENTRADA_{tipo}"])
+        if restantes:
+            falhas.append(f"entrada {tipo} não esvaziou: {sorted(restantes)[:5]}")
+    if os.listdir(pastas["PROCESSAMENTO"]):
+        falhas.append(f"EM_PROCESSAMENTO não esvaziou: {os.listdir(pastas['PROCESSAMENTO'])}")
+
+    saidas = Counter()
+    for pasta, _, nomes in os.walk(pastas["BASE"]):
+        for nome in nomes:
+            caminho = os.path.join(pasta, nome)
+            if nome.endswith(".tmp"):
+                falhas.append(f"temporário deixado: {os.path.relpath(caminho, raiz)}")
+            elif pasta.startswith(pastas["SAIDA_FRETE"]) and nome.endswith(".xml"):
+                saidas[nome] += 1
+                po = esperado["xmls"].get(nome)
+                pos = {m.group().decode("ascii") for m in RE_PO.finditer(ler(caminho))}
+                if pos != {po}:
+                    falhas.append(f"{nome}: PO na saída {sorted(pos)}, esperado {po}")
+            elif pasta.startswith(pastas["SAIDA_CUSTO"]) and nome.endswith(".zip"):
+                saidas[nome] += 1
+                with zipfile.ZipFile(caminho) as zf:
+                    for membro in zf.namelist():
+                        if not membro.endswith(".xml"):
+                            continue
+                        dados = zf.read(membro)
+                        po = po_esperado(editor, dados, "CUSTO")
+                        if {m.group().decode("ascii") for m in RE_PO.finditer(dados)} != {po}:
+                            falhas.append(f"{nome}/{membro}: PO errado")
+
+    for nome in list(esperado["xmls"]) + esperado["zips"]:
+        if saidas[nome] != 1:
+            falhas.append(f"{nome}: {saidas[nome]} vez(es) na saída")
+
+    with sqlite3.connect(os.path.join(pastas["LOG"], "AUDITORIA_PO.db")) as conexao:
+        linhas = conexao.execute("SELECT arquivo, membro FROM auditoria_po").fetchall()
+    repetidas = [linha for linha, n in Counter(linhas).items() if n > 1]
+    total = len(esperado["xmls"]) + esperado["membros_xml"]
+    if repetidas or len(linhas) != total:
+        falhas.append(f"auditoria: {len(linhas)} linha(s) de {total}, repetidas {repetidas[:3]}")
+    faltando = set(esperado["xmls"]) - {arquivo for arquivo, membro in linhas if membro is None}
+    if faltando:
+        falhas.append(f"auditoria sem os XMLs {sorted(faltando)[:5]}")
+
+    with sqlite3.connect(os.path.join(pastas["LOG"], "INDICE_CTE.db")) as conexao:
+        indexados = conexao.execute("SELECT COUNT(*) FROM indice_cte").fetchone()[0]
+    if indexados != len(esperado["xmls"]):
+        falhas.append(f"índice: {indexados} hash(es) de {len(esperado['xmls'])}")
+
+    with open(os.path.join(pastas["LOG"], "LOG_EDICAO_PO.txt"), encoding="utf-8") as f:
+        log = [linha.split(" | ", 1)[1] for linha in f.read().splitlines()]
+    total = len(esperado["xmls"]) + len(esperado["zips"])
+    repetidas = [linha for linha, n in Counter(log).items() if n > 1]
+    if repetidas or len(log) != total:
+        falhas.append(f"LOG_EDICAO_PO: {len(log)} linha(s) de {total}, repetidas {repetidas[:2]}")
+
+    erros = os.path.join(pastas["LOG"], "LOG_ERRO.txt")
+    if os.path.exists(erros) and os.path.getsize(erros):
+        with open(erros, encoding="utf-8") as f:
+            falhas.append(f"LOG_ERRO: {f.read().splitlines()[:3]}")
+
+    return {"arquivos": total, "falhas": falhas}
+
+
+# ============================================================
+# EXECUÇÃO
+# ============================================================
+def rodar_interno(*argumentos):
+    # (código de saída, resultado em JSON ou None)
+    resultado = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--interno", *argumentos],
+        capture_output=True, text=True,
+    )
+    linhas = resultado.stdout.strip().splitlines()
+    try:
+        return resultado.returncode, json.loads(linhas[-1])
+    except (IndexError, ValueError):
+        return resultado.returncode, {"falhas": [resultado.stderr.strip()[-500:] or "sem resultado"]}
+
+
+def verificar(verificacao, workers, quantidade):
+    # Lista de (nome, resultado)
+    resultados = []
+
+    if verificacao == "remendo_po":
+        raiz = tempfile.mkdtemp(prefix="VERIF_PO_")
+        try:
+            resultados.append(("remendo_po", rodar_interno("remendo_po", raiz, str(quantidade))[1]))
+        finally:
+            shutil.rmtree(raiz, ignore_errors=True)
+        return resultados
+
+    for ponto in PONTOS_QUEDA:
+        for n in workers:
+            nome = f"retomada {ponto} (workers={n})"
+            print(f"🔎 {nome}...", flush=True)
+            raiz = tempfile.mkdtemp(prefix="VERIF_PO_")
+            try:
+                codigo, resultado = rodar_interno("queda", raiz, ponto, str(n), str(quantidade))
+                if codigo == CODIGO_QUEDA:
+                    resultado = rodar_interno("retomada", raiz, str(n))[1]
+                resultados.append((nome, resultado))
+            finally:
+                shutil.rmtree(raiz, ignore_errors=True)
+
+    return resultados
+
+
+def executar_interno(argumentos):
+    verificacao, raiz = argumentos[0], argumentos[1]
+
+    if verificacao == "remendo_po":
+        resultado = verificar_remendo_po(raiz, int(argumentos[2]))
+    elif verificacao == "queda":
+        resultado = executar_com_queda(raiz, argumentos[2], int(argumentos[3]), int(argumentos[4]))
+    else:
+        resultado = conferir_retomada(raiz, int(argumentos[2]))
+
+    print(json.dumps(resultado, ensure_ascii=False))
+
+
+# ============================================================
+# RELATÓRIO
+# ============================================================
+def imprimir_tabela(resultados):
+    print("=" * 72)
+    print(f"{'VERIFICAÇÃO':<44}{'ARQUIVOS':>10}{'RESULTADO':>12}")
+    print("-" * 72)
+    for nome, resultado in resultados:
+        situacao = "FALHA" if resultado["falhas"] else "OK"
+        print(f"{nome:<44}{resultado.get('arquivos', '-'):>10}{situacao:>12}")
+        for falha in resultado["falhas"][:10]:
+            print(f"    - {falha}")
+    print("=" * 72)
+
+
+# ============================================================
+# MAIN
+# ============================================================
+def main():
+    parser = argparse.ArgumentParser(description="Verificação do EDITOR_AUTOM_PO")
+    parser.add_argument(
+        "--verificacoes", default=",".join(VERIFICACOES),
+        help=f"verificações separadas por vírgula (padrão: {','.join(VERIFICACOES)})",
+    )
+    parser.add_argument(
+        "--workers", default=",".join(str(n) for n in WORKERS_PADRAO),
+        help="quantidades de workers da retomada, separadas por vírgula (padrão: 1,3)",
+    )
+    parser.add_argument(
+        "--quantidade", type=int, default=QUANTIDADE_PADRAO,
+        help=f"XMLs soltos (e XMLs em ZIPs) da massa (padrão: {QUANTIDADE_PADRAO})",
+    )
+    parser.add_argument("--interno", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.interno:
+        executar_interno(args.interno)
+        return
+
+    verificacoes = [v.strip() for v in args.verificacoes.split(",") if v.strip()]
+    for verificacao in verificacoes:
+        if verificacao not in VERIFICACOES:
+            parser.error(f"verificação desconhecida: {verificacao}")
+
+    workers = [int(n) for n in args.workers.split(",")]
+    resultados = []
+    for verificacao in verificacoes:
+        print(f"🔎 {verificacao}...", flush=True)
+        resultados.extend(verificar(verificacao, workers, args.quantidade))
+
+    imprimir_tabela(resultados)
+    sys.exit(1 if any(r["falhas"] for _, r in resultados) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
+import io
 import os
 import time
 import re
 import zipfile
 import shutil
-from lxml import etree
+from collections import Counter
 
 # ============================================================
 # CONFIGURAÇÕES GERAIS
@@ -20,6 +21,55 @@ CNPJ_CACAU = "33163908010561"
 CNPJ_CHOCOLATE = "33163908008583"
 
 
+# ============================================================
+# LIMITES (ZIP-BOMBA E MEMÓRIA)
+# ============================================================
+# ZIP ou XML fora destes limites não é extraído nem lido: vai para
+# QUARENTENA e o motivo para LOG_ERRO.txt. Os tamanhos declarados no ZIP são
+# conferidos antes da extração, e o zipfile nunca grava mais que o declarado
+# (o excedente falha no CRC); o XML solto é lido até o limite + 1 byte.
+LIMITE_ZIP_BYTES = 4096 * 1024 * 1024
+LIMITE_MEMBROS = 200000
+LIMITE_RAZAO = 200
+RAZAO_MINIMA_BYTES = 1024 * 1024
+LIMITE_XML_BYTES = 50 * 1024 * 1024
+DIR_QUARENTENA = os.path.join(os.path.dirname(DIR_ORIGEM), "QUARENTENA")
+
+
+class ArquivoRecusado(ValueError):
+    """Arquivo fora dos limites"""
+
+
+def verificar_zip(zf):
+    """Confere quantidade, tamanho descompactado e razão de compressão dos membros"""
+    membros = zf.infolist()
+    if len(membros) > LIMITE_MEMBROS:
+        raise ArquivoRecusado(f"{len(membros)} membros (limite {LIMITE_MEMBROS})")
+
+    total = 0
+    for info in membros:
+        total += info.file_size
+        if total > LIMITE_ZIP_BYTES:
+            raise ArquivoRecusado(f"mais de {LIMITE_ZIP_BYTES // 1024 // 1024} MB descompactados")
+        if info.filename.lower().endswith(".xml") and info.file_size > LIMITE_XML_BYTES:
+            raise ArquivoRecusado(f"{info.filename} com {info.file_size} bytes (limite por XML)")
+        if info.file_size >= RAZAO_MINIMA_BYTES and info.file_size > LIMITE_RAZAO * max(info.compress_size, 1):
+            raise ArquivoRecusado(f"{info.filename} com compressão acima de {LIMITE_RAZAO}:1")
+
+
+def quarentenar(caminho, motivo):
+    """Move o arquivo para QUARENTENA e registra o motivo em LOG_ERRO.txt"""
+    nome = os.path.basename(caminho)
+    os.makedirs(DIR_QUARENTENA, exist_ok=True)
+    try:
+        shutil.move(caminho, os.path.join(DIR_QUARENTENA, nome))
+    except OSError as e:
+        motivo = f"{motivo} (não foi possível mover: {e})"
+    with open(os.path.join(DIR_FINAL, "LOG_ERRO.txt"), "a", encoding="utf-8") as log:
+        log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {nome} | ERRO=QUARENTENA: {motivo}\n")
+    print(f"🚫 Quarentena: {nome} ({motivo})")
+
+
 # ============================================================
 # FUNÇÕES AUXILIARES
 # ============================================================
@@ -36,53 +86,128 @@ def extrair_zips(origem, destino_tmp):
 
         try:
             with zipfile.ZipFile(zip_path, "r") as zf:
+                verificar_zip(zf)
                 zf.extractall(destino_pasta)
             print(f"📦 Extraído: {zip_name} → {destino_pasta}")
             extraidos.append(destino_pasta)
+        except ArquivoRecusado as e:
+            shutil.rmtree(destino_pasta, ignore_errors=True)
+            quarentenar(zip_path, str(e))
         except Exception as e:
             print(f"💥 Erro ao extrair {zip_name}: {e}")
     return extraidos
 
 
-def modify_text_value(tree, old_value=None, new_value=None):
-    """Substitui valores de PO em qualquer tag de texto"""
+# Índice dos nós que podem levar o PO (XPath compilado uma vez): apenas as
+# observações do complemento, no namespace do CT-e. Demais textos do
+# documento (chaves, valores, endereços) nunca são visitados nem alterados.
+NS = {"cte": "http://www.portalfiscal.inf.br/cte"}
+NS_CTE = f"{{{NS['cte']}}}"  # prefixo das tags no iterparse
+PADRAO_PO_TEXTO = re.compile(r"4504\d{6,}/\d{5}")
+XPATH_NOS_PO = "//cte:xObs | //cte:ObsCont/cte:xTexto | //cte:ObsFisco/cte:xTexto"
+xpaths_compilados = {}
+
+
+def xpath_cte(expressao):
+    """Compila o XPath uma única vez (o lxml só é carregado quando algum XML precisa da árvore)"""
+    xpath = xpaths_compilados.get(expressao)
+    if xpath is None:
+        from lxml import etree
+
+        xpath = xpaths_compilados[expressao] = etree.XPath(expressao, namespaces=NS)
+    return xpath
+
+
+def substituir_po_nos(elems, old_value=None, new_value=None):
+    """Troca o PO no texto dos nós informados, preservando o restante do texto"""
     changed = False
-    for elem in tree.xpath("//*[text()]"):
+    for elem in elems:
         text = elem.text
         if text:
             if old_value and old_value in text:
                 elem.text = text.replace(old_value, new_value)
                 changed = True
-            elif "4504" in text and "/000" in text:
-                elem.text = new_value
+            elif PADRAO_PO_TEXTO.search(text):
+                elem.text = PADRAO_PO_TEXTO.sub(new_value, text)
                 changed = True
     return changed
 
 
-def modify_xTexto_value(tree, old_value=None, new_value=None):
-    """Substitui valores dentro de <xTexto>"""
-    changed = False
-    for elem in tree.findall(".//xTexto"):
-        if elem.text:
-            if old_value and old_value in elem.text:
-                elem.text = elem.text.replace(old_value, new_value)
-                changed = True
-            elif "4504" in elem.text and "/000" in elem.text:
-                elem.text = new_value
-                changed = True
-    return changed
+def modify_text_value(tree, old_value=None, new_value=None):
+    """Substitui valores de PO nos nós de observação (<xObs>, <ObsCont>/<xTexto>)"""
+    return substituir_po_nos(xpath_cte(XPATH_NOS_PO)(tree), old_value, new_value)
+
+
+# Leitura rápida, sem lxml: os campos são localizados direto nos bytes já
+# lidos. Fora do padrão (UTF-16, comentário/CDATA, campo ausente ou com
+# acento/entidade) devolve None e a leitura segue pelo iterparse.
+RE_CAMPOS_CTE = {
+    "UFEnv": re.compile(rb"<(?:[\w.-]+:)?UFEnv>([A-Z]{2})</"),
+    "nCT": re.compile(rb"<(?:[\w.-]+:)?nCT>(\d+)</"),
+    "xMunEnv": re.compile(rb"<(?:[\w.-]+:)?xMunEnv>([^<&]*)</"),
+}
+RE_REM = re.compile(rb"<(?:[\w.-]+:)?rem[\s>].*?</(?:[\w.-]+:)?rem>", re.S)
+RE_CNPJ = re.compile(rb"<(?:[\w.-]+:)?CNPJ>([^<]*)</")
+RE_MARCACAO_ESPECIAL = re.compile(rb"<!--|<!\[CDATA\[")
+
+
+def ler_campos_rapido(dados, campos):
+    """Lê os campos do CT-e direto nos bytes (None se o documento fugir do padrão)"""
+    if dados[:2] in (b"\xff\xfe", b"\xfe\xff") or RE_MARCACAO_ESPECIAL.search(dados):
+        return None
+
+    valores = {}
+    for campo in campos:
+        if campo == "rem/CNPJ":
+            rem = RE_REM.search(dados)
+            encontrado = RE_CNPJ.search(rem.group()) if rem else None
+        else:
+            encontrado = RE_CAMPOS_CTE[campo].search(dados)
+
+        if not encontrado or not encontrado.group(1).isascii():
+            return None
+        valores[campo] = encontrado.group(1).decode("ascii")
+    return valores
 
 
-def obter_info_xml(file_path):
+def ler_campos_cte(file_path, campos):
+    """Lê os campos do CT-e com iterparse, parando assim que todos forem encontrados"""
+    from lxml import etree
+
+    valores = {}
+    for evento, elem in etree.iterparse(file_path, events=("end",)):
+        nome = elem.tag[len(NS_CTE):] if elem.tag.startswith(NS_CTE) else None
+
+        if nome == "CNPJ":
+            pai = elem.getparent()
+            if pai is not None and pai.tag == NS_CTE + "rem":
+                nome = "rem/CNPJ"
+
+        if nome in campos and nome not in valores:
+            valores[nome] = elem.text
+            if len(valores) == len(campos):
+                break
+
+        # Libera o que já foi lido (infCarga/infDoc podem ser longos)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return valores
+
+
+def obter_info_xml(file_path, dados=None):
     """Lê UF, Município, nCT e CNPJ do Tomador (<rem><CNPJ>)"""
     try:
-        tree = etree.parse(file_path)
-        ns = {"cte": "http://www.portalfiscal.inf.br/cte"}
-
-        uf = tree.findtext(".//cte:UFEnv", namespaces=ns)
-        mun = tree.findtext(".//cte:xMunEnv", namespaces=ns)
-        nct = tree.findtext(".//cte:nCT", namespaces=ns)
-        cnpj_rem = tree.findtext(".//cte:rem/cte:CNPJ", namespaces=ns)
+        campos = {"UFEnv", "xMunEnv", "nCT", "rem/CNPJ"}
+        valores = ler_campos_rapido(dados, campos) if dados is not None else None
+        if valores is None:
+            fonte = io.BytesIO(dados) if dados is not None else file_path
+            valores = ler_campos_cte(fonte, campos)
+
+        uf = valores.get("UFEnv")
+        mun = valores.get("xMunEnv")
+        nct = valores.get("nCT")
+        cnpj_rem = valores.get("rem/CNPJ")
         if cnpj_rem:
             cnpj_rem = re.sub(r"\D", "", cnpj_rem)
         return uf, mun, nct, cnpj_rem
@@ -91,21 +216,20 @@ def obter_info_xml(file_path):
         return None, None, None, None
 
 
-def alterar_po(file_path, novo_po, destino_final):
+def alterar_po(file_path, novo_po, destino_final, dados=None):
     """Edita o PO no XML e salva no destino mantendo a estrutura"""
+    from lxml import etree
+
     try:
-        tree = etree.parse(file_path)
-        ns = {"cte": "http://www.portalfiscal.inf.br/cte"}
+        tree = etree.parse(io.BytesIO(dados) if dados is not None else file_path)
 
         valores_antigos = []
-        for elem in tree.xpath(".//cte:xTexto | .//cte:xObs", namespaces=ns):
+        for elem in xpath_cte(XPATH_NOS_PO)(tree):
             if elem.text:
-                encontrados = re.findall(r"4504\d{6,}/\d{5}", elem.text)
-                if encontrados:
-                    valores_antigos.extend(encontrados)
-        valores_antigos = list(set(valores_antigos))
+                valores_antigos.extend(PADRAO_PO_TEXTO.findall(elem.text))
+        valores_antigos = list(dict.fromkeys(valores_antigos))
 
-        alterado = modify_text_value(tree, None, novo_po) or modify_xTexto_value(tree, None, novo_po)
+        alterado = modify_text_value(tree, None, novo_po)
         if alterado:
             os.makedirs(os.path.dirname(destino_final), exist_ok=True)
             tree.write(destino_final, pretty_print=True, xml_declaration=True, encoding="UTF-8")
@@ -118,6 +242,41 @@ def alterar_po(file_path, novo_po, destino_final):
         return False, None
 
 
+# ============================================================
+# CACHE DA VARREDURA
+# ============================================================
+# Os bytes lidos na varredura ficam em memória para a fase de edição, até
+# LIMITE_CACHE_BYTES; o que não couber é relido do disco na edição.
+LIMITE_CACHE_BYTES = 256 * 1024 * 1024
+
+cache_xml = {}
+cache_total_bytes = 0
+
+
+def ler_xml_bytes(file_path):
+    with open(file_path, "rb") as f:
+        dados = f.read(LIMITE_XML_BYTES + 1)
+    if len(dados) > LIMITE_XML_BYTES:
+        raise ArquivoRecusado(f"XML acima de {LIMITE_XML_BYTES // 1024 // 1024} MB")
+    return dados
+
+
+def guardar_cache(file_path, dados):
+    global cache_total_bytes
+    if cache_total_bytes + len(dados) <= LIMITE_CACHE_BYTES:
+        cache_xml[file_path] = dados
+        cache_total_bytes += len(dados)
+
+
+def retirar_cache(file_path):
+    """Entrega os bytes guardados na varredura (None se não couberam no cache)"""
+    global cache_total_bytes
+    dados = cache_xml.pop(file_path, None)
+    if dados is not None:
+        cache_total_bytes -= len(dados)
+    return dados
+
+
 # ============================================================
 # GRADE DE POs
 # ============================================================
@@ -169,22 +328,38 @@ def main():
         input("\nPressione ENTER para sair...")
         return
 
+    # Varredura única: lê cada arquivo uma vez, guarda os bytes no cache e
+    # conta UF/CNPJ na mesma passada
     arquivos_info = []
+    contagem_uf = Counter()
+    contagem_cnpj = Counter()
     for caminho in xml_files:
-        uf, mun, nct, cnpj_tomador = obter_info_xml(caminho)
+        try:
+            dados = ler_xml_bytes(caminho)
+        except ArquivoRecusado as e:
+            quarentenar(caminho, str(e))
+            continue
+        except OSError as e:
+            print(f"⚠️ Erro ao ler {caminho}: {e}")
+            continue
+
+        uf, mun, nct, cnpj_tomador = obter_info_xml(caminho, dados)
         if uf:
             arquivos_info.append({"arquivo": caminho, "UF": uf, "MUN": mun, "nCT": nct, "CNPJ": cnpj_tomador})
+            guardar_cache(caminho, dados)
+            contagem_uf[uf] += 1
+            if cnpj_tomador:
+                contagem_cnpj[cnpj_tomador] += 1
 
-    total_mg = len([a for a in arquivos_info if a["UF"] == "MG"])
-    total_sp = len([a for a in arquivos_info if a["UF"] == "SP"])
+    total_mg = contagem_uf["MG"]
+    total_sp = contagem_uf["SP"]
     uf_dominante = "MG" if total_mg >= total_sp else "SP"
 
-    cnpjs = [a["CNPJ"] for a in arquivos_info if a["CNPJ"]]
-    if not cnpjs:
+    if not contagem_cnpj:
         print("⚠️ Nenhum CNPJ de tomador localizado.")
         input("\nPressione ENTER para sair...")
         return
-    cnpj_dominante = max(set(cnpjs), key=cnpjs.count)
+    cnpj_dominante = contagem_cnpj.most_common(1)[0][0]
     tomador = "CACAU" if cnpj_dominante == CNPJ_CACAU else "CHOCOLATE"
 
     print("📊 Resumo de detecção:")
@@ -218,12 +393,14 @@ def main():
 
         print(f"🧩 ({ajustados}/{total_arquivos}) nCT Ajustados", end="\r")
 
+        dados = retirar_cache(caminho)
+
         if uf != uf_dominante:
             ignorados += 1
             detalhes_ignorados.append(f"nCT {nct}: Ignorado ({uf})")
             continue
 
-        ok, antigo = alterar_po(caminho, novo_po, destino)
+        ok, antigo = alterar_po(caminho, novo_po, destino, dados)
         if ok:
             alterados += 1
             ajustados += 1
@@ -1,10 +1,13 @@
+import io
 import os
 import sys
 import time
 import re
+import mmap
 import zipfile
+import zlib
 import shutil
-from lxml import etree
+from collections import Counter
 
 # ============================================================
 # AJUSTE AUTOMÁTICO DE DIRETÓRIO (FUNCIONA NO .EXE)
@@ -28,6 +31,55 @@ for pasta in [DIR_ORIGEM, DIR_FINAL, DIR_TEMP]:
 CNPJ_CACAU = "33163908010561"
 CNPJ_CHOCOLATE = "33163908008583"
 
+# ============================================================
+# LIMITES (ZIP-BOMBA E MEMÓRIA)
+# ============================================================
+# ZIP ou XML fora destes limites não é extraído nem lido: vai para
+# QUARENTENA e o motivo para LOG_ERRO.txt. Os tamanhos declarados no ZIP são
+# conferidos antes da extração, e o zipfile nunca grava mais que o declarado
+# (o excedente falha no CRC); o XML solto é lido até o limite + 1 byte.
+LIMITE_ZIP_BYTES = 4096 * 1024 * 1024
+LIMITE_MEMBROS = 200000
+LIMITE_RAZAO = 200
+RAZAO_MINIMA_BYTES = 1024 * 1024
+LIMITE_XML_BYTES = 50 * 1024 * 1024
+DIR_QUARENTENA = os.path.join(BASE_DIR, "QUARENTENA")
+
+
+class ArquivoRecusado(ValueError):
+    """Arquivo fora dos limites"""
+
+
+def verificar_zip(zf):
+    """Confere quantidade, tamanho descompactado e razão de compressão dos membros"""
+    membros = zf.infolist()
+    if len(membros) > LIMITE_MEMBROS:
+        raise ArquivoRecusado(f"{len(membros)} membros (limite {LIMITE_MEMBROS})")
+
+    total = 0
+    for info in membros:
+        total += info.file_size
+        if total > LIMITE_ZIP_BYTES:
+            raise ArquivoRecusado(f"mais de {LIMITE_ZIP_BYTES // 1024 // 1024} MB descompactados")
+        if info.filename.lower().endswith(".xml") and info.file_size > LIMITE_XML_BYTES:
+            raise ArquivoRecusado(f"{info.filename} com {info.file_size} bytes (limite por XML)")
+        if info.file_size >= RAZAO_MINIMA_BYTES and info.file_size > LIMITE_RAZAO * max(info.compress_size, 1):
+            raise ArquivoRecusado(f"{info.filename} com compressão acima de {LIMITE_RAZAO}:1")
+
+
+def quarentenar(caminho, motivo):
+    """Move o arquivo para QUARENTENA e registra o motivo em LOG_ERRO.txt"""
+    nome = os.path.basename(caminho)
+    os.makedirs(DIR_QUARENTENA, exist_ok=True)
+    try:
+        shutil.move(caminho, os.path.join(DIR_QUARENTENA, nome))
+    except OSError as e:
+        motivo = f"{motivo} (não foi possível mover: {e})"
+    with open(os.path.join(DIR_FINAL, "LOG_ERRO.txt"), "a", encoding="utf-8") as log:
+        log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {nome} | ERRO=QUARENTENA: {motivo}\n")
+    print(f"🚫 Quarentena: {nome} ({motivo})")
+
+
 # ============================================================
 # FUNÇÕES AUXILIARES
 # ============================================================
@@ -44,33 +96,207 @@ def extrair_zips(origem, destino_tmp):
 
         try:
             with zipfile.ZipFile(zip_path, "r") as zf:
+                verificar_zip(zf)
                 zf.extractall(destino_pasta)
             print(f"📦 Extraído: {zip_name}")
             extraidos.append((zip_name, zip_path, destino_pasta))
+        except ArquivoRecusado as e:
+            shutil.rmtree(destino_pasta, ignore_errors=True)
+            quarentenar(zip_path, str(e))
         except Exception as e:
             print(f"💥 Erro ao extrair {zip_name}: {e}")
     return extraidos
 
 
+# Compressão do ZIP recriado: os XMLs usam deflate no NIVEL_ZIP, comprimidos
+# em threads (o zlib libera o GIL) em blocos de até BLOCO_ZIP arquivos e
+# BLOCO_ZIP_BYTES, e gravados na ordem. Os demais arquivos (PDF, imagens,
+# ZIPs internos...) vão do disco para o ZIP em streaming, sem passar
+# inteiros pela memória; os que já vêm comprimidos são apenas armazenados.
+EXTENSOES_JA_COMPRIMIDAS = {
+    ".pdf", ".jpg", ".jpeg", ".png", ".gif", ".zip", ".gz", ".7z", ".rar",
+    ".docx", ".xlsx",
+}
+NIVEL_ZIP = 6
+THREADS_ZIP = os.cpu_count() or 1
+BLOCO_ZIP = 64
+BLOCO_ZIP_BYTES = 64 * 1024 * 1024
+
+
+def comprimir_arquivo(full_path):
+    """Lê e comprime um XML (devolve tipo, dados, CRC, tamanho e CPU)"""
+    inicio = time.thread_time()
+    with open(full_path, "rb") as f:
+        dados = f.read()
+    crc = zlib.crc32(dados)
+    tipo, gravado = zipfile.ZIP_STORED, dados
+
+    if NIVEL_ZIP > 0 and os.path.splitext(full_path)[1].lower() not in EXTENSOES_JA_COMPRIMIDAS:
+        compressor = zlib.compressobj(NIVEL_ZIP, zlib.DEFLATED, -15)
+        comprimido = compressor.compress(dados) + compressor.flush()
+        if len(comprimido) < len(dados):
+            tipo, gravado = zipfile.ZIP_DEFLATED, comprimido
+
+    return tipo, gravado, crc, len(dados), time.thread_time() - inicio
+
+
+def gravar_membro(zf, zinfo, dados):
+    """Grava no ZIP um membro já comprimido (cabeçalho local + dados)"""
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(dados)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf._didModify = True
+
+
+def gravar_em_stream(zf, full_path, rel_path):
+    """Grava o arquivo no ZIP lendo do disco em partes (devolve tamanho, gravado e CPU)"""
+    inicio = time.thread_time()
+    if NIVEL_ZIP > 0 and os.path.splitext(full_path)[1].lower() not in EXTENSOES_JA_COMPRIMIDAS:
+        zf.write(full_path, rel_path, zipfile.ZIP_DEFLATED, NIVEL_ZIP)
+    else:
+        zf.write(full_path, rel_path, zipfile.ZIP_STORED)
+    zinfo = zf.filelist[-1]
+    return zinfo.file_size, zinfo.compress_size, time.thread_time() - inicio
+
+
+def agrupar_arquivos(arquivos):
+    """Junta XMLs consecutivos em blocos (lista); os demais seguem sozinhos (tupla)"""
+    bloco, tamanho_bloco = [], 0
+    for full_path, rel_path in arquivos:
+        if not full_path.lower().endswith(".xml"):
+            if bloco:
+                yield bloco
+                bloco, tamanho_bloco = [], 0
+            yield full_path, rel_path
+            continue
+
+        tamanho = os.path.getsize(full_path)
+        if bloco and (len(bloco) >= BLOCO_ZIP or tamanho_bloco + tamanho > BLOCO_ZIP_BYTES):
+            yield bloco
+            bloco, tamanho_bloco = [], 0
+        bloco.append((full_path, rel_path))
+        tamanho_bloco += tamanho
+
+    if bloco:
+        yield bloco
+
+
 def recreate_zip(folder_path, zip_dest_path):
     """Compacta novamente uma pasta em um ZIP (mantendo PDFs e XMLs editados)"""
-    with zipfile.ZipFile(zip_dest_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                full_path = os.path.join(root, file)
-                rel_path = os.path.relpath(full_path, folder_path)
-                zf.write(full_path, rel_path)
-    print(f"🗜️ Novo ZIP: {os.path.basename(zip_dest_path)}")
+    arquivos = []
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            full_path = os.path.join(root, file)
+            arquivos.append((full_path, os.path.relpath(full_path, folder_path)))
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    original = gravado = 0
+    cpu = 0.0
+    with ThreadPoolExecutor(max_workers=THREADS_ZIP) as pool, \
+            zipfile.ZipFile(zip_dest_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for bloco in agrupar_arquivos(arquivos):
+            if isinstance(bloco, tuple):
+                tamanho, comprimido, tempo = gravar_em_stream(zf, *bloco)
+                original += tamanho
+                gravado += comprimido
+                cpu += tempo
+                continue
+
+            for (full_path, rel_path), (tipo, dados, crc, tamanho, tempo) in zip(
+                bloco, pool.map(comprimir_arquivo, [full for full, _ in bloco])
+            ):
+                zinfo = zipfile.ZipInfo.from_file(full_path, rel_path)
+                zinfo.compress_type = tipo
+                zinfo.CRC = crc
+                zinfo.file_size = tamanho
+                zinfo.compress_size = len(dados)
+                gravar_membro(zf, zinfo, dados)
+
+                original += tamanho
+                gravado += len(dados)
+                cpu += tempo
+
+    print(
+        f"🗜️ Novo ZIP: {os.path.basename(zip_dest_path)} "
+        f"({original / 1048576:.1f} MB → {gravado / 1048576:.1f} MB, CPU {cpu:.2f}s)"
+    )
+
+
+NS_CTE = "{http://www.portalfiscal.inf.br/cte}"
+
+
+# Leitura rápida, sem lxml: os campos são localizados direto nos bytes já
+# lidos. Fora do padrão (UTF-16, comentário/CDATA, campo ausente ou com
+# acento/entidade) devolve None e a leitura segue pelo iterparse.
+RE_CAMPOS_CTE = {
+    "UFEnv": re.compile(rb"<(?:[\w.-]+:)?UFEnv>([A-Z]{2})</"),
+    "nCT": re.compile(rb"<(?:[\w.-]+:)?nCT>(\d+)</"),
+    "xMunEnv": re.compile(rb"<(?:[\w.-]+:)?xMunEnv>([^<&]*)</"),
+}
+RE_REM = re.compile(rb"<(?:[\w.-]+:)?rem[\s>].*?</(?:[\w.-]+:)?rem>", re.S)
+RE_CNPJ = re.compile(rb"<(?:[\w.-]+:)?CNPJ>([^<]*)</")
+RE_MARCACAO_ESPECIAL = re.compile(rb"<!--|<!\[CDATA\[")
+
+
+def ler_campos_rapido(dados, campos):
+    """Lê os campos do CT-e direto nos bytes (None se o documento fugir do padrão)"""
+    if dados[:2] in (b"\xff\xfe", b"\xfe\xff") or RE_MARCACAO_ESPECIAL.search(dados):
+        return None
+
+    valores = {}
+    for campo in campos:
+        if campo == "rem/CNPJ":
+            rem = RE_REM.search(dados)
+            encontrado = RE_CNPJ.search(rem.group()) if rem else None
+        else:
+            encontrado = RE_CAMPOS_CTE[campo].search(dados)
+
+        if not encontrado or not encontrado.group(1).isascii():
+            return None
+        valores[campo] = encontrado.group(1).decode("ascii")
+    return valores
+
+
+def ler_campos_cte(file_path, campos):
+    """Lê os campos do CT-e com iterparse, parando assim que todos forem encontrados"""
+    from lxml import etree
+
+    valores = {}
+    for evento, elem in etree.iterparse(file_path, events=("end",)):
+        nome = elem.tag[len(NS_CTE):] if elem.tag.startswith(NS_CTE) else None
+
+        if nome == "CNPJ":
+            pai = elem.getparent()
+            if pai is not None and pai.tag == NS_CTE + "rem":
+                nome = "rem/CNPJ"
+
+        if nome in campos and nome not in valores:
+            valores[nome] = elem.text
+            if len(valores) == len(campos):
+                break
 
+        # Libera o que já foi lido (infCarga/infDoc podem ser longos)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return valores
 
-def obter_info_xml(file_path):
+
+def obter_info_xml(file_path, dados=None):
     """Extrai informações principais do XML (UF, nCT, CNPJ Tomador)"""
     try:
-        tree = etree.parse(file_path)
-        ns = {"cte": "http://www.portalfiscal.inf.br/cte"}
-        uf = tree.findtext(".//cte:UFEnv", namespaces=ns)
-        nct = tree.findtext(".//cte:nCT", namespaces=ns)
-        cnpj_rem = tree.findtext(".//cte:rem/cte:CNPJ", namespaces=ns)
+        campos = {"UFEnv", "nCT", "rem/CNPJ"}
+        valores = ler_campos_rapido(dados, campos) if dados is not None else None
+        if valores is None:
+            fonte = io.BytesIO(dados) if dados is not None else file_path
+            valores = ler_campos_cte(fonte, campos)
+        uf = valores.get("UFEnv")
+        nct = valores.get("nCT")
+        cnpj_rem = valores.get("rem/CNPJ")
         if cnpj_rem:
             cnpj_rem = re.sub(r"\D", "", cnpj_rem)
         return uf, nct, cnpj_rem
@@ -78,26 +304,75 @@ def obter_info_xml(file_path):
         return None, None, None
 
 
-def alterar_po(file_path, novo_po):
-    """Substitui ou adiciona o PO em qualquer parte do XML"""
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            xml_text = f.read()
+PADRAO_PO = re.compile(rb"4504\d{6,}/\d{5}")
 
-        # Captura todos os POs antigos (mesmo que repetidos)
-        encontrados = re.findall(r"4504\d{6,}/\d{5}", xml_text)
-        antigo = encontrados[0] if encontrados else "(não encontrado)"
 
+def alterar_po_bytes(xml, novo_po):
+    """Substitui (ou insere) o PO nos bytes do XML, preservando codificação e declaração"""
+    if xml[:2] in (b"\xff\xfe", b"\xfe\xff"):  # UTF-16: único caso que precisa decodificar
+        editado, antigo = alterar_po_bytes(xml.decode("utf-16").encode("utf-8"), novo_po)
+        return editado.decode("utf-8").encode("utf-16"), antigo
+
+    # Captura o primeiro PO antigo (mesmo que repetido)
+    encontrado = PADRAO_PO.search(xml)
+    if encontrado:
         # Substitui todos os padrões existentes por novo PO
-        xml_editado = re.sub(r"4504\d{6,}/\d{5}", novo_po, xml_text)
+        return PADRAO_PO.sub(novo_po.encode("ascii"), xml), encontrado.group().decode("ascii")
+
+    # Se não houver nenhum PO anterior, ainda insere o novo (mantendo XML íntegro)
+    editado = xml.replace(b"</CTe>", f"<xObs>{novo_po}</xObs></CTe>".encode("ascii"))
+    return editado, "(não encontrado)"
 
-        # Se não houver nenhum PO anterior, ainda insere o novo (mantendo XML íntegro)
-        if xml_editado == xml_text:
-            xml_editado = xml_text.replace("</CTe>", f"<xObs>{novo_po}</xObs></CTe>")
 
-        # Regrava o XML editado
-        with open(file_path, "w", encoding="utf-8") as f:
+def alterar_po(file_path, novo_po, dados=None):
+    """Substitui ou adiciona o PO em qualquer parte do XML"""
+    try:
+        novo = novo_po.encode("ascii")
+
+        # Bytes já lidos na varredura: as posições do PO saem da memória e,
+        # com o mesmo tamanho, só esses trechos são regravados no arquivo
+        if dados is not None:
+            encontrados = list(PADRAO_PO.finditer(dados))
+            if (
+                dados[:2] not in (b"\xff\xfe", b"\xfe\xff")
+                and encontrados
+                and all(m.end() - m.start() == len(novo) for m in encontrados)
+            ):
+                with open(file_path, "r+b") as f:
+                    for m in encontrados:
+                        f.seek(m.start())
+                        f.write(novo)
+                return True, encontrados[0].group().decode("ascii")
+
+            xml_editado, antigo = alterar_po_bytes(dados, novo_po)
+            with open(file_path, "wb") as f:
+                f.write(xml_editado)
+            return True, antigo
+
+        with open(file_path, "r+b") as f:
+            # Caminho rápido: PO novo com o mesmo tamanho do antigo é trocado
+            # direto no arquivo mapeado em memória, sem cópia do documento
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0) as mm:
+                    encontrados = list(PADRAO_PO.finditer(mm))
+                    if (
+                        mm[:2] not in (b"\xff\xfe", b"\xfe\xff")
+                        and encontrados
+                        and all(m.end() - m.start() == len(novo) for m in encontrados)
+                    ):
+                        antigo = encontrados[0].group().decode("ascii")
+                        for m in encontrados:
+                            mm[m.start():m.end()] = novo
+                        mm.flush()
+                        return True, antigo
+
+            f.seek(0)
+            xml_editado, antigo = alterar_po_bytes(f.read(), novo_po)
+
+            # Regrava o XML editado
+            f.seek(0)
             f.write(xml_editado)
+            f.truncate()
 
         return True, antigo
 
@@ -106,6 +381,41 @@ def alterar_po(file_path, novo_po):
         return False, None
 
 
+# ============================================================
+# CACHE DA VARREDURA
+# ============================================================
+# Os bytes lidos na varredura ficam em memória para a fase de edição, até
+# LIMITE_CACHE_BYTES; o que não couber é relido do disco na edição.
+LIMITE_CACHE_BYTES = 256 * 1024 * 1024
+
+cache_xml = {}
+cache_total_bytes = 0
+
+
+def ler_xml_bytes(file_path):
+    with open(file_path, "rb") as f:
+        dados = f.read(LIMITE_XML_BYTES + 1)
+    if len(dados) > LIMITE_XML_BYTES:
+        raise ArquivoRecusado(f"XML acima de {LIMITE_XML_BYTES // 1024 // 1024} MB")
+    return dados
+
+
+def guardar_cache(file_path, dados):
+    global cache_total_bytes
+    if cache_total_bytes + len(dados) <= LIMITE_CACHE_BYTES:
+        cache_xml[file_path] = dados
+        cache_total_bytes += len(dados)
+
+
+def retirar_cache(file_path):
+    """Entrega os bytes guardados na varredura (None se não couberam no cache)"""
+    global cache_total_bytes
+    dados = cache_xml.pop(file_path, None)
+    if dados is not None:
+        cache_total_bytes -= len(dados)
+    return dados
+
+
 # ============================================================
 # GRADE DE POs
 # ============================================================
@@ -163,18 +473,33 @@ def main():
         input("\nPressione ENTER para sair...")
         return
 
+    # Varredura única: lê cada arquivo uma vez, guarda os bytes no cache e
+    # conta UF/CNPJ na mesma passada
     arquivos_info = []
+    contagem_uf = Counter()
+    contagem_cnpj = Counter()
     for caminho in xml_files:
-        uf, nct, cnpj = obter_info_xml(caminho)
+        try:
+            dados = ler_xml_bytes(caminho)
+        except ArquivoRecusado as e:
+            quarentenar(caminho, str(e))
+            continue
+        except OSError:
+            continue
+
+        uf, nct, cnpj = obter_info_xml(caminho, dados)
         if uf:
             arquivos_info.append({"arquivo": caminho, "UF": uf, "nCT": nct, "CNPJ": cnpj})
+            guardar_cache(caminho, dados)
+            contagem_uf[uf] += 1
+            if cnpj:
+                contagem_cnpj[cnpj] += 1
 
-    total_mg = len([a for a in arquivos_info if a["UF"] == "MG"])
-    total_sp = len([a for a in arquivos_info if a["UF"] == "SP"])
+    total_mg = contagem_uf["MG"]
+    total_sp = contagem_uf["SP"]
     uf_dominante = "MG" if total_mg >= total_sp else "SP"
 
-    cnpjs = [a["CNPJ"] for a in arquivos_info if a["CNPJ"]]
-    cnpj_dominante = max(set(cnpjs), key=cnpjs.count)
+    cnpj_dominante = contagem_cnpj.most_common(1)[0][0]
     tomador = "CACAU" if cnpj_dominante == CNPJ_CACAU else "CHOCOLATE"
 
     print("📊 Resumo de detecção:")
@@ -202,12 +527,14 @@ def main():
         caminho = arq["arquivo"]
         print(f"🧩 ({idx}/{total}) nCT {nct}", end="\r")
 
+        dados = retirar_cache(caminho)
+
         if uf != uf_dominante:
             ignorados += 1
             detalhes_ignorados.append(f"nCT {nct}: Ignorado ({uf})")
             continue
 
-        ok, antigo = alterar_po(caminho, novo_po)
+        ok, antigo = alterar_po(caminho, novo_po, dados)
         if ok:
             alterados += 1
             detalhes_alterados.append(f"nCT {nct}: Alterado de {antigo} → {novo_po}")